@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Compare allocations and throughput per received message with and without borrowed frames.
+
+Borrowed frames take half the allocations per message, no payload object and no copy of
+its bytes, but hold more bytes while frames are kept: Frame.bytes is a memoryview slice of
+the receive buffer then, which is bigger than a copy of a short payload. Protobuf parses
+whole buffers only, so the slice can't be done without.
+
+Usage: python benchmarks/borrowed_frames.py [message count]
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+import tracemalloc
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from smarkets.streaming_api import eto, seto  # noqa
+from smarkets.streaming_api.framing import frame_encode  # noqa
+from smarkets.streaming_api.session import Session, SessionSettings  # noqa
+
+
+def make_frames(count):
+    frames = bytearray()
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_ETO
+    payload.eto_payload.type = eto.PAYLOAD_PONG
+    for seq in range(1, count + 1):
+        payload.eto_payload.seq = seq
+        frame_encode(frames, payload.SerializeToString())
+    return frames
+
+
+def run(frames, count, borrowed_frames):
+    session = Session(SessionSettings(
+        'username', 'password', read_buffer_capacity=len(frames), borrowed_frames=borrowed_frames))
+    session.decoder.feed(frames)
+    started = time.time()
+    for frame in session.next_frames():
+        pass
+    elapsed = time.time() - started
+    assert session.inseq == count + 1
+    return elapsed
+
+
+def measure_allocations(frames, count, borrowed_frames):
+    """
+    Count memory blocks and bytes allocated for every message. Frames are kept alive so that
+    everything allocated for them shows up in the snapshot, the bytes are what every kept
+    frame holds on to.
+    """
+    session = Session(SessionSettings(
+        'username', 'password', read_buffer_capacity=len(frames), borrowed_frames=borrowed_frames))
+    session.decoder.feed(frames)
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept.extend(session.next_frames())
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = [stat for stat in after.compare_to(before, 'filename') if stat.count_diff > 0]
+    # The list holding the frames is not allocated by the session
+    blocks = sum(stat.count_diff for stat in stats) - 1
+    size = sum(stat.size_diff for stat in stats) - sys.getsizeof(kept)
+    return blocks / count, size / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frames = make_frames(count)
+    for borrowed_frames in (False, True):
+        elapsed = min(run(frames, count, borrowed_frames) for _ in range(3))
+        blocks, size = measure_allocations(frames, count, borrowed_frames)
+        print('borrowed_frames=%-5s  blocks/msg: %5.2f  bytes/msg: %7.1f  msgs/s: %9.0f' % (
+            borrowed_frames, blocks, size, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
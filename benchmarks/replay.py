@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Replay a capture made with CaptureRecorder through a client as fast as possible and report
+the throughput, optionally profiling the run.
+
+Usage: python benchmarks/replay.py <capture file> [--profile] [--borrowed-frames]
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cProfile
+import pstats
+import sys
+import time
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from smarkets.streaming_api.client import StreamingAPIClient  # noqa
+from smarkets.streaming_api.replay import replay  # noqa
+from smarkets.streaming_api.session import Session, SessionSettings  # noqa
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) != 1:
+        sys.exit(__doc__)
+    settings = SessionSettings('username', 'password', borrowed_frames='--borrowed-frames' in sys.argv)
+    client = StreamingAPIClient(Session(settings))
+    # Dispatch every payload, like a client with handlers for everything would
+    client.add_global_handler(lambda name, message: None)
+    profile = cProfile.Profile() if '--profile' in sys.argv else None
+    started = time.time()
+    if profile is not None:
+        profile.enable()
+    dispatched = replay(client, args[0])
+    if profile is not None:
+        profile.disable()
+    elapsed = time.time() - started
+    print('dispatched %d frames in %.3fs, %.0f frames/s' % (dispatched, elapsed, dispatched / elapsed))
+    if profile is not None:
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    main()
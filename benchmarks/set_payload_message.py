@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Compare the cost of putting an outbound message into a payload and encoding it, per message,
+with the string work redone for every message and with the per-class table.
+
+Usage: python benchmarks/set_payload_message.py [message count]
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from smarkets.streaming_api import seto  # noqa
+from smarkets.streaming_api.utils import set_payload_message  # noqa
+from smarkets.string import camel_case_to_underscores  # noqa
+
+
+def set_payload_message_uncached(payload, message):
+    "set_payload_message as it was before the per-class table"
+    underscore_form = camel_case_to_underscores(type(message).__name__)
+    payload_type = getattr(seto, 'PAYLOAD_' + underscore_form.upper())
+    payload.type = payload_type
+    getattr(payload, underscore_form).CopyFrom(message)
+
+
+def make_messages(count):
+    messages = []
+    for i in range(count):
+        if i % 2:
+            messages.append(seto.OrderCancel(order_id=i))
+        else:
+            messages.append(seto.OrderCreate(
+                side=seto.SIDE_BUY, quantity=10000 + i, price=2500, market_id=1, contract_id=2))
+    return messages
+
+
+def run(messages, set_message, serialize):
+    payload = seto.Payload()
+    started = time.time()
+    for seq, message in enumerate(messages, 1):
+        payload.Clear()
+        set_message(payload, message)
+        if serialize:
+            payload.eto_payload.seq = seq
+            payload.SerializeToString()
+    return time.time() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = make_messages(count)
+    for serialize in (False, True):
+        for name, set_message in (('uncached', set_payload_message_uncached),
+                                  ('table', set_payload_message)):
+            elapsed = min(run(messages, set_message, serialize) for _ in range(3))
+            print('%-8s serialize=%-5s  ns/msg: %7.0f' % (name, serialize, elapsed * 1e9 / count))
+
+
+if __name__ == '__main__':
+    main()
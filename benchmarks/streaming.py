@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""End-to-end streaming benchmarks: a Session and StreamingAPIClient reading quotes from a local
+StreamingServer over loopback, while timing order round trips.
+
+Every scenario runs the server in a separate process sending quotes at the given rate, with
+the given number of price levels per quote and burst size, to a client with the given number
+of quote handlers and read chunk size. Reported as JSON, one object per scenario:
+
+- messages_per_second, bytes_per_second: incoming payloads and bytes read by the client
+- allocations_per_message, allocated_bytes_per_message: memory blocks and bytes allocated
+  by the client for every message, measured in a separate, shorter run with tracemalloc.
+  Messages passed to the quote handlers are kept alive during that run so everything
+  allocated for them shows up, without handlers quotes are skipped unparsed
+- order_latency: percentiles, in microseconds, of the time from sending an order to its
+  order_accepted handler being called, orders are sent every --order-interval seconds
+- stage_latency: with --latency, the session's per payload type and stage latency
+  histograms (see smarkets.streaming_api.latency) summarised in seconds, timed from the
+  kernel receiving the data with --kernel-timestamps
+
+Usage: python benchmarks/streaming.py [--duration 2] [--quick] [--output results.json]
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import sys
+import time
+import tracemalloc
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import smarkets  # noqa
+from smarkets.streaming_api import seto  # noqa
+from smarkets.streaming_api.client import (  # noqa
+    READ_MODE_BUFFER_FROM_SOCKET, READ_MODE_DISPATCH_FROM_BUFFER, StreamingAPIClient,
+)
+from smarkets.streaming_api.latency import LatencyStats  # noqa
+from smarkets.streaming_api.server import StreamingServer  # noqa
+from smarkets.streaming_api.session import Session, SessionSettings  # noqa
+
+_monotonic = time.monotonic
+
+MARKET_ID = 1
+
+# (quote rate, quote depth, quote burst, handler count, read chunk size)
+SCENARIOS = list(itertools.product(
+    (20000, 100000),
+    (1, 10),
+    (1, 100),
+    (0, 1, 10),
+    (65536,),
+)) + [
+    (100000, 1, 1, 1, 4096),
+    (100000, 1, 1, 1, 16384),
+    (100000, 1, 1, 1, 262144),
+]
+
+QUICK_SCENARIOS = [
+    (20000, 1, 1, 1, 65536),
+    (100000, 10, 100, 1, 65536),
+]
+
+
+def serve(connection, quote_rate, quote_depth, quote_burst):
+    server = StreamingServer(quote_rate=quote_rate, quote_depth=quote_depth, quote_burst=quote_burst)
+    connection.send(server.address)
+    server.serve_forever()
+
+
+class Server(object):
+
+    "A StreamingServer running in another process"
+
+    def __init__(self, quote_rate, quote_depth, quote_burst):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve, args=(child, quote_rate, quote_depth, quote_burst))
+        self.process.daemon = True
+        self.process.start()
+        self.address = parent.recv()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    if not values:
+        return None
+    values = sorted(values)
+    result = dict(('p%s' % point, values[min(len(values) - 1, int(len(values) * point / 100))])
+                  for point in points)
+    result['max'] = values[-1]
+    result['count'] = len(values)
+    return result
+
+
+class BenchmarkClient(object):
+
+    def __init__(self, address, handler_count, read_chunksize, latency=False, kernel_timestamps=False):
+        host, port = address
+        settings = SessionSettings(
+            'username', 'password', host=host, port=port, ssl=False, kernel_timestamps=kernel_timestamps)
+        settings.read_chunksize = read_chunksize
+        self.client = StreamingAPIClient(Session(settings))
+        if latency:
+            self.client.session.latency = LatencyStats()
+        self.messages = 0
+        self.bytes = 0
+        self.order_sent_at = {}
+        self.order_latencies = []
+        self._references = itertools.count(1)
+        # Messages kept alive while measuring allocations
+        self._kept = None
+        for _ in range(handler_count):
+            self.client.add_handler('seto.contract_quotes', self._on_quotes)
+        self.client.add_handler('seto.order_accepted', self._on_order_accepted)
+
+    def _on_quotes(self, message):
+        if self._kept is not None:
+            self._kept.append(message)
+
+    def _on_order_accepted(self, message):
+        sent_at = self.order_sent_at.pop(message.order_accepted.reference, None)
+        if sent_at is not None:
+            self.order_latencies.append((_monotonic() - sent_at) * 1e6)
+
+    def login(self):
+        self.client.login()
+        self.client.send(seto.MarketSubscribe(market_id=MARKET_ID))
+        self.client.flush()
+
+    def send_order(self):
+        reference = next(self._references)
+        self.order_sent_at[reference] = _monotonic()
+        self.client.send(seto.OrderCreate(
+            side=seto.SIDE_BUY, quantity=10000, price=2500, market_id=MARKET_ID, contract_id=1,
+            reference=reference))
+        self.client.flush()
+
+    def read(self):
+        session = self.client.session
+        before = session.decoder.pending_bytes
+        self.client.read(READ_MODE_BUFFER_FROM_SOCKET)
+        self.bytes += session.decoder.pending_bytes - before
+        # Count every payload sequenced, quotes are skipped without being dispatched when
+        # there are no handlers for them
+        inseq = session.inseq
+        self.client.read(READ_MODE_DISPATCH_FROM_BUFFER)
+        self.messages += session.inseq - inseq
+
+    def run(self, duration, order_interval):
+        "Read for `duration` seconds, sending an order every `order_interval` seconds"
+        started = now = _monotonic()
+        next_order = started + order_interval
+        while now - started < duration:
+            if now >= next_order:
+                self.send_order()
+                next_order += order_interval
+            self.read()
+            now = _monotonic()
+        return now - started
+
+    def measure_allocations(self, message_count, timeout=10.0):
+        """
+        Count memory blocks and bytes allocated per message over the next `message_count`
+        messages, or as many as arrive in `timeout` seconds. None if none did.
+        """
+        kept = self._kept = []
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            messages = self.messages
+            deadline = _monotonic() + timeout
+            while self.messages - messages < message_count and _monotonic() < deadline:
+                self.read()
+            after = tracemalloc.take_snapshot()
+            read = self.messages - messages
+        finally:
+            tracemalloc.stop()
+            self._kept = None
+        if not read:
+            return None, None
+        stats = [stat for stat in after.compare_to(before, 'filename') if stat.count_diff > 0]
+        # The list holding the messages is not allocated by the client
+        blocks = sum(stat.count_diff for stat in stats) - 1
+        size = sum(stat.size_diff for stat in stats) - sys.getsizeof(kept)
+        return max(blocks, 0) / read, max(size, 0) / read
+
+
+def run_scenario(scenario, duration, order_interval, allocation_messages, latency=False,
+                 kernel_timestamps=False):
+    quote_rate, quote_depth, quote_burst, handler_count, read_chunksize = scenario
+    server = Server(quote_rate, quote_depth, quote_burst)
+    try:
+        bench = BenchmarkClient(server.address, handler_count, read_chunksize, latency, kernel_timestamps)
+        bench.login()
+        # Warm up
+        bench.run(min(duration, 0.5), order_interval)
+        bench.messages = bench.bytes = 0
+        del bench.order_latencies[:]
+        stats = bench.client.session.latency
+        if stats is not None:
+            stats.reset()
+        elapsed = bench.run(duration, order_interval)
+        messages, read_bytes = bench.messages, bench.bytes
+        stage_latency = stats.snapshot() if stats is not None else None
+        blocks, size = bench.measure_allocations(allocation_messages)
+        bench.client.logout(receive=False)
+    finally:
+        server.stop()
+    result = {
+        'quote_rate': quote_rate,
+        'quote_depth': quote_depth,
+        'quote_burst': quote_burst,
+        'handlers': handler_count,
+        'read_chunksize': read_chunksize,
+        'duration': elapsed,
+        'messages': messages,
+        'messages_per_second': messages / elapsed,
+        'bytes_per_second': read_bytes / elapsed,
+        'allocations_per_message': blocks,
+        'allocated_bytes_per_message': size,
+        'order_latency': percentiles(bench.order_latencies),
+    }
+    if stage_latency is not None:
+        result['stage_latency'] = stage_latency
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds measured per scenario')
+    parser.add_argument('--order-interval', type=float, default=0.005, help='seconds between orders')
+    parser.add_argument('--allocation-messages', type=int, default=2000,
+                        help='messages read with tracemalloc enabled per scenario')
+    parser.add_argument('--quick', action='store_true', help='run only a couple of scenarios')
+    parser.add_argument('--latency', action='store_true',
+                        help='time the stages of every incoming payload, see stage_latency')
+    parser.add_argument('--kernel-timestamps', action='store_true',
+                        help='time payloads from the kernel receiving them (Linux only)')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for scenario in QUICK_SCENARIOS if args.quick else SCENARIOS:
+        result = run_scenario(
+            scenario, args.duration, args.order_interval, args.allocation_messages, args.latency,
+            args.kernel_timestamps)
+        print('rate=%(quote_rate)d depth=%(quote_depth)d burst=%(quote_burst)d handlers=%(handlers)d '
+              'chunk=%(read_chunksize)d: %(messages_per_second).0f msgs/s' % result, file=sys.stderr)
+        results.append(result)
+    report = {
+        'sdk_version': smarkets.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenarios': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
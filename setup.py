@@ -167,6 +167,7 @@ sdict = {
         'iso8601',
         'protobuf',
         'pytz',
+        'selectors34; python_version < "3.4"',
         'six',
     ],
     'zip_safe': False,
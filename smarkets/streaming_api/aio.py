@@ -0,0 +1,338 @@
+"asyncio-based Smarkets streaming API session and client"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+import asyncio
+import logging
+import socket
+import ssl
+import sys
+
+from smarkets import private
+from smarkets.streaming_api.client import (
+    READ_MODE_BUFFER_AND_DISPATCH, READ_MODE_BUFFER_FROM_SOCKET, READ_MODE_DISPATCH_FROM_BUFFER,
+    StreamingAPIClient,
+)
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.session import _monotonic, Session
+
+__all__ = ('AsyncSession', 'AsyncStreamingAPIClient')
+
+# Only called from coroutines, get_event_loop() returns the running loop there before 3.7
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+_PROTOCOL_TLS_CLIENT = getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23)
+
+
+def _ssl_context(ssl_kwargs):
+    "Build an SSL context out of :func:`ssl.wrap_socket` keyword arguments"
+    context = ssl.SSLContext(ssl_kwargs.get('ssl_version', _PROTOCOL_TLS_CLIENT))
+    context.check_hostname = False
+    context.verify_mode = ssl_kwargs.get('cert_reqs', ssl.CERT_NONE)
+    if ssl_kwargs.get('ca_certs'):
+        context.load_verify_locations(ssl_kwargs['ca_certs'])
+    if ssl_kwargs.get('certfile'):
+        context.load_cert_chain(ssl_kwargs['certfile'], ssl_kwargs.get('keyfile'))
+    if ssl_kwargs.get('ciphers'):
+        context.set_ciphers(ssl_kwargs['ciphers'])
+    return context
+
+
+class _SessionProtocol(getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)):
+
+    "Receives data straight into the session decoder buffer"
+
+    def __init__(self, session):
+        self._session = session
+        self._decoder = session.decoder
+        self._chunksize = session.settings.read_chunksize
+        self.data_received_event = asyncio.Event()
+        self.connection_lost_exception = None
+        self._paused = False
+        self._drain_waiters = []
+
+    def get_buffer(self, sizehint):
+        return self._decoder.reserve(max(sizehint, self._chunksize))
+
+    def buffer_updated(self, nbytes):
+        self._decoder.commit(nbytes)
+        self._session.check_inbound()
+        self.data_received_event.set()
+
+    def data_received(self, data):
+        # Used instead of get_buffer/buffer_updated when BufferedProtocol is not available
+        self._decoder.feed(data)
+        self._session.check_inbound()
+        self.data_received_event.set()
+
+    def eof_received(self):
+        # Close the transport
+        return False
+
+    def connection_lost(self, exc):
+        self.connection_lost_exception = SocketDisconnected(
+            'Socket disconnected while receiving, %r' % (exc,))
+        self.data_received_event.set()
+        self._paused = False
+        self._wake_drain_waiters()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain_waiters()
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain(self):
+        "Wait until the transport write buffer goes below its high-water mark"
+        if self.connection_lost_exception is not None:
+            raise self.connection_lost_exception
+        if self._paused:
+            waiter = _get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+
+class AsyncSession(Session):
+
+    """
+    :class:`smarkets.streaming_api.session.Session` running on an asyncio event loop.
+
+    Framing, sequencing and payload handling are shared with :class:`Session`; :meth:`connect`,
+    :meth:`logout`, :meth:`flush` and :meth:`read` are coroutines instead of blocking calls.
+    Heartbeats are answered as soon as they are read, without waiting for :meth:`flush`.
+    """
+
+    logger = private(logging.getLogger('smarkets.session.aio'))
+
+    def __init__(self, settings, inseq=1, outseq=1, account_sequence=None):
+        super(AsyncSession, self).__init__(
+            settings, inseq=inseq, outseq=outseq, account_sequence=account_sequence)
+        self._transport = None
+        self._protocol = None
+        # The transport does its own buffering
+        self._vectored = False
+
+    @property
+    def raw_socket(self):
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info('socket')
+
+    @property
+    def connected(self):
+        "Returns True if the transport is currently connected"
+        return self._transport is not None and self._protocol.connection_lost_exception is None
+
+    async def connect(self):
+        """
+        Connect to the API and log in if not already connected.
+
+        :return: True if a new connection was made, False if already connected
+        """
+        if self.connected:
+            self.logger.debug("connect() called, but already connected")
+            return False
+        if self._transport is not None:
+            self._transport.close()
+        settings = self.settings
+        loop = _get_running_loop()
+        self.logger.info("connecting with new transport to %s:%s", settings.host, settings.port)
+        try:
+            self._transport, self._protocol = await asyncio.wait_for(
+                loop.create_connection(
+                    lambda: _SessionProtocol(self), settings.host, settings.port,
+                    ssl=_ssl_context(settings.ssl_kwargs) if settings.ssl else None),
+                settings.socket_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError('Error connecting to %s:%s. %r.' % (settings.host, settings.port, e))
+        if settings.tcp_nodelay:
+            self.raw_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_login()
+        await self.flush()
+        return True
+
+    async def logout(self):
+        "Send the logout payload"
+        self._send_logout()
+        await self.flush()
+
+    def disconnect(self):
+        "Close the transport"
+        if self._transport is not None:
+            self.logger.info("closing transport")
+            self._transport.close()
+            self._transport = None
+        self._reset_connection_state()
+
+    def _pause_reading(self):
+        if self._transport is not None:
+            self._transport.pause_reading()
+
+    def _resume_reading(self):
+        if self._transport is not None:
+            self._transport.resume_reading()
+
+    def _write(self):
+        "Hand the send buffer over to the transport"
+        if not self.send_buffer:
+            return
+        if self._transport is None:
+            raise SocketDisconnected('Trying to write to transport when disconnected')
+        self.flush_logger.debug("Flushing %d bytes", len(self.send_buffer))
+        # The transport may keep a reference to the buffer so it's not reused
+        data, self.send_buffer = self.send_buffer, bytearray()
+        if self._send_offset:
+            data = memoryview(data)[self._send_offset:]
+            self._send_offset = 0
+        self._unflushed_since = None
+        self._transport.write(data)
+        self.flush_stats.flushes += 1
+        self.flush_stats.bytes += len(data)
+        self.last_sent_at = _monotonic()
+        self.heartbeat_pending = False
+
+    async def flush(self):
+        "Flush payloads to the transport, waiting if it's applying backpressure"
+        self._write()
+        await self.drain()
+
+    async def drain(self):
+        "Wait until the transport is ready to accept more data"
+        if self._protocol is not None:
+            await self._protocol.drain()
+
+    async def read(self):
+        """
+        Wait until more data is received.
+
+        While the session is overloaded the transport stops reading and this returns straight
+        away, handle the buffered frames for reading to resume.
+
+        :raises SocketDisconnected: when the connection was lost and every frame received
+            before that was handled
+        """
+        protocol = self._protocol
+        if protocol is None:
+            raise SocketDisconnected('Trying to read from a transport when disconnected')
+        self._flush_before_read()
+        if self.overloaded and self.check_inbound():
+            return
+        event = protocol.data_received_event
+        if not event.is_set() and protocol.connection_lost_exception is None:
+            await event.wait()
+        event.clear()
+        self._timestamp_read()
+        # Frames received before the connection was lost are handed out first
+        if protocol.connection_lost_exception is not None and not self.buffered_frames:
+            raise protocol.connection_lost_exception
+
+    def _send_heartbeat(self):
+        super(AsyncSession, self)._send_heartbeat()
+        if self._transport is not None:
+            self._write()
+
+
+class AsyncStreamingAPIClient(StreamingAPIClient):
+
+    """
+    :class:`smarkets.streaming_api.client.StreamingAPIClient` working with an
+    :class:`AsyncSession`.
+
+    Handlers are registered and called the same way, :meth:`login`, :meth:`logout`,
+    :meth:`read`, :meth:`flush`, :meth:`send` and :meth:`ping` are coroutines. Iterating the
+    client with ``async for`` dispatches incoming frames and yields them, payloads nothing
+    handles are skipped like :meth:`read` does::
+
+        async for frame in client:
+            print(frame.protobuf)
+    """
+
+    async def login(self, receive=True):
+        "Connect and ensure the session is active"
+        await self.session.connect()
+        if receive:
+            await self.read()
+            self.check_login()
+            await self.flush()
+
+    async def logout(self, receive=True):
+        "Send logout message, optionally waiting for confirmation, and disconnect"
+        self.last_login = None
+        await self.session.logout()
+        if receive:
+            await self.read()
+            await self.flush()
+        self.session.disconnect()
+
+    async def read(self, read_mode=READ_MODE_BUFFER_AND_DISPATCH, limit=sys.maxsize):
+        """
+        Wait for data and dispatch buffered frames.
+
+        :return: Number of processed incoming messages.
+        :rtype: int
+        """
+        if read_mode & READ_MODE_BUFFER_FROM_SOCKET:
+            await self.session.read()
+        if read_mode & READ_MODE_DISPATCH_FROM_BUFFER:
+            return self._dispatch_buffered(limit)
+        return 0
+
+    async def flush(self):
+        "Flush the send buffer"
+        await self.session.flush()
+
+    async def send(self, message):
+        "Buffer a message, waiting first if the transport is applying backpressure"
+        await self.session.drain()
+        super(AsyncStreamingAPIClient, self).send(message)
+
+    async def send_many(self, messages):
+        "Buffer a batch of messages and flush them, waiting while the transport applies backpressure"
+        await self.session.drain()
+        count = self.session.send_many(messages)
+        await self.flush()
+        return count
+
+    async def send_template(self, template, *values):
+        "Buffer a templated payload, waiting first if the transport is applying backpressure"
+        await self.session.drain()
+        super(AsyncStreamingAPIClient, self).send_template(template, *values)
+
+    async def ping(self):
+        "Ping the service"
+        super(AsyncStreamingAPIClient, self).ping()
+
+    def __aiter__(self):
+        return _DispatchingIterator(self)
+
+
+class _DispatchingIterator(object):
+
+    "Dispatches buffered frames one at a time, reading more when they run out"
+
+    # A class rather than an async generator, those need Python 3.6
+
+    def __init__(self, client):
+        self._client = client
+        self._frames = client.session.next_frames(wanted=client._wants_payload)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        session = self._client.session
+        while True:
+            for frame in self._frames:
+                name = self._client._dispatch(frame)
+                if session.latency is not None:
+                    session.frame_dispatched(name)
+                return frame
+            await session.read()
+            self._frames = session.next_frames(wanted=self._client._wants_payload)
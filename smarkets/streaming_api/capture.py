@@ -0,0 +1,199 @@
+"Recording the payloads a session receives and sends"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import mmap
+import struct
+from collections import namedtuple
+
+from smarkets.streaming_api.exceptions import ParseError
+
+__all__ = (
+    'CaptureRecord', 'CaptureRecorder', 'DIRECTION_IN', 'DIRECTION_OUT', 'iter_records', 'read_capture',
+    'read_capture_index',
+)
+
+DIRECTION_IN = 1
+DIRECTION_OUT = 2
+
+# Written at the start of every capture file
+CAPTURE_MAGIC = b'SMKCAP01'
+
+# Direction, monotonic timestamp, sequence number and payload size, followed by the payload
+_RECORD_HEADER = struct.Struct('<BdQI')
+_RECORD_HEADER_SIZE = _RECORD_HEADER.size
+# Direction, sequence number and offset of the record in the capture file
+_INDEX_ENTRY = struct.Struct('<BQQ')
+# Index entries are buffered in memory and written out in batches of this many bytes
+_INDEX_BATCH_SIZE = 65536
+
+
+class CaptureRecord(namedtuple('CaptureRecord', 'direction timestamp seq payload')):
+
+    """
+    A recorded payload.
+
+    `timestamp` is the :func:`time.monotonic` time the payload was received at, or buffered
+    to be sent at, and `seq` its eto sequence number.
+    """
+
+
+class CaptureRecorder(object):
+
+    """
+    Appends the payloads of a session to a binary capture file.
+
+    Every record is a fixed size header (direction, timestamp, sequence number and payload
+    size, little endian) followed by the serialised seto payload. A sidecar index file, the
+    capture path with ``.idx`` appended, maps directions and sequence numbers to record offsets,
+    see :func:`read_capture_index`.
+
+    Records are written through a buffered file object and index entries are batched in
+    memory, so recording a payload costs two buffered writes. Call :meth:`flush` or
+    :meth:`close` to get everything on disk. Attach a recorder to a session with::
+
+        session.recorder = CaptureRecorder('market.cap')
+    """
+
+    def __init__(self, path, index_path=None):
+        """
+        :param path: Capture file, appended to if it exists
+        :param index_path: Index file, `path` with ``.idx`` appended by default
+        """
+        self.path = path
+        self.index_path = index_path if index_path is not None else path + '.idx'
+        self._file = open(path, 'ab')
+        self._index = open(self.index_path, 'ab')
+        if not self._file.tell():
+            self._file.write(CAPTURE_MAGIC)
+        self._offset = self._file.tell()
+        self._index_buffer = bytearray()
+        self.records = 0
+
+    def record(self, direction, seq, payload, timestamp):
+        """
+        Append a payload to the capture.
+
+        :type direction: :data:`DIRECTION_IN` or :data:`DIRECTION_OUT`
+        :param seq: Eto sequence number of the payload
+        :param payload: Serialised seto payload
+        :type payload: bytes-like object
+        :type timestamp: float
+        """
+        size = len(payload)
+        offset = self._offset
+        write = self._file.write
+        write(_RECORD_HEADER.pack(direction, timestamp, seq, size))
+        write(payload)
+        index_buffer = self._index_buffer
+        index_buffer += _INDEX_ENTRY.pack(direction, seq, offset)
+        if len(index_buffer) >= _INDEX_BATCH_SIZE:
+            self._write_index()
+        self._offset = offset + _RECORD_HEADER_SIZE + size
+        self.records += 1
+
+    def _write_index(self):
+        self._index.write(self._index_buffer)
+        del self._index_buffer[:]
+
+    def flush(self):
+        "Write buffered records and index entries to the files"
+        self._write_index()
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        "Flush and close the files"
+        self._write_index()
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_capture(path):
+    """
+    Iterate over the records of a capture file.
+
+    The file is memory mapped and record payloads are copied out of it one at a time.
+
+    :rtype: iterator of :class:`CaptureRecord`
+    :raises ParseError: if the file is not a capture file or is truncated
+    """
+    with open(path, 'rb') as f:
+        if not _file_size(f):
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for record in iter_records(data):
+            yield record
+    finally:
+        data.close()
+
+
+def read_capture_index(index_path):
+    """
+    Read the sidecar index of a capture file.
+
+    Sequence numbers start again on every reconnect, so the records are split into sessions,
+    numbered from 0 in file order. A new session starts at every record whose sequence number
+    isn't above the last one recorded in the same direction.
+
+    :return: Record offsets keyed by (session, direction, sequence number)
+    :rtype: dict
+    """
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    entry_size = _INDEX_ENTRY.size
+    unpack_from = _INDEX_ENTRY.unpack_from
+    index = {}
+    session = 0
+    last_seqs = {}
+    for position in range(0, len(data) - entry_size + 1, entry_size):
+        direction, seq, offset = unpack_from(data, position)
+        last_seq = last_seqs.get(direction)
+        if last_seq is not None and seq <= last_seq:
+            session += 1
+            last_seqs.clear()
+        last_seqs[direction] = seq
+        index[(session, direction, seq)] = offset
+    return index
+
+
+def iter_records(data):
+    """
+    Iterate over the records of a capture held in memory.
+
+    Payloads are slices of `data`, so they're views into it if `data` is a :class:`memoryview`.
+
+    :type data: bytes-like object
+    :rtype: iterator of :class:`CaptureRecord`
+    :raises ParseError: if `data` is not a capture or is truncated
+    """
+    if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ParseError('Not a capture file')
+    unpack_from = _RECORD_HEADER.unpack_from
+    header_size = _RECORD_HEADER.size
+    position = len(CAPTURE_MAGIC)
+    end = len(data)
+    while position < end:
+        if end - position < header_size:
+            raise ParseError('Truncated record header at offset %d' % position)
+        direction, timestamp, seq, size = unpack_from(data, position)
+        position += header_size
+        if end - position < size:
+            raise ParseError('Truncated payload at offset %d' % position)
+        yield CaptureRecord(direction, timestamp, seq, data[position:position + size])
+        position += size
+
+
+def _file_size(f):
+    f.seek(0, 2)
+    return f.tell()
@@ -10,6 +10,7 @@ from smarkets.signal import Signal
 from smarkets.streaming_api import eto
 from smarkets.streaming_api import seto
 from smarkets.streaming_api.exceptions import InvalidCallbackError, LoginError, LoginTimeout
+from smarkets.streaming_api.templates import PING_TEMPLATE
 from smarkets.streaming_api.utils import set_payload_message
 
 
@@ -26,6 +27,12 @@ def _get_payload_types(module):
 _ETO_PAYLOAD_TYPES = _get_payload_types(eto)
 _SETO_PAYLOAD_TYPES = _get_payload_types(seto)
 
+# The client itself needs these to keep track of the login state
+_ALWAYS_DISPATCHED_PAYLOADS = frozenset((
+    (seto.PAYLOAD_ETO, eto.PAYLOAD_LOGIN_RESPONSE),
+    (seto.PAYLOAD_ETO, eto.PAYLOAD_LOGOUT),
+))
+
 
 READ_MODE_BUFFER_FROM_SOCKET = 1
 READ_MODE_DISPATCH_FROM_BUFFER = 2
@@ -49,6 +56,7 @@ class StreamingAPIClient(object):
                               for callback_name in self.__class__.CALLBACKS)
         self.global_callback = Signal()
         self.last_login = None
+        self._build_dispatch_table()
 
     def login(self, receive=True):
         "Connect and ensure the session is active"
@@ -115,16 +123,24 @@ class StreamingAPIClient(object):
         if read_mode & READ_MODE_BUFFER_FROM_SOCKET:
             self.session.read()
 
-        processed = 0
         if read_mode & READ_MODE_DISPATCH_FROM_BUFFER:
-            while processed < limit:
-                frame = self.session.next_frame()
-                if frame:
-                    self._dispatch(frame)
-                    processed += 1
-                else:
-                    break
+            return self._dispatch_buffered(limit)
+        return 0
 
+    def _dispatch_buffered(self, limit):
+        "Dispatch up to `limit` frames which are already buffered in the session"
+        processed = 0
+        dispatch = self._dispatch
+        session = self.session
+        if session.latency is None:
+            for frame in session.next_frames(limit, self._wants_payload):
+                dispatch(frame)
+                processed += 1
+        else:
+            frame_dispatched = session.frame_dispatched
+            for frame in session.next_frames(limit, self._wants_payload):
+                frame_dispatched(dispatch(frame))
+                processed += 1
         return processed
 
     def flush(self):
@@ -137,13 +153,28 @@ class StreamingAPIClient(object):
         set_payload_message(payload, message)
         self._send()
 
+    def send_many(self, messages):
+        """
+        Send a batch of messages, for example order creates or cancels, and flush them together.
+
+        :return: Number of sent messages
+        :rtype: int
+        """
+        count = self.session.send_many(messages)
+        self.flush()
+        return count
+
+    def send_template(self, template, *values):
+        """
+        Send a payload serialised from a template with the given field values.
+
+        :type template: :class:`smarkets.streaming_api.templates.PayloadTemplate`
+        """
+        self.session.send_template(template, *values)
+
     def ping(self):
         "Ping the service"
-        msg = self.session.out_payload
-        msg.Clear()
-        msg.type = seto.PAYLOAD_ETO
-        msg.eto_payload.type = eto.PAYLOAD_PING
-        self._send()
+        self.session.send_template(PING_TEMPLATE)
 
     def add_handler(self, name, callback):
         "Add a callback handler"
@@ -169,34 +200,76 @@ class StreamingAPIClient(object):
         "Remove a global callback handler"
         self.global_callback -= callback
 
+    def _build_dispatch_table(self):
+        """
+        Map (seto payload type, eto payload type) to the payload name and its :attr:`callbacks` signal.
+
+        Only eto payloads are keyed by their eto payload type, for other payloads it's None.
+        The signals themselves are kept, so handlers added to them directly are called too.
+        """
+        table = {}
+        for seto_type, name in _SETO_PAYLOAD_TYPES.items():
+            if seto_type != seto.PAYLOAD_ETO:
+                table[(seto_type, None)] = (name, self.callbacks[name])
+        for eto_type, name in _ETO_PAYLOAD_TYPES.items():
+            table[(seto.PAYLOAD_ETO, eto_type)] = (name, self.callbacks[name])
+        self._dispatch_table = table
+        # Payloads parsed whether they have handlers or not
+        self._wanted_payloads = _ALWAYS_DISPATCHED_PAYLOADS
+
+    def _logged_out(self):
+        "Disconnect once a logout payload is dispatched"
+        self.session.disconnect()
+
     def _send(self):
         """
         Send a payload via the session.
         """
         self.session.send()
 
+    def _wants_payload(self, seto_type, eto_type):
+        "Check if a payload of the given type needs to be parsed and dispatched"
+        if self.global_callback:
+            return True
+        if seto_type != seto.PAYLOAD_ETO:
+            eto_type = None
+        key = (seto_type, eto_type)
+        if key in self._wanted_payloads:
+            return True
+        slot = self._dispatch_table.get(key)
+        return slot is not None and bool(slot[1])
+
     def _dispatch(self, frame):
-        "Dispatch a frame to the callbacks"
+        """
+        Dispatch a frame to the callbacks.
+
+        :return: Name of the payload type, 'eto.unknown' for unknown eto payloads
+        """
         message = frame.protobuf
-        name = _SETO_PAYLOAD_TYPES.get(message.type, 'seto.unknown')
-        if name == 'seto.eto':
-            name = _ETO_PAYLOAD_TYPES.get(message.eto_payload.type)
+        seto_type = message.type
+        if seto_type == seto.PAYLOAD_ETO:
+            eto_type = message.eto_payload.type
 
             # handle login and logout messages
-            if message.eto_payload.type in [eto.PAYLOAD_LOGIN_RESPONSE, eto.PAYLOAD_LOGOUT]:
-                self.last_login = message
-                if message.eto_payload.type == eto.PAYLOAD_LOGOUT:
-                    self.session.disconnect()
-
-        if name in self.callbacks:
-            self.logger.debug("dispatching callback %s", name)
-            callback = self.callbacks.get(name)
-            if callback is not None:
-                callback(message=message)
-            else:
-                self.logger.error("no callback %s", name)
+            if eto_type == eto.PAYLOAD_LOGIN_RESPONSE or eto_type == eto.PAYLOAD_LOGOUT:
+                # The message may be borrowed from the session, keep a copy
+                self.last_login = seto.Payload()
+                self.last_login.CopyFrom(message)
+                if eto_type == eto.PAYLOAD_LOGOUT:
+                    self._logged_out()
         else:
-            self.logger.debug("ignoring unknown message: %s", name)
+            eto_type = None
 
-        self.logger.debug('Dispatching global callbacks for %s', name)
-        self.global_callback(name=name, message=frame)
+        slot = self._dispatch_table.get((seto_type, eto_type))
+        if slot is None:
+            name = 'seto.unknown' if eto_type is None else None
+            self.logger.debug("ignoring unknown message: %s", name)
+        else:
+            name, handlers = slot
+            # Firing copies the handlers, don't bother when there are none
+            if handlers:
+                handlers(message=message)
+
+        if self.global_callback:
+            self.global_callback(name=name, message=frame)
+        return name or 'eto.unknown'
@@ -0,0 +1,514 @@
+"Fanning incoming payloads out to worker processes through a shared memory ring"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import logging
+import multiprocessing
+import platform
+import struct
+import time
+from collections import namedtuple
+
+from smarkets import private
+from smarkets.streaming_api import seto
+from smarkets.streaming_api.client import _ETO_PAYLOAD_TYPES, _SETO_PAYLOAD_TYPES, StreamingAPIClient
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+__all__ = ('ConsumerStats', 'FanOutStreamingAPIClient', 'RingReader', 'SharedFrameRing')
+
+_MAGIC = b'SMKRING1'
+# Magic, slot count, slot size, consumer count, closed flag, write position, published frames
+_HEADER = struct.Struct('<8sIIIIQQ')
+_CLOSED_OFFSET = 20
+_WRITE_POSITION_OFFSET = 24
+_PUBLISHED_OFFSET = 32
+_CONSUMERS_OFFSET = 64
+# Position, frames read, frames lost and handler errors of every consumer
+_CONSUMER = struct.Struct('<QQQQ')
+# Stamp, payload size, seto payload type and eto payload type, the stamp is the position of
+# the slot plus one once its data is complete and 0 while it's being written
+_SLOT = struct.Struct('<QIHH')
+_STAMP = struct.Struct('<Q')
+_POSITION = struct.Struct('<Q')
+# Write position and published frames, next to each other
+_PROGRESS = struct.Struct('<QQ')
+# platform.machine() of CPUs whose stores become visible to other CPUs in program order
+_ORDERED_STORE_MACHINES = frozenset(['x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86'])
+
+ConsumerStats = namedtuple('ConsumerStats', 'index frames lag lost errors')
+ConsumerStats.__doc__ = """
+Progress of a ring consumer.
+
+`frames` were read, `lag` more were published and not read yet, `lost` were overwritten
+before being read and handlers failed `errors` times.
+"""
+
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def _ordered_stores():
+    "True if the CPU makes stores visible to other CPUs in the order they were made"
+    return platform.machine().lower() in _ORDERED_STORE_MACHINES
+
+
+def _check_available():
+    if shared_memory is None:
+        raise RuntimeError('shared memory rings need Python 3.8 or newer')
+    if not _ordered_stores():
+        raise RuntimeError('shared memory rings need an x86 CPU, not %s' % (platform.machine(),))
+
+
+class SharedFrameRing(object):
+
+    """
+    Ring of sequence-stamped slots in shared memory, written by one process and read by
+    several.
+
+    Every slot has a 16 byte header: a stamp, the payload size and the seto and eto payload
+    types, so readers can filter payloads without parsing them. Payloads larger than a slot
+    continue in the slots after it. The writer never waits for readers: readers which fall
+    more than a ring behind lose the frames which were overwritten, and :class:`RingReader`
+    notices from the stamps and counts them.
+
+    Readers rely on the stores of the writer becoming visible in the order they were made,
+    which holds on x86. Python has no memory barriers to enforce it on other CPUs, so rings
+    can't be created or attached to there.
+    """
+
+    def __init__(self, memory, owner=False):
+        magic, slot_count, slot_size, consumer_count, _, _, _ = _HEADER.unpack_from(memory.buf, 0)
+        if magic != _MAGIC:
+            raise ValueError('%s is not a frame ring' % (memory.name,))
+        self.memory = memory
+        self.buffer = memory.buf
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.consumer_count = consumer_count
+        self.owner = owner
+        self._slots_offset = _round_up(_CONSUMERS_OFFSET + consumer_count * _CONSUMER.size, 64)
+        self._data_size = slot_size - _SLOT.size
+        self._write_position = self.write_position
+        self._published = self.published
+
+    @classmethod
+    def create(cls, slot_count, slot_size, consumer_count, name=None):
+        """
+        Create a ring, it's removed when the creator closes it.
+
+        :param slot_count: Number of slots
+        :param slot_size: Size of every slot in bytes, header included
+        :param consumer_count: Number of readers whose progress is tracked
+        :raises RuntimeError: if shared memory isn't available or the CPU isn't x86
+        """
+        _check_available()
+        if slot_count <= 0 or consumer_count <= 0:
+            raise ValueError('slot_count and consumer_count need to be positive')
+        if slot_size <= _SLOT.size or slot_size % 8:
+            raise ValueError('slot_size needs to be a multiple of 8 larger than %d, got %r' % (
+                _SLOT.size, slot_size))
+        slots_offset = _round_up(_CONSUMERS_OFFSET + consumer_count * _CONSUMER.size, 64)
+        memory = shared_memory.SharedMemory(
+            name=name, create=True, size=slots_offset + slot_count * slot_size)
+        memory.buf[:slots_offset] = bytes(slots_offset)
+        _HEADER.pack_into(memory.buf, 0, _MAGIC, slot_count, slot_size, consumer_count, 0, 0, 0)
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        "Attach to a ring created by another process"
+        _check_available()
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def write_position(self):
+        "Number of slots written so far"
+        return _POSITION.unpack_from(self.buffer, _WRITE_POSITION_OFFSET)[0]
+
+    @property
+    def published(self):
+        "Number of frames written so far"
+        return _POSITION.unpack_from(self.buffer, _PUBLISHED_OFFSET)[0]
+
+    @property
+    def closed(self):
+        "Set by the writer when no more frames will be written"
+        return bool(struct.unpack_from('<I', self.buffer, _CLOSED_OFFSET)[0])
+
+    def publish(self, seto_type, eto_type, data):
+        """
+        Write a payload to the next slots.
+
+        :param data: Serialized seto.Payload
+        :type data: bytes-like object
+        :raises ValueError: if the payload doesn't fit in the ring
+        """
+        buffer = self.buffer
+        size = len(data)
+        data_size = self._data_size
+        slot_count = self.slot_count
+        slot_size = self.slot_size
+        position = self._write_position
+        offset = self._slots_offset + (position % slot_count) * slot_size
+        if size <= data_size:
+            _SLOT.pack_into(buffer, offset, 0, size, seto_type, eto_type)
+            buffer[offset + _SLOT.size:offset + _SLOT.size + size] = data
+            _STAMP.pack_into(buffer, offset, position + 1)
+            position += 1
+        else:
+            slots = -(-size // data_size)
+            if slots > slot_count:
+                raise ValueError('%d byte payload does not fit in the ring' % (size,))
+            data = memoryview(data)
+            offsets = [self._slots_offset + ((position + index) % slot_count) * slot_size
+                       for index in range(slots)]
+            for offset in offsets:
+                _STAMP.pack_into(buffer, offset, 0)
+            for index, offset in enumerate(offsets):
+                chunk = data[index * data_size:(index + 1) * data_size]
+                buffer[offset + _SLOT.size:offset + _SLOT.size + len(chunk)] = chunk
+            _SLOT.pack_into(buffer, offsets[0], 0, size, seto_type, eto_type)
+            for index, offset in enumerate(offsets):
+                _STAMP.pack_into(buffer, offset, position + index + 1)
+            position += slots
+        self._write_position = position
+        self._published += 1
+        _PROGRESS.pack_into(buffer, _WRITE_POSITION_OFFSET, position, self._published)
+
+    def consumer_stats(self):
+        "Progress of every consumer, see :class:`ConsumerStats`"
+        published = self.published
+        stats = []
+        for index in range(self.consumer_count):
+            _, frames, lost, errors = _CONSUMER.unpack_from(
+                self.buffer, _CONSUMERS_OFFSET + index * _CONSUMER.size)
+            stats.append(ConsumerStats(index, frames, max(0, published - frames - lost), lost, errors))
+        return stats
+
+    def reader(self, index, wanted=None):
+        "Read the ring as consumer `index`, see :class:`RingReader`"
+        return RingReader(self, index, wanted)
+
+    def close_writing(self):
+        "Tell the readers no more frames will be written"
+        struct.pack_into('<I', self.buffer, _CLOSED_OFFSET, 1)
+
+    def close(self):
+        "Detach from the ring and remove it if this process created it"
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class RingReader(object):
+
+    """
+    Reads the frames of a :class:`SharedFrameRing` in order, as one of its consumers.
+
+    Frames for which `wanted(seto_type, eto_type)` returns False are skipped without being
+    copied. Progress is written to the ring header after every :meth:`read`, for the writer
+    to see in :meth:`SharedFrameRing.consumer_stats`. When the writer laps the reader, the
+    reader skips to the newest frame and counts the ones in between as lost.
+    """
+
+    def __init__(self, ring, index, wanted=None):
+        if not 0 <= index < ring.consumer_count:
+            raise ValueError('ring has no consumer %r' % (index,))
+        self.ring = ring
+        self.index = index
+        self.wanted = wanted
+        self._offset = _CONSUMERS_OFFSET + index * _CONSUMER.size
+        self.position, self.frames, self.lost, self.errors = _CONSUMER.unpack_from(
+            ring.buffer, self._offset)
+
+    def read(self, max_count=1024):
+        """
+        Read the frames published since the last read.
+
+        :return: seto payload type, eto payload type and payload bytes of up to `max_count`
+            wanted frames
+        :rtype: list of tuples
+        """
+        ring = self.ring
+        buffer = ring.buffer
+        wanted = self.wanted
+        slot_count = ring.slot_count
+        slot_size = ring.slot_size
+        slots_offset = ring._slots_offset
+        data_size = ring._data_size
+        header_size = _SLOT.size
+        unpack_slot = _SLOT.unpack_from
+        unpack_stamp = _STAMP.unpack_from
+        write_position = ring.write_position
+        position = self.position
+        frames = []
+        while position < write_position and len(frames) < max_count:
+            offset = slots_offset + (position % slot_count) * slot_size
+            stamp, size, seto_type, eto_type = unpack_slot(buffer, offset)
+            slots = -(-size // data_size) if size > data_size else 1
+            if stamp != position + 1 or write_position - position > slot_count or slots > slot_count:
+                position, write_position = self._skip_lost()
+                continue
+            if wanted is None or wanted(seto_type, eto_type):
+                if slots == 1:
+                    data = bytes(buffer[offset + header_size:offset + header_size + size])
+                else:
+                    chunks = []
+                    for index in range(slots):
+                        chunk_offset = slots_offset + ((position + index) % slot_count) * slot_size
+                        chunk_size = min(data_size, size - index * data_size)
+                        chunk_offset += header_size
+                        chunks.append(buffer[chunk_offset:chunk_offset + chunk_size])
+                    data = b''.join(chunks)
+                # The writer may have overwritten the slots while they were copied
+                last_offset = slots_offset + ((position + slots - 1) % slot_count) * slot_size
+                if (unpack_stamp(buffer, offset)[0] != position + 1 or
+                        unpack_stamp(buffer, last_offset)[0] != position + slots):
+                    position, write_position = self._skip_lost()
+                    continue
+                frames.append((seto_type, eto_type, data))
+            position += slots
+            self.frames += 1
+        self.position = position
+        self.save()
+        return frames
+
+    def _skip_lost(self):
+        "Skip to the newest frame after being lapped, counting the skipped frames as lost"
+        ring = self.ring
+        write_position, published = _PROGRESS.unpack_from(ring.buffer, _WRITE_POSITION_OFFSET)
+        # Both are written at once but not atomically, a frame may be counted too few or too many
+        self.lost += max(0, published - self.frames - self.lost)
+        self.position = write_position
+        return write_position, ring.write_position
+
+    def save(self):
+        "Write the progress of this consumer to the ring header"
+        _CONSUMER.pack_into(
+            self.ring.buffer, self._offset, self.position, self.frames, self.lost, self.errors)
+
+    @property
+    def lag(self):
+        "Number of frames published and not read yet"
+        return max(0, self.ring.published - self.frames - self.lost)
+
+
+def _payload_types(names):
+    "(seto type, eto type) of every payload type name, eto type None for seto payloads"
+    seto_types = dict((name, seto_type) for seto_type, name in _SETO_PAYLOAD_TYPES.items())
+    eto_types = dict((name, eto_type) for eto_type, name in _ETO_PAYLOAD_TYPES.items())
+    types = set()
+    for name in names:
+        if name in eto_types:
+            types.add((seto.PAYLOAD_ETO, eto_types[name]))
+        elif name in seto_types and seto_types[name] != seto.PAYLOAD_ETO:
+            types.add((seto_types[name], None))
+        else:
+            raise ValueError('Unknown payload type %r' % (name,))
+    return frozenset(types)
+
+
+def _market_fields():
+    "seto payload type -> name of the payload field holding a message with a market_id"
+    fields = {}
+    payload_fields = seto.Payload.DESCRIPTOR.fields_by_name
+    for seto_type, name in _SETO_PAYLOAD_TYPES.items():
+        field = payload_fields.get(name.split('.', 1)[1])
+        if field is not None and field.message_type is not None and \
+                'market_id' in field.message_type.fields_by_name:
+            fields[seto_type] = field.name
+    return fields
+
+
+class _WorkerFilter(object):
+
+    "Payload type and market filter of a worker"
+
+    def __init__(self, payload_types=None, markets=None):
+        self.types = _payload_types(payload_types) if payload_types is not None else None
+        self.markets = frozenset(markets) if markets is not None else None
+        self.market_fields = _market_fields() if markets is not None else None
+
+    def wants_type(self, seto_type, eto_type):
+        if seto_type != seto.PAYLOAD_ETO:
+            eto_type = None
+        return (seto_type, eto_type) in self.types
+
+    def wants_market(self, payload):
+        "Payloads without a market id are always wanted"
+        field = self.market_fields.get(payload.type)
+        return field is None or getattr(payload, field).market_id in self.markets
+
+
+def _run_worker(name, index, handler, worker_filter, idle_sleep, batch_size):
+    "Worker process: parse the frames of consumer `index` and pass them to `handler`"
+    logger = logging.getLogger('smarkets.streaming_api.fanout')
+    ring = SharedFrameRing.attach(name)
+    try:
+        reader = ring.reader(index, worker_filter.wants_type if worker_filter.types is not None else None)
+        markets = worker_filter.markets
+        wants_market = worker_filter.wants_market
+        while True:
+            frames = reader.read(batch_size)
+            if not frames:
+                if ring.closed and reader.position == ring.write_position:
+                    return
+                time.sleep(idle_sleep)
+                continue
+            for _, _, data in frames:
+                payload = seto.Payload()
+                payload.ParseFromString(data)
+                if markets is not None and not wants_market(payload):
+                    continue
+                try:
+                    handler(message=payload)
+                except Exception:
+                    reader.errors += 1
+                    logger.exception('handler failed for frame %d', payload.eto_payload.seq)
+            reader.save()
+    finally:
+        ring.close()
+
+
+class FanOutStreamingAPIClient(StreamingAPIClient):
+
+    """
+    :class:`smarkets.streaming_api.client.StreamingAPIClient` which hands every incoming
+    payload to worker processes, to parse and handle payloads on more than one CPU.
+
+    The client reads, sequences and answers heartbeats as usual, without parsing payloads
+    it has no handlers for itself, and writes the serialized payloads to a
+    :class:`SharedFrameRing`. Every worker process reads all of them, skips payloads of the
+    wrong type without parsing them, parses the rest, skips those for other markets and
+    calls its handler::
+
+        client = FanOutStreamingAPIClient(session)
+        client.add_worker(on_quotes, payload_types=['seto.contract_quotes'], markets=[1, 2])
+        client.login()
+        client.start()
+        while True:
+            client.read()
+
+    Handlers are called with the payload like client handlers, in another process, so with
+    the ``spawn`` start method they have to be picklable. Workers which fall more than a
+    ring behind lose frames; :meth:`consumer_stats` has how far behind every worker is and
+    how many frames it lost. Payloads too large for the whole ring are logged and counted in
+    :attr:`payloads_dropped` instead of being handed to the workers.
+    """
+
+    logger = private(logging.getLogger('smarkets.streaming_api.fanout'))
+
+    def __init__(self, session, slot_count=65536, slot_size=512, idle_sleep=0.0005, batch_size=1024):
+        """
+        :type session: :class:`smarkets.streaming_api.session.Session`
+        :param slot_count: Number of ring slots
+        :param slot_size: Size of ring slots in bytes, larger payloads take several slots
+        :param idle_sleep: Seconds workers sleep when there's nothing to read
+        :param batch_size: Maximum number of frames workers take out of the ring at once
+        """
+        super(FanOutStreamingAPIClient, self).__init__(session)
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.idle_sleep = idle_sleep
+        self.batch_size = batch_size
+        self.ring = None
+        self.processes = []
+        self.payloads_dropped = 0
+        self._workers = []
+
+    def add_worker(self, handler, payload_types=None, markets=None):
+        """
+        Add a worker process, before starting.
+
+        :param handler: Called with every wanted payload as `message`
+        :param payload_types: Names of the wanted payload types like ``seto.contract_quotes``,
+            None for all
+        :param markets: Wanted market ids, None for all, payloads without one are always wanted
+        :return: Consumer index of the worker
+        :rtype: int
+        """
+        if self.ring is not None:
+            raise RuntimeError('workers have to be added before starting')
+        if not hasattr(handler, '__call__'):
+            raise ValueError('handler must be a callable')
+        self._workers.append((handler, _WorkerFilter(payload_types, markets)))
+        return len(self._workers) - 1
+
+    def start(self):
+        "Create the ring and start the worker processes"
+        if self.ring is not None:
+            raise RuntimeError('already started')
+        if not self._workers:
+            raise ValueError('no workers were added')
+        self.ring = SharedFrameRing.create(self.slot_count, self.slot_size, len(self._workers))
+        self.processes = [
+            multiprocessing.Process(
+                target=_run_worker, name='smarkets-worker-%d' % (index,),
+                args=(self.ring.name, index, handler, worker_filter, self.idle_sleep, self.batch_size))
+            for index, (handler, worker_filter) in enumerate(self._workers)
+        ]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+    def stop(self, timeout=None):
+        """
+        Let the workers handle the frames written so far, wait for them and remove the ring.
+
+        :param timeout: Seconds to wait for every worker, None to wait until they finish
+        """
+        ring = self.ring
+        if ring is None:
+            return
+        ring.close_writing()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                self.logger.warning('terminating %s', process.name)
+                process.terminate()
+                process.join()
+        self.ring = None
+        ring.close()
+
+    def consumer_stats(self):
+        "Progress of every worker, see :class:`ConsumerStats`"
+        return self.ring.consumer_stats() if self.ring is not None else []
+
+    def _publish(self, seto_type, eto_type, seq, data):
+        try:
+            self.ring.publish(seto_type, eto_type, data)
+        except ValueError:
+            # The payload is sequenced already, it's only lost to the workers
+            self.payloads_dropped += 1
+            self.logger.warning('%d byte payload %d does not fit in the ring, dropped', len(data), seq)
+
+    def _dispatch_buffered(self, limit):
+        ring = self.ring
+        if ring is None:
+            return super(FanOutStreamingAPIClient, self)._dispatch_buffered(limit)
+        processed = 0
+        dispatch = self._dispatch
+        publish = self._publish
+        session = self.session
+        frame_dispatched = session.frame_dispatched if session.latency is not None else None
+        for frame in session.next_frames(limit, self._wants_payload, publish):
+            message = frame.protobuf
+            publish(message.type, message.eto_payload.type, message.eto_payload.seq, frame.bytes)
+            name = dispatch(frame)
+            if frame_dispatched is not None:
+                frame_dispatched(name)
+            processed += 1
+        return processed
@@ -1,10 +1,31 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from six import int2byte
+from six import int2byte, PY2
 
 
 MIN_FRAME_SIZE = 4
 
+# Protobuf keys (field number << 3 | wire type) of the seto.Payload and eto.Payload
+# fields read by peek_payload_header
+_SETO_TYPE_KEY = 0x08  # seto.Payload.type, varint
+_SETO_ETO_PAYLOAD_KEY = 0x12  # seto.Payload.eto_payload, length-delimited
+_ETO_SEQ_KEY = 0x08  # eto.Payload.seq, varint
+_ETO_TYPE_KEY = 0x10  # eto.Payload.type, varint
+_DEFAULT_ETO_TYPE = 1  # eto.PAYLOAD_NONE
+
+if PY2:
+    # Indexing memoryviews gives single-character strings on Python 2
+    _indexable = bytearray
+else:
+    _indexable = lambda data: data
+
+
+# Headers and paddings of frames with payloads short enough for a single byte header
+_SHORT_FRAME_HEADERS = tuple(
+    (int2byte(byte_count), b'\x00' * max(0, MIN_FRAME_SIZE - 1 - byte_count))
+    for byte_count in range(0x80)
+)
+
 
 class IncompleteULEB128(Exception):
     pass
@@ -16,12 +37,23 @@ def frame_encode(frame, payload):
     :type frame: bytearray
     :type payload: byte string or bytearray
     """
-    byte_count = len(payload)
-    header = uleb128_encode(byte_count)
-    padding = b'\x00' * max(0, MIN_FRAME_SIZE - len(header) - byte_count)
+    header, padding = frame_header(len(payload))
     frame += header
     frame += payload
-    frame += padding
+    if padding:
+        frame += padding
+
+
+def frame_header(byte_count):
+    """
+    Get the header and the padding which surround a payload of `byte_count` bytes in a frame.
+
+    :type byte_count: int
+    :rtype: tuple (bytes, bytes)
+    """
+    if byte_count < len(_SHORT_FRAME_HEADERS):
+        return _SHORT_FRAME_HEADERS[byte_count]
+    return bytes(uleb128_encode(byte_count)), b''
 
 
 def uleb128_encode(value):
@@ -48,26 +80,196 @@ def uleb128_encode(value):
 
 def frame_decode_all(to_decode):
     """
-    :type to_decode: bytes
+    :type to_decode: bytearray
     :rtype: tuple (list of bytes, remaining bytes)
     """
     payloads = []
-    while len(to_decode) >= MIN_FRAME_SIZE:
-        try:
-            decoded = uleb128_decode(to_decode)
-        except IncompleteULEB128:
-            # There may be not enough data in the input to decode the header
+    position = 0
+    end = len(to_decode)
+    while end - position >= MIN_FRAME_SIZE:
+        decoded = _decode_frame_header(to_decode, position, end)
+        if decoded is None:
             break
-        else:
-            payload_size, header_size = decoded
-            frame_size = max(payload_size + header_size, MIN_FRAME_SIZE)
-            if len(to_decode) >= frame_size:
-                frame, to_decode = to_decode[:frame_size], to_decode[frame_size:]
-                payloads.append(frame[header_size:header_size + payload_size])
-            else:
+        payload_start, payload_end, frame_end = decoded
+        payloads.append(to_decode[payload_start:payload_end])
+        position = frame_end
+    return payloads, to_decode[position:]
+
+
+def _decode_frame_header(buffer, position, end):
+    """Locate the frame starting at `position`.
+
+    :type buffer: bytearray
+    :return: payload start, payload end and frame end offsets or None if `buffer[position:end]`
+        doesn't contain a whole frame
+    :rtype: tuple of 3 ints or None
+    """
+    decoded = _uleb128_decode_at(buffer, position, end)
+    if decoded is None:
+        # There may be not enough data in the input to decode the header
+        return None
+    payload_size, payload_start = decoded
+    payload_end = payload_start + payload_size
+    frame_end = max(payload_end, position + MIN_FRAME_SIZE)
+    if frame_end > end:
+        return None
+    return payload_start, payload_end, frame_end
+
+
+class FrameDecoder(object):
+
+    """Incremental frame decoder working on a preallocated receive buffer.
+
+    Bytes are written either with :meth:`feed` or directly into the buffer, by filling the
+    view returned by :meth:`reserve` (for example with :meth:`socket.socket.recv_into`) and
+    calling :meth:`commit`. Complete payloads are taken out with :meth:`next_payload` (or by
+    iterating the decoder).
+
+    Payloads are :class:`memoryview` objects pointing into the internal buffer so no
+    copying happens when walking over a chunk of frames. Undecoded bytes are moved to the
+    front of the buffer when there's no room left at the end of it and the buffer only
+    grows when a frame doesn't fit into it, so payload views are only valid until the next
+    :meth:`reserve` or :meth:`feed` call.
+
+        >>> decoder = FrameDecoder()
+        >>> decoder.feed(b'\\x01a\\x00\\x00\\x03ab')
+        >>> [payload.tobytes() for payload in decoder] == [b'a']
+        True
+        >>> decoder.pending_bytes
+        3
+        >>> decoder.feed(b'c')
+        >>> decoder.next_payload().tobytes() == b'abc'
+        True
+        >>> decoder.next_payload() is None
+        True
+    """
+
+    def __init__(self, capacity=65536):
+        """
+        :param capacity: initial size of the buffer in bytes
+        :type capacity: int
+        """
+        if capacity <= 0:
+            raise ValueError('capacity needs to be positive, got %r' % (capacity,))
+        self.buffer = bytearray(capacity)
+        self._view = memoryview(self.buffer)
+        self.position = 0
+        self.end = 0
+        # Number of bytes received since the decoder was created
+        self.received = 0
+        # Complete frames between position and _counted_end, see frame_count
+        self._counted = 0
+        self._counted_end = 0
+
+    @property
+    def capacity(self):
+        return len(self.buffer)
+
+    @property
+    def pending_bytes(self):
+        "Number of buffered bytes which haven't been decoded yet"
+        return self.end - self.position
+
+    @property
+    def frame_count(self):
+        """
+        Number of complete frames which weren't taken out yet.
+
+        Every frame header is only decoded once however often this is checked.
+        """
+        buffer = self.buffer
+        end = self.end
+        position = self._counted_end
+        if position < self.position:
+            position = self.position
+            self._counted = 0
+        while end - position >= MIN_FRAME_SIZE:
+            decoded = _decode_frame_header(buffer, position, end)
+            if decoded is None:
                 break
+            position = decoded[2]
+            self._counted += 1
+        self._counted_end = position
+        return self._counted
+
+    def clear(self):
+        "Drop all buffered bytes, complete frames included"
+        self.position = self.end = 0
+        self._counted = self._counted_end = 0
+
+    def reserve(self, size):
+        """
+        Make sure there are at least `size` bytes of free space at the end of the buffer.
+
+        :type size: int
+        :return: writable view of the free space, to be followed by :meth:`commit`
+        :rtype: memoryview
+        """
+        if self.position == self.end:
+            self.position = self.end = self._counted_end = 0
+        if len(self.buffer) - self.end < size:
+            self._make_room(size)
+        return self._view[self.end:]
+
+    def commit(self, size):
+        """
+        Mark `size` bytes written to the view returned by :meth:`reserve` as received.
+
+        :type size: int
+        """
+        self.end += size
+        self.received += size
 
-    return payloads, to_decode
+    def feed(self, data):
+        """
+        Append `data` to the buffer.
+
+        :type data: byte string or bytearray
+        """
+        size = len(data)
+        self.reserve(size)
+        self.buffer[self.end:self.end + size] = data
+        self.end += size
+        self.received += size
+
+    def _make_room(self, size):
+        pending = self.end - self.position
+        if pending + size <= len(self.buffer) and pending <= self.position:
+            # The source and the destination don't overlap so it's safe to move in place
+            self.buffer[:pending] = self._view[self.position:self.end]
+        else:
+            capacity = len(self.buffer)
+            while capacity < pending + size:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[:pending] = self._view[self.position:self.end]
+            self.buffer = buffer
+            self._view = memoryview(buffer)
+        self._counted_end = max(0, self._counted_end - self.position)
+        self.position = 0
+        self.end = pending
+
+    def next_payload(self):
+        """
+        :return: next complete payload or None if more bytes are needed
+        :rtype: memoryview or None
+        """
+        end = self.end
+        if end - self.position < MIN_FRAME_SIZE:
+            return None
+        decoded = _decode_frame_header(self.buffer, self.position, end)
+        if decoded is None:
+            return None
+        payload_start, payload_end, self.position = decoded
+        if self._counted:
+            self._counted -= 1
+        return self._view[payload_start:payload_end]
+
+    def __iter__(self):
+        payload = self.next_payload()
+        while payload is not None:
+            yield payload
+            payload = self.next_payload()
 
 
 def uleb128_decode(to_decode):
@@ -78,25 +280,76 @@ def uleb128_decode(to_decode):
     :raises:
         :IncompleteULEB128: when `to_decode` doesn't start with ULEB128-encoded number.
     """
+    decoded = _uleb128_decode_at(to_decode, 0, len(to_decode))
+    if decoded is None:
+        raise IncompleteULEB128('to_decode does not start with a ULEB128-encoded value')
+    return decoded
+
+
+def _uleb128_decode_at(to_decode, position, end):
+    """
+    :return: decoded value and position right after it or None if `to_decode[position:end]`
+        doesn't start with a complete ULEB128-encoded number
+    :rtype: tuple of (int or long) and int or None
+    """
     CONTINUATION_MARK = 0x80
     LEAST_MEANINGFUL_PART_MASK = 0x7f
 
     shift = 0
     result = 0
-    position = 0
 
-    while True:
-        try:
-            current_byte = to_decode[position]
-        except IndexError:
-            raise IncompleteULEB128('to_decode does not start with a ULEB128-encoded value')
-        else:
-            result |= ((current_byte & LEAST_MEANINGFUL_PART_MASK) << shift)
+    while position < end:
+        current_byte = to_decode[position]
+        position += 1
+        result |= ((current_byte & LEAST_MEANINGFUL_PART_MASK) << shift)
+        if not current_byte & CONTINUATION_MARK:
+            return result, position
+        shift += 7
+    return None
 
-            if not current_byte & CONTINUATION_MARK:
-                break
-            else:
-                shift += 7
-                position += 1
 
-    return result, position + 1
+def peek_payload_header(payload):
+    """Read the fields needed for sequencing from a serialized seto.Payload without parsing it.
+
+    Only the canonical layout every protobuf serializer produces is understood: the seto
+    payload type followed by the eto payload starting with its sequence number and type.
+
+    >>> peek_payload_header(bytearray(b'\\x08\\x0c\\x12\\x04\\x08\\x07\\x10\\x01'))
+    (12, 1, 7)
+
+    :type payload: bytearray or a bytes-like object
+    :return: seto payload type, eto payload type and eto sequence number or None if the
+        payload needs a full parse
+    :rtype: tuple of 3 ints or None
+    """
+    payload = _indexable(payload)
+    end = len(payload)
+    try:
+        if payload[0] != _SETO_TYPE_KEY:
+            return None
+        # Payload types and the eto payload size nearly always fit in a single byte
+        seto_type = payload[1]
+        if seto_type & 0x80:
+            seto_type, position = _uleb128_decode_at(payload, 1, end)
+        else:
+            position = 2
+        if payload[position] != _SETO_ETO_PAYLOAD_KEY:
+            return None
+        eto_end = payload[position + 1]
+        if eto_end & 0x80:
+            eto_end, position = _uleb128_decode_at(payload, position + 1, end)
+        else:
+            position += 2
+        eto_end += position
+        if eto_end > end or payload[position] != _ETO_SEQ_KEY:
+            return None
+        seq, position = _uleb128_decode_at(payload, position + 1, eto_end)
+        eto_type = _DEFAULT_ETO_TYPE
+        if position + 1 < eto_end and payload[position] == _ETO_TYPE_KEY:
+            eto_type = payload[position + 1]
+            if eto_type & 0x80:
+                eto_type, position = _uleb128_decode_at(payload, position + 1, eto_end)
+    except (IndexError, TypeError):
+        # Truncated payload, _uleb128_decode_at returned None
+        return None
+    return seto_type, eto_type, seq
@@ -0,0 +1,138 @@
+"Keeping outgoing traffic flowing on a timer, whatever the handlers are doing"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from smarkets import private
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.session import _monotonic
+from smarkets.streaming_api.templates import HEARTBEAT_TEMPLATE
+
+__all__ = ('KeepaliveScheduler',)
+
+
+class KeepaliveScheduler(object):
+
+    """
+    Flushes heartbeat replies and sends keepalives for a session on its own timer.
+
+    Heartbeat replies are buffered while frames are read and with the explicit flush policy
+    they wait for the next flush. :meth:`run_pending` flushes them straight away and, when
+    nothing was written to the socket for `interval` seconds, sends a payload serialised
+    from `template`, a heartbeat by default, so the server keeps hearing from the client.
+    Payloads already waiting in the send buffer are flushed instead of sending a new one.
+
+    Run it from a :class:`smarkets.streaming_api.reactor.Reactor` (see
+    ``Reactor.register``) or in a background thread of its own with :meth:`start`. In a
+    thread, `lock` has to be held by everything else using the session's send buffer,
+    :class:`smarkets.streaming_api.threaded.ThreadedStreamingAPIClient` does that with its
+    `keepalive_interval` option.
+    """
+
+    logger = private(logging.getLogger('smarkets.streaming_api.keepalive'))
+
+    def __init__(self, session, interval=5.0, template=HEARTBEAT_TEMPLATE, lock=None, poll_interval=0.05):
+        """
+        :type session: :class:`smarkets.streaming_api.session.Session`
+        :param interval: Seconds without writing to the socket after which a keepalive is sent
+        :type template: :class:`smarkets.streaming_api.templates.PayloadTemplate`
+        :param lock: Lock held while using the session, needed in a background thread
+        :param poll_interval: Seconds between checks for heartbeat replies in a background
+            thread
+        """
+        if interval <= 0:
+            raise ValueError('interval needs to be positive, got %r' % (interval,))
+        self.session = session
+        self.interval = interval
+        self.template = template
+        self.lock = lock if lock is not None else threading.Lock()
+        self.poll_interval = poll_interval
+        self.keepalives_sent = 0
+        self.heartbeat_flushes = 0
+        self.error = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def next_due(self, now=None):
+        """
+        When the next keepalive is due, heartbeat replies are checked for separately.
+
+        :return: :func:`time.monotonic` time in seconds
+        :rtype: float
+        """
+        if now is None:
+            now = _monotonic()
+        session = self.session
+        if session.last_sent_at is None:
+            return now + self.interval
+        return max(now, session.last_sent_at + self.interval)
+
+    def run_pending(self, now=None):
+        """
+        Flush heartbeat replies and send a keepalive if one is due.
+
+        :return: True if anything was written
+        :rtype: bool
+        """
+        session = self.session
+        with self.lock:
+            if not session.connected:
+                return False
+            if now is None:
+                now = _monotonic()
+            if session.heartbeat_pending:
+                session.flush()
+                self.heartbeat_flushes += 1
+                return True
+            if session.last_sent_at is None or now - session.last_sent_at >= self.interval:
+                # With the explicit flush policy nothing else writes buffered payloads, they
+                # keep the connection alive just as well
+                if not session.output_buffer_size:
+                    session.send_template(self.template)
+                session.flush()
+                self.keepalives_sent += 1
+                return True
+        return False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        "Run in a background thread until :meth:`stop` is called or the connection fails"
+        if self.running:
+            raise RuntimeError('already started')
+        self.error = None
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='smarkets-keepalive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        "Stop the background thread and wait for it to finish"
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _run(self):
+        "Background thread"
+        stopping = self._stopping
+        while True:
+            now = _monotonic()
+            due = min(self.next_due(now), now + self.poll_interval)
+            if not self.session.connected:
+                due = now + self.poll_interval
+            if stopping.wait(due - now):
+                return
+            try:
+                self.run_pending()
+            except (ConnectionError, SocketDisconnected) as exc:
+                self.logger.warning('keepalives stopped: %s', exc)
+                self.error = exc
+                return
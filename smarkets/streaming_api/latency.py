@@ -0,0 +1,234 @@
+"Latency histograms for incoming payloads"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+__all__ = (
+    'LatencyHistogram', 'LatencyStats', 'STAGES', 'STAGE_DISPATCH', 'STAGE_PARSE', 'STAGE_QUEUED',
+    'STAGE_TOTAL',
+)
+
+# From the bytes of a payload being received, by the kernel with kernel timestamps enabled
+# in the session settings, until its frame is taken out of the receive buffer
+STAGE_QUEUED = 'queued'
+# Parsing the payload
+STAGE_PARSE = 'parse'
+# Calling the handlers
+STAGE_DISPATCH = 'dispatch'
+# From the bytes being received until the handlers returned
+STAGE_TOTAL = 'total'
+
+STAGES = (STAGE_QUEUED, STAGE_PARSE, STAGE_DISPATCH, STAGE_TOTAL)
+
+# Every power of two of nanoseconds is split into this many buckets, so bucket bounds are
+# within 12.5% of the values counted in them
+_SUB_BUCKET_BITS = 3
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+# Enough buckets for any 64 bit number of nanoseconds
+_BUCKET_COUNT = 64 * _SUB_BUCKETS
+
+
+def _bucket_index(value):
+    "Index of the bucket counting `value` nanoseconds"
+    if value < _SUB_BUCKETS:
+        return value if value > 0 else 0
+    shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+    return ((shift + 1) << _SUB_BUCKET_BITS) + (value >> shift) - _SUB_BUCKETS
+
+
+def _bucket_bounds(index):
+    "Lowest and highest nanosecond values counted in a bucket"
+    if index < _SUB_BUCKETS:
+        return index, index
+    shift = (index >> _SUB_BUCKET_BITS) - 1
+    mantissa = (index & (_SUB_BUCKETS - 1)) + _SUB_BUCKETS
+    return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+
+    """
+    Counts durations in logarithmic buckets.
+
+    Durations are kept in nanoseconds with a precision of 12.5%. Adding one only increments
+    the counter of its bucket, so everything else, including the count, mean and maximum, is
+    worked out from the buckets when asked for.
+    """
+
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = [0] * _BUCKET_COUNT
+
+    def reset(self):
+        self.counts[:] = [0] * _BUCKET_COUNT
+
+    def add(self, seconds):
+        "Count a duration given in seconds"
+        self.counts[_bucket_index(int(seconds * 1e9))] += 1
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        """
+        Mean duration in seconds, from the middle of the buckets, 0.0 if nothing was added.
+
+        :rtype: float
+        """
+        count = total = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count:
+                low, high = _bucket_bounds(index)
+                count += bucket_count
+                total += bucket_count * (low + high) / 2.0
+        return total / count / 1e9 if count else 0.0
+
+    @property
+    def max(self):
+        """
+        Upper bound of the longest duration in seconds, 0.0 if nothing was added.
+
+        :rtype: float
+        """
+        for index in range(_BUCKET_COUNT - 1, -1, -1):
+            if self.counts[index]:
+                return _bucket_bounds(index)[1] / 1e9
+        return 0.0
+
+    def percentile(self, percent):
+        """
+        Upper bound of the duration in seconds which `percent` percent of the added durations
+        don't exceed, 0.0 if nothing was added.
+
+        :type percent: float
+        :rtype: float
+        """
+        count = self.count
+        if not count:
+            return 0.0
+        rank = max(1, int(count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return _bucket_bounds(index)[1] / 1e9
+
+    def buckets(self):
+        """
+        Iterate over the buckets with anything in them.
+
+        :return: lowest duration, highest duration (both in seconds) and number of durations
+            for every bucket
+        :rtype: iterator of tuples
+        """
+        for index, count in enumerate(self.counts):
+            if count:
+                low, high = _bucket_bounds(index)
+                yield low / 1e9, high / 1e9, count
+
+    def update(self, other):
+        "Add the durations counted in `other` to this histogram"
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+
+    def __repr__(self):
+        return '%s(count=%d, mean=%.6f, max=%.6f)' % (type(self).__name__, self.count, self.mean, self.max)
+
+
+class LatencyStats(object):
+
+    """
+    Latency histograms of incoming payloads, one per payload type and stage.
+
+    Attach it to a session to time every payload dispatched by a
+    :class:`smarkets.streaming_api.client.StreamingAPIClient` from the read which received
+    its last bytes, through decoding and parsing, to its handlers returning::
+
+        session.latency = LatencyStats()
+        ...
+        session.latency.histogram('seto.contract_quotes').percentile(99)
+
+    Payload types are handler names like ``seto.contract_quotes`` and stages are the
+    ``STAGE_*`` constants. Payloads skipped without being parsed aren't timed. Timing a
+    payload costs three clock reads and four bucket increments, cheap enough to leave on.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+
+    def record(self, name, received_at, framed_at, parsed_at, dispatched_at):
+        """
+        Add the timings of one payload, all :func:`time.monotonic_ns` times in nanoseconds.
+
+        :param name: Payload type
+        :param received_at: When the last bytes of the payload were received
+        :param framed_at: When the payload was taken out of the receive buffer
+        :param parsed_at: When the payload was parsed
+        :param dispatched_at: When the handlers returned
+        """
+        histograms = self._histograms.get(name)
+        if histograms is None:
+            histograms = self._histograms[name] = tuple(LatencyHistogram() for _ in STAGES)
+        queued, parse, dispatch, total = histograms
+        bucket_index = _bucket_index
+        queued.counts[bucket_index(framed_at - received_at)] += 1
+        parse.counts[bucket_index(parsed_at - framed_at)] += 1
+        dispatch.counts[bucket_index(dispatched_at - parsed_at)] += 1
+        total.counts[bucket_index(dispatched_at - received_at)] += 1
+
+    @property
+    def names(self):
+        "Payload types timed so far"
+        return sorted(self._histograms)
+
+    def histogram(self, name=None, stage=STAGE_TOTAL):
+        """
+        Get the histogram of a payload type and stage.
+
+        :param name: Payload type, None for all payload types together
+        :type stage: One of :data:`STAGES`
+        :rtype: :class:`LatencyHistogram`
+        :raises ValueError: if `stage` is unknown
+        """
+        if stage not in STAGES:
+            raise ValueError('Unknown stage %r' % (stage,))
+        position = STAGES.index(stage)
+        if name is not None:
+            histograms = self._histograms.get(name)
+            return histograms[position] if histograms is not None else LatencyHistogram()
+        combined = LatencyHistogram()
+        for histograms in self._histograms.values():
+            combined.update(histograms[position])
+        return combined
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Summarise the histograms, for example to be logged or exported as JSON.
+
+        :return: ``{name: {stage: {'count': ..., 'mean': ..., 'max': ..., 'p50': ...}}}``
+            with durations in seconds
+        :rtype: dict
+        """
+        result = {}
+        for name, histograms in self._histograms.items():
+            stages = result[name] = {}
+            for stage, histogram in zip(STAGES, histograms):
+                summary = stages[stage] = {
+                    'count': histogram.count,
+                    'mean': histogram.mean,
+                    'max': histogram.max,
+                }
+                for percent in percentiles:
+                    summary['p%s' % (percent,)] = histogram.percentile(percent)
+        return result
+
+    def reset(self):
+        "Forget everything timed so far"
+        self._histograms.clear()
@@ -0,0 +1,202 @@
+"Multiplexing many streaming API clients in a single thread"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+from collections import deque
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+from smarkets import private
+from smarkets.signal import Signal
+from smarkets.streaming_api.client import READ_MODE_BUFFER_AND_DISPATCH, READ_MODE_DISPATCH_FROM_BUFFER
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.keepalive import KeepaliveScheduler
+from smarkets.streaming_api.session import _monotonic
+
+__all__ = ('Reactor',)
+
+
+class Reactor(object):
+
+    """
+    Reads from and writes to many :class:`smarkets.streaming_api.client.StreamingAPIClient`
+    instances in one thread.
+
+    Registered clients are switched to non-blocking mode. Every :meth:`run_once` round reads
+    once from every socket which is ready and dispatches at most `read_limit` frames per client,
+    so that a busy connection can't starve the others. Frames left over are dispatched in the
+    following rounds. Messages sent by handlers (or anything else) are flushed as soon as the
+    socket becomes writable, there's no need to call :meth:`flush` on registered clients.
+    Clients whose session is overloaded, see
+    :meth:`smarkets.streaming_api.session.Session.check_inbound`, aren't read from until
+    they've caught up with the frames they have buffered.
+    Clients registered with a `keepalive_interval` get a
+    :class:`smarkets.streaming_api.keepalive.KeepaliveScheduler` run every round, and
+    :meth:`run_once` doesn't wait past their next keepalive.
+
+    When a client gets disconnected it's unregistered and :attr:`disconnected` is fired with
+    `client` and `exception` (None if it was logged out) keyword arguments.
+    """
+
+    logger = private(logging.getLogger('smarkets.streaming_api.reactor'))
+
+    def __init__(self, read_limit=100, selector=None):
+        """
+        :param read_limit: Maximum number of frames dispatched per client in one round
+        :type read_limit: int
+        :type selector: :class:`selectors.BaseSelector` or None
+        """
+        self.read_limit = read_limit
+        self.selector = selector if selector is not None else selectors.DefaultSelector()
+        self.disconnected = Signal()
+        self._running = False
+        # Clients which may have complete frames buffered which weren't dispatched yet
+        self._backlog = deque()
+        self._sockets = {}
+        self._events = {}
+        self._keepalives = {}
+
+    @property
+    def clients(self):
+        "Registered clients"
+        return list(self._sockets)
+
+    def register(self, client, keepalive_interval=None):
+        """
+        Start handling a connected, logged in client.
+
+        :type client: :class:`smarkets.streaming_api.client.StreamingAPIClient`
+        :param keepalive_interval: Seconds without writing after which a keepalive is sent,
+            None for no keepalives
+        """
+        sock = client.raw_socket
+        if sock is None:
+            raise ValueError('client has to be connected before registering it')
+        sock.setblocking(False)
+        events = self._wanted_events(client)
+        if events:
+            self.selector.register(sock, events, client)
+        self._sockets[client] = sock
+        self._events[client] = events
+        if keepalive_interval is not None:
+            self._keepalives[client] = KeepaliveScheduler(client.session, keepalive_interval)
+        # Login may have left frames in the buffers already
+        self._backlog.append(client)
+
+    def unregister(self, client):
+        """
+        Stop handling a client, its socket is switched back to blocking mode if still open.
+
+        :type client: :class:`smarkets.streaming_api.client.StreamingAPIClient`
+        """
+        sock = self._sockets.pop(client)
+        events = self._events.pop(client)
+        self._keepalives.pop(client, None)
+        if events:
+            self.selector.unregister(sock)
+        if client.raw_socket is sock:
+            sock.settimeout(client.session.settings.socket_timeout)
+
+    def run(self):
+        "Handle the registered clients until all of them are gone or :meth:`stop` is called"
+        self._running = True
+        while self._running and self._sockets:
+            self.run_once()
+
+    def stop(self):
+        "Make :meth:`run` return after the current round"
+        self._running = False
+
+    def run_once(self, timeout=None):
+        """
+        Wait for at most `timeout` seconds (forever if None) for any socket to be ready and
+        handle every ready client once.
+
+        :return: Number of dispatched frames
+        :rtype: int
+        """
+        for client in list(self._sockets):
+            self._update_events(client)
+
+        if self._backlog:
+            timeout = 0
+        elif self._keepalives:
+            now = _monotonic()
+            due = min(keepalive.next_due(now) for keepalive in self._keepalives.values())
+            timeout = due - now if timeout is None else min(timeout, due - now)
+        ready = dict((key.data, mask) for key, mask in self.selector.select(timeout))
+        backlog, self._backlog = self._backlog, deque()
+        for client in backlog:
+            if client in self._sockets:
+                ready.setdefault(client, 0)
+
+        processed = 0
+        for client, mask in ready.items():
+            processed += self._handle(client, mask)
+        for client, keepalive in list(self._keepalives.items()):
+            try:
+                keepalive.run_pending()
+            except (ConnectionError, SocketDisconnected) as e:
+                self.logger.info('client %r disconnected: %r', client, e)
+                self._drop(client, e)
+        return processed
+
+    def _handle(self, client, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                client.flush()
+            if mask & selectors.EVENT_READ:
+                processed = client.read(READ_MODE_BUFFER_AND_DISPATCH, limit=self.read_limit)
+            else:
+                processed = client.read(READ_MODE_DISPATCH_FROM_BUFFER, limit=self.read_limit)
+        except (ConnectionError, SocketDisconnected) as e:
+            self.logger.info('client %r disconnected: %r', client, e)
+            self._drop(client, e)
+            return 0
+
+        if not client.session.connected:
+            self._drop(client, None)
+        elif processed >= self.read_limit or self._ssl_pending(client) or client.session.overloaded:
+            # Data already off the socket won't make it ready again, come back next round
+            self._backlog.append(client)
+        else:
+            self._update_events(client)
+        return processed
+
+    def _drop(self, client, exception):
+        self.unregister(client)
+        self.disconnected.fire(client=client, exception=exception)
+
+    def _update_events(self, client):
+        events = self._wanted_events(client)
+        current = self._events[client]
+        if events != current:
+            # Selectors don't take sockets without events
+            sock = self._sockets[client]
+            if not events:
+                self.selector.unregister(sock)
+            elif not current:
+                self.selector.register(sock, events, client)
+            else:
+                self.selector.modify(sock, events, client)
+            self._events[client] = events
+
+    @staticmethod
+    def _wanted_events(client):
+        events = 0 if client.session.overloaded else selectors.EVENT_READ
+        if client.output_buffer_size:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    @staticmethod
+    def _ssl_pending(client):
+        "Check if the SSL layer holds decrypted data select() doesn't know about"
+        pending = getattr(client.raw_socket, 'pending', None)
+        return pending is not None and pending() > 0
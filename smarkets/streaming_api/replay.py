@@ -0,0 +1,228 @@
+"Replaying captured streams through sessions and clients"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import logging
+import mmap
+import os
+import time
+
+from smarkets import private
+from smarkets.streaming_api.capture import DIRECTION_IN, iter_records
+from smarkets.streaming_api.exceptions import SocketDisconnected
+from smarkets.streaming_api.framing import frame_header
+
+__all__ = ('ReplaySocket', 'replay')
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class ReplaySocket(object):
+
+    """
+    Stands in for :class:`smarkets.streaming_api.session.SessionSocket`, serving the payloads
+    a session received in a capture made with :class:`smarkets.streaming_api.capture.CaptureRecorder`.
+
+    The capture is memory mapped and payloads are framed straight from the mapping into the
+    buffer passed to :meth:`recv_into`, so everything after the socket, framing, sequencing,
+    parsing and dispatching, runs the same code as with a live connection. Sent data is
+    discarded. :meth:`recv_into` raises
+    :class:`smarkets.streaming_api.exceptions.SocketDisconnected` at the end of the capture.
+
+    A capture recorded across reconnects holds one run of sequence numbers per connection,
+    a new one starts wherever the sequence number isn't above the last one. The socket is
+    disconnected there too, with :attr:`reconnect_seq` set to where the next run starts, and
+    serves the next run once it's connected again.
+
+    With `speed` None payloads are served as fast as they're read. Otherwise the original
+    spacing of the payloads is reproduced, divided by `speed`: 1.0 replays in real time,
+    10.0 ten times faster. Payloads which are due are served together, :meth:`recv_into`
+    only sleeps when nothing is due yet.
+    """
+
+    logger = private(logging.getLogger('smarkets.session.replay'))
+
+    def __init__(self, path, speed=None, clock=_monotonic, sleep=time.sleep):
+        """
+        :param path: Capture file
+        :type speed: float or None
+        :param clock: Monotonic clock, returning seconds
+        :param sleep: Called with the number of seconds to wait for the next payload
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError('speed needs to be positive, got %r' % (speed,))
+        self.speed = speed
+        self._clock = clock
+        self._sleep = sleep
+        with open(path, 'rb') as f:
+            # Empty files can't be mapped, a recorder which didn't get to write anything
+            # leaves an empty capture with no records
+            if os.fstat(f.fileno()).st_size:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._data = memoryview(self._mmap)
+            else:
+                self._mmap = self._data = None
+        if self._data is not None:
+            self._records = (
+                record for record in iter_records(self._data) if record.direction == DIRECTION_IN)
+        else:
+            self._records = iter(())
+        self._next_record = next(self._records, None)
+        # Sequence number of the first payload to be replayed
+        self.first_seq = self._next_record.seq if self._next_record is not None else None
+        # Sequence number of the first payload after the connection the capture went on with,
+        # set when recv_into reached the end of the previous one
+        self.reconnect_seq = None
+        self._last_seq = None
+        self._first_timestamp = self._next_record.timestamp if self._next_record is not None else None
+        self._started_at = None
+        # Rest of a frame which didn't fit into the last buffer
+        self._pending = b''
+        self._connected = True
+        self.payloads = 0
+
+    @property
+    def connected(self):
+        return self._connected
+
+    def connect(self):
+        "Nothing to connect to, the capture is replayed from where it's got to"
+        was_connected, self._connected = self._connected, True
+        return not was_connected
+
+    def disconnect(self):
+        self._connected = False
+
+    def close(self):
+        "Release the capture file"
+        self._connected = False
+        self._next_record = self._records = None
+        if self._mmap is not None:
+            # The mapping can't be closed while it's exported
+            if hasattr(self._data, 'release'):
+                self._data.release()
+            self._mmap.close()
+
+    def send(self, byte_array):
+        if not self._connected:
+            raise SocketDisconnected('Trying to write to socket when disconnected')
+        return len(byte_array)
+
+    def sendmsg(self, buffers):
+        if not self._connected:
+            raise SocketDisconnected('Trying to write to socket when disconnected')
+        return sum(len(buffer) for buffer in buffers)
+
+    def recv_into(self, buffer, nbytes):
+        """
+        Frame the next payloads which are due into `buffer`.
+
+        :return: Number of bytes written to `buffer`
+        :rtype: int
+        """
+        if not self._connected:
+            raise SocketDisconnected('Trying to read from a socket when disconnected')
+        buffer = memoryview(buffer)
+        filled = 0
+        if self._pending:
+            filled = min(nbytes, len(self._pending))
+            buffer[:filled] = self._pending[:filled]
+            self._pending = self._pending[filled:]
+        while filled < nbytes:
+            record = self._next_record
+            if record is None:
+                break
+            if self._last_seq is not None and record.seq <= self._last_seq:
+                # The capture goes on with a new connection, everything before it has to be
+                # handled before the session can start sequencing again
+                if filled:
+                    break
+                self._connected = False
+                self._last_seq = None
+                self.reconnect_seq = record.seq
+                message = 'End of captured connection after %d payloads' % self.payloads
+                self.logger.info(message)
+                raise SocketDisconnected(message)
+            if not self._due(record.timestamp, wait=not filled):
+                break
+            payload = record.payload
+            header, padding = frame_header(len(payload))
+            frame_end = filled + len(header) + len(payload) + len(padding)
+            if frame_end <= nbytes:
+                position = filled + len(header)
+                buffer[filled:position] = header
+                buffer[position:position + len(payload)] = payload
+                buffer[position + len(payload):frame_end] = padding
+                filled = frame_end
+            else:
+                frame = header + payload.tobytes() + padding
+                self._pending = frame[nbytes - filled:]
+                buffer[filled:nbytes] = frame[:nbytes - filled]
+                filled = nbytes
+            self.payloads += 1
+            self._last_seq = record.seq
+            self._next_record = next(self._records, None)
+        if not filled:
+            self.reconnect_seq = None
+            message = 'End of capture after %d payloads' % self.payloads
+            self.logger.info(message)
+            raise SocketDisconnected(message)
+        return filled
+
+    def _due(self, timestamp, wait):
+        "Check if a payload recorded at `timestamp` is due, sleeping until it is if `wait`"
+        if self.speed is None:
+            return True
+        now = self._clock()
+        if self._started_at is None:
+            self._started_at = now
+        due_at = self._started_at + (timestamp - self._first_timestamp) / self.speed
+        if now >= due_at:
+            return True
+        if not wait:
+            return False
+        self._sleep(due_at - now)
+        return True
+
+
+def replay(client, path, speed=None):
+    """
+    Replay the payloads received in a capture through a client's session and handlers.
+
+    The session of `client` gets a :class:`ReplaySocket` and its incoming sequence number is
+    set to the one of the first captured payload, then the client reads until the end of the
+    capture. Where the capture went on with a new connection the session is disconnected
+    and picks up the sequence numbers of the new one. Handlers are called exactly as they
+    would be for a live connection. Whatever the session sends meanwhile is flushed after
+    every read and thrown away.
+
+    :type client: :class:`smarkets.streaming_api.client.StreamingAPIClient`
+    :param path: Capture file
+    :param speed: None to replay as fast as possible, otherwise the time scale, 1.0 for real time
+    :return: Number of dispatched frames
+    :rtype: int
+    """
+    session = client.session
+    socket = ReplaySocket(path, speed=speed)
+    session.socket = socket
+    if socket.first_seq is not None:
+        session.inseq = socket.first_seq
+    dispatched = 0
+    try:
+        while True:
+            try:
+                dispatched += client.read()
+                # Heartbeat replies and replay requests go nowhere, don't let them pile up
+                client.flush()
+            except SocketDisconnected:
+                if socket.reconnect_seq is None:
+                    break
+                session.disconnect()
+                session.inseq = socket.reconnect_seq
+                socket.connect()
+    finally:
+        socket.close()
+    return dispatched
@@ -0,0 +1,222 @@
+"Reconnecting automatically and resuming from the last processed account sequence"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import logging
+import random
+import sys
+import time
+
+from smarkets import private
+from smarkets.signal import Signal
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import (
+    _SETO_PAYLOAD_TYPES, READ_MODE_BUFFER_AND_DISPATCH, StreamingAPIClient,
+)
+from smarkets.streaming_api.exceptions import ConnectionError, LoginTimeout, SocketDisconnected
+from smarkets.streaming_api.latency import LatencyHistogram
+
+__all__ = ('ReconnectStats', 'ResilientStreamingAPIClient')
+
+_monotonic = getattr(time, 'monotonic', time.time)
+_sleep = time.sleep
+_random = random.random
+
+
+def _account_fields():
+    "seto payload type -> name of the payload field holding a message with an account sequence"
+    fields = {}
+    payload_fields = seto.Payload.DESCRIPTOR.fields_by_name
+    for seto_type, name in _SETO_PAYLOAD_TYPES.items():
+        field = payload_fields.get(name.split('.', 1)[1])
+        if field is not None and field.message_type is not None and \
+                'account_sequence_64' in field.message_type.fields_by_name:
+            fields[seto_type] = field.name
+    return fields
+
+
+_ACCOUNT_FIELDS = _account_fields()
+
+
+class ReconnectStats(object):
+
+    """
+    Counts the reconnects of a :class:`ResilientStreamingAPIClient`.
+
+    :attr:`durations` has how long recovering took every time, from noticing the connection
+    was lost to being logged in again with the market subscriptions renewed.
+    :attr:`messages_replayed` counts the account payloads the server replayed after logins
+    which resumed from an account sequence.
+    """
+
+    def __init__(self):
+        self.durations = LatencyHistogram()
+        self.reset()
+
+    def reset(self):
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.messages_replayed = 0
+        self.last_duration = None
+        self.durations.reset()
+
+    def __repr__(self):
+        return '%s(reconnects=%d, failed_attempts=%d, messages_replayed=%d, last_duration=%r)' % (
+            type(self).__name__, self.reconnects, self.failed_attempts, self.messages_replayed,
+            self.last_duration)
+
+
+class ResilientStreamingAPIClient(StreamingAPIClient):
+
+    """
+    :class:`smarkets.streaming_api.client.StreamingAPIClient` which reconnects when the
+    connection is lost.
+
+    The account sequence of every account payload, order accepted, executed, cancelled and
+    so on, is kept in :attr:`smarkets.streaming_api.session.Session.account_sequence` once
+    its handlers have returned, so those payloads are always parsed. When reading or
+    flushing fails, the client logs in again, resuming from that sequence, so the server
+    replays the account payloads which were missed, and renews the market subscriptions
+    sent through it. Attempts after the first one are spaced with exponential backoff,
+    jittered so that many clients cut off at once don't come back at once.
+
+    :attr:`reconnected` is fired with the `duration` of the recovery in seconds and the
+    number of `attempts` it took, and :attr:`reconnect_stats` keeps count. Payloads which
+    weren't flushed when the connection was lost are dropped. A logout, by the client or
+    the server, and a rejected login end the session for good.
+    """
+
+    logger = private(logging.getLogger('smarkets.streaming_api.resilient'))
+
+    def __init__(self, session, initial_backoff=0.1, max_backoff=30.0, max_attempts=None):
+        """
+        :type session: :class:`smarkets.streaming_api.session.Session`
+        :param initial_backoff: Seconds to wait at most before the second attempt to reconnect
+        :param max_backoff: Seconds to wait at most between attempts
+        :param max_attempts: Attempts after which reconnecting gives up and the error is
+            raised, None to keep trying
+        """
+        super(ResilientStreamingAPIClient, self).__init__(session)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.reconnect_stats = ReconnectStats()
+        self.reconnected = Signal()
+        # Market ids subscribed to through the client
+        self.subscriptions = set()
+        self._reconnecting = False
+
+    @property
+    def logged_in(self):
+        last_login = self.last_login
+        return last_login is not None and last_login.eto_payload.type == eto.PAYLOAD_LOGIN_RESPONSE
+
+    def read(self, read_mode=READ_MODE_BUFFER_AND_DISPATCH, limit=sys.maxsize):
+        try:
+            return super(ResilientStreamingAPIClient, self).read(read_mode, limit)
+        except (ConnectionError, SocketDisconnected) as exc:
+            self._recover(exc)
+            return 0
+
+    def flush(self):
+        try:
+            super(ResilientStreamingAPIClient, self).flush()
+        except (ConnectionError, SocketDisconnected) as exc:
+            self._recover(exc)
+
+    def send(self, message):
+        self._track_subscription(message)
+        try:
+            super(ResilientStreamingAPIClient, self).send(message)
+        except (ConnectionError, SocketDisconnected) as exc:
+            self._recover(exc)
+
+    def send_many(self, messages):
+        messages = list(messages)
+        for message in messages:
+            self._track_subscription(message)
+        return super(ResilientStreamingAPIClient, self).send_many(messages)
+
+    def _track_subscription(self, message):
+        if isinstance(message, seto.MarketSubscribe):
+            self.subscriptions.add(message.market_id)
+        elif isinstance(message, seto.MarketUnsubscribe):
+            self.subscriptions.discard(message.market_id)
+
+    def backoff(self, attempt):
+        "Seconds to wait before attempt number `attempt`, counted from 0"
+        if attempt == 0:
+            return 0.0
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+        return delay * (0.5 + _random() / 2)
+
+    def _recover(self, exc):
+        "Reconnect after `exc`, or raise it if the session isn't meant to be connected"
+        if self._reconnecting or not self.logged_in:
+            raise exc
+        self.logger.warning('connection lost: %s', exc)
+        self.reconnect()
+
+    def reconnect(self):
+        """
+        Log in again, resuming from the last processed account sequence.
+
+        :raises: The error of the last attempt after :attr:`max_attempts` attempts, and
+            :class:`smarkets.streaming_api.exceptions.LoginError` straight away
+        """
+        stats = self.reconnect_stats
+        started = _monotonic()
+        attempt = 0
+        self._reconnecting = True
+        try:
+            while True:
+                _sleep(self.backoff(attempt))
+                attempt += 1
+                self.session.disconnect()
+                self.logger.info('reconnecting, attempt %d, account sequence %r', attempt,
+                                 self.session.account_sequence)
+                try:
+                    self.login()
+                    if self.subscriptions:
+                        self.session.send_many(
+                            [seto.MarketSubscribe(market_id=market_id)
+                             for market_id in sorted(self.subscriptions)])
+                        self.session.flush()
+                    break
+                except (ConnectionError, SocketDisconnected, LoginTimeout) as exc:
+                    stats.failed_attempts += 1
+                    if self.max_attempts is not None and attempt >= self.max_attempts:
+                        self.logger.error('giving up reconnecting after %d attempts', attempt)
+                        raise
+                    self.logger.info('reconnecting failed: %s', exc)
+        finally:
+            self._reconnecting = False
+        duration = _monotonic() - started
+        stats.reconnects += 1
+        stats.last_duration = duration
+        stats.durations.add(duration)
+        self.logger.info('reconnected in %.3fs after %d attempts', duration, attempt)
+        self.reconnected(duration=duration, attempts=attempt)
+
+    def _build_dispatch_table(self):
+        super(ResilientStreamingAPIClient, self)._build_dispatch_table()
+        # Account payloads are parsed to keep track of the account sequence
+        self._wanted_payloads = self._wanted_payloads.union(
+            (seto_type, None) for seto_type in _ACCOUNT_FIELDS)
+
+    def _dispatch(self, frame):
+        name = super(ResilientStreamingAPIClient, self)._dispatch(frame)
+        message = frame.protobuf
+        field = _ACCOUNT_FIELDS.get(message.type)
+        if field is not None:
+            account_message = getattr(message, field)
+            sequence = account_message.account_sequence_64 or account_message.account_sequence
+            session = self.session
+            if session.account_sequence is None or sequence > session.account_sequence:
+                session.account_sequence = sequence
+            if message.eto_payload.is_replay:
+                self.reconnect_stats.messages_replayed += 1
+        return name
@@ -0,0 +1,480 @@
+"Local stand-in for the streaming API, for load and latency testing"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import, division
+
+import errno
+import logging
+import socket
+import threading
+import time
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+from smarkets import private
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_encode, FrameDecoder
+from smarkets.streaming_api.templates import PayloadTemplate
+
+__all__ = ('ServerStats', 'StreamingServer')
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_WOULD_BLOCK_ERRNOS = frozenset((errno.EAGAIN, errno.EWOULDBLOCK))
+
+# Synthetic prices repeat after this many quotes of a contract
+_QUOTE_CYCLE = 200
+
+
+class ServerStats(object):
+
+    "Counters of a :class:`StreamingServer`"
+
+    __slots__ = ('connections', 'payloads_received', 'payloads_sent', 'quotes_sent', 'quotes_dropped',
+                 'orders_accepted', 'orders_cancelled', 'payloads_replayed')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'ServerStats(%s)' % ', '.join('%s=%d' % item for item in sorted(self.as_dict().items()))
+
+
+class _Connection(object):
+
+    "State of a client connection"
+
+    def __init__(self, sock, number):
+        self.sock = sock
+        self.number = number
+        self.decoder = FrameDecoder()
+        self.send_buffer = bytearray()
+        # Next expected sequence number of client payloads
+        self.inseq = 1
+        self.outseq = 1
+        self.logged_in = False
+        self.account = None
+        self.closing = False
+        self.markets = []
+        self.open_orders = {}
+
+
+class StreamingServer(object):
+
+    """
+    A small streaming API server speaking the real framing and payloads over plain TCP.
+
+    It handles logins (any credentials, unless `password` is given), pings, heartbeats and
+    logouts, accepts and cancels orders, and sends synthetic
+    :class:`seto.ContractQuotes` for subscribed markets to every logged in client at
+    `quote_rate` payloads per second, in bursts of `quote_burst` payloads with `quote_depth`
+    price levels on each side. Clients whose send buffer grows past
+    `max_send_buffer` bytes skip quotes, which are counted in :attr:`stats` as dropped.
+
+    Order payloads are numbered with an account sequence per username and kept, and
+    logins with an account sequence get the ones after it replayed.
+    :meth:`drop_connections` cuts clients off, to test reconnecting.
+
+    Run it in a background thread, for example against a client on the same machine::
+
+        server = StreamingServer(quote_rate=10000)
+        server.start()
+        host, port = server.address
+        settings = SessionSettings('username', 'password', host=host, port=port, ssl=False)
+        ...
+        server.stop()
+
+    or from the command line with ``python -m smarkets.streaming_api.server``.
+    """
+
+    logger = private(logging.getLogger('smarkets.streaming_api.server'))
+
+    def __init__(self, host='127.0.0.1', port=0, quote_rate=0.0, contracts_per_market=2,
+                 heartbeat_interval=None, password=None, max_send_buffer=1048576,
+                 quote_depth=1, quote_burst=1):
+        """
+        :param port: Port to listen on, 0 picks a free one, see :attr:`address`
+        :param quote_rate: Quote payloads per second sent to every subscribed client
+        :param contracts_per_market: Number of contracts quotes are generated for in every market
+        :param heartbeat_interval: Seconds between heartbeats sent to clients, None for none
+        :param password: Password clients need to log in with, None to accept any
+        :param max_send_buffer: Size of the send buffer of a client above which quotes are dropped
+        :param quote_depth: Number of bid and offer price levels in every quote payload
+        :param quote_burst: Number of quote payloads sent back to back, bursts are spaced so
+            that the average rate is `quote_rate`
+        """
+        self.quote_rate = quote_rate
+        self.contracts_per_market = contracts_per_market
+        self.heartbeat_interval = heartbeat_interval
+        self.password = password
+        self.max_send_buffer = max_send_buffer
+        self.quote_depth = quote_depth
+        self.quote_burst = quote_burst
+        self.stats = ServerStats()
+        self.selector = selectors.DefaultSelector()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(64)
+        self._listener.setblocking(False)
+        self.selector.register(self._listener, selectors.EVENT_READ, None)
+        self._connections = []
+        self._running = False
+        self._thread = None
+        self._payload = seto.Payload()
+        self._started_at = None
+        self._quote_ticks = 0
+        # Quote templates keyed by market id, contract id and step in the price cycle
+        self._quote_templates = {}
+        self._last_heartbeat = None
+        self._next_order_id = 1
+        # Order payloads sent to every username, in account sequence order
+        self._journals = {}
+        self._dropping = False
+
+    @property
+    def address(self):
+        "(host, port) the server listens on"
+        return self._listener.getsockname()[:2]
+
+    @property
+    def connections(self):
+        "Number of open client connections"
+        return len(self._connections)
+
+    def start(self):
+        "Serve from a daemon thread"
+        self._thread = threading.Thread(target=self.serve_forever, name='StreamingServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop serving, close all connections and wait for the serving thread"
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def close(self):
+        for conn in list(self._connections):
+            self._close(conn)
+        if self._listener is not None:
+            self.selector.unregister(self._listener)
+            self._listener.close()
+            self._listener = None
+
+    def drop_connections(self):
+        "Close all client connections without logging them out, from any thread"
+        self._dropping = True
+
+    def serve_forever(self, poll_interval=0.05):
+        "Serve until :meth:`stop` is called"
+        self._running = True
+        while self._running:
+            self.run_once(poll_interval)
+
+    def run_once(self, timeout=0.05):
+        """
+        Wait for at most `timeout` seconds for sockets to become ready, handle them and send
+        the quotes and heartbeats which are due.
+        """
+        now = _monotonic()
+        if self._started_at is None:
+            self._started_at = self._last_heartbeat = now
+        if self.quote_rate:
+            timeout = min(timeout, max(0.0, self._next_quote_at() - now))
+        for key, mask in self.selector.select(timeout):
+            if key.data is None:
+                self._accept()
+                continue
+            conn = key.data
+            if mask & selectors.EVENT_READ:
+                self._read(conn)
+            if mask & selectors.EVENT_WRITE and conn.sock is not None:
+                self._write(conn)
+        now = _monotonic()
+        if self.quote_rate:
+            self._send_quotes(now)
+        if self.heartbeat_interval is not None and now - self._last_heartbeat >= self.heartbeat_interval:
+            self._last_heartbeat = now
+            for conn in self._connections:
+                if conn.logged_in:
+                    self._send_eto(conn, eto.PAYLOAD_HEARTBEAT)
+        if self._dropping:
+            self._dropping = False
+            for conn in list(self._connections):
+                self._close(conn)
+        for conn in list(self._connections):
+            if conn.send_buffer:
+                self._write(conn)
+            elif conn.closing:
+                self._close(conn)
+
+    def _accept(self):
+        try:
+            sock, address = self._listener.accept()
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK_ERRNOS:
+                return
+            raise
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stats.connections += 1
+        conn = _Connection(sock, self.stats.connections)
+        self._connections.append(conn)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        self.logger.info('accepted connection %d from %s:%s', conn.number, *address[:2])
+
+    def _close(self, conn):
+        if conn.sock is None:
+            return
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        conn.sock = None
+        self._connections.remove(conn)
+        self.logger.info('closed connection %d', conn.number)
+
+    def _read(self, conn):
+        decoder = conn.decoder
+        try:
+            received = conn.sock.recv_into(decoder.reserve(65536), 65536)
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK_ERRNOS:
+                return
+            self.logger.info('error reading from connection %d: %r', conn.number, e)
+            self._close(conn)
+            return
+        if not received:
+            self._close(conn)
+            return
+        decoder.commit(received)
+        payload = seto.Payload()
+        for data in decoder:
+            payload.ParseFromString(data.tobytes())
+            self.stats.payloads_received += 1
+            self._handle(conn, payload)
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.send_buffer)
+        except socket.error as e:
+            if e.errno not in _WOULD_BLOCK_ERRNOS:
+                self.logger.info('error writing to connection %d: %r', conn.number, e)
+                self._close(conn)
+            return
+        del conn.send_buffer[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.send_buffer else 0)
+        self.selector.modify(conn.sock, events, conn)
+
+    def _handle(self, conn, payload):
+        seq = payload.eto_payload.seq
+        if seq != conn.inseq:
+            self.logger.warning(
+                'connection %d sent sequence %d instead of %d', conn.number, seq, conn.inseq)
+        conn.inseq = seq + 1
+        seto_type = payload.type
+        if seto_type == seto.PAYLOAD_LOGIN:
+            self._login(conn, payload.login)
+        elif not conn.logged_in:
+            self.logger.warning('connection %d sent a payload before logging in', conn.number)
+            self._logout(conn, eto.LOGOUT_LOGIN_NOT_FIRST_SEQ)
+        elif seto_type == seto.PAYLOAD_ETO:
+            eto_type = payload.eto_payload.type
+            if eto_type == eto.PAYLOAD_PING:
+                self._send_eto(conn, eto.PAYLOAD_PONG)
+            elif eto_type == eto.PAYLOAD_LOGOUT:
+                self._logout(conn, eto.LOGOUT_CONFIRMATION)
+        elif seto_type == seto.PAYLOAD_MARKET_SUBSCRIBE:
+            market_id = payload.market_subscribe.market_id
+            if market_id not in conn.markets:
+                conn.markets.append(market_id)
+        elif seto_type == seto.PAYLOAD_MARKET_UNSUBSCRIBE:
+            market_id = payload.market_unsubscribe.market_id
+            if market_id in conn.markets:
+                conn.markets.remove(market_id)
+        elif seto_type == seto.PAYLOAD_ORDER_CREATE:
+            self._accept_order(conn, seq, payload.order_create)
+        elif seto_type == seto.PAYLOAD_ORDER_CANCEL:
+            self._cancel_order(conn, payload.order_cancel)
+
+    def _login(self, conn, login):
+        if self.password is not None and login.password != self.password:
+            self.logger.info('connection %d failed to log in as %r', conn.number, login.username)
+            self._logout(conn, eto.LOGOUT_UNAUTHORISED)
+            return
+        conn.logged_in = True
+        conn.account = login.username
+        out = self._out_payload(seto.PAYLOAD_ETO)
+        out.eto_payload.type = eto.PAYLOAD_LOGIN_RESPONSE
+        out.eto_payload.login_response.session = 'session-%d' % conn.number
+        out.eto_payload.login_response.reset = conn.inseq
+        self._send(conn, out)
+        if login.HasField('account_sequence_64') or login.HasField('account_sequence'):
+            resume_from = login.account_sequence_64 or login.account_sequence
+            for payload in self._journals.get(conn.account, [])[resume_from:]:
+                payload.eto_payload.is_replay = True
+                self._send(conn, payload)
+                self.stats.payloads_replayed += 1
+
+    def _logout(self, conn, reason):
+        out = self._out_payload(seto.PAYLOAD_ETO)
+        out.eto_payload.type = eto.PAYLOAD_LOGOUT
+        out.eto_payload.logout.reason = reason
+        self._send(conn, out)
+        conn.logged_in = False
+        conn.closing = True
+
+    def _accept_order(self, conn, seq, order):
+        order_id = self._next_order_id
+        self._next_order_id += 1
+        conn.open_orders[order_id] = order.reference
+        out = self._out_payload(seto.PAYLOAD_ORDER_ACCEPTED)
+        accepted = out.order_accepted
+        accepted.seq = seq
+        accepted.order_id = order_id
+        accepted.reference = order.reference
+        accepted.price = order.price
+        accepted.quantity = order.quantity
+        accepted.market_id = order.market_id
+        accepted.contract_id = order.contract_id
+        accepted.side = order.side
+        self.stats.orders_accepted += 1
+        self._send_account(conn, out, accepted)
+
+    def _cancel_order(self, conn, cancel):
+        if conn.open_orders.pop(cancel.order_id, None) is None:
+            out = self._out_payload(seto.PAYLOAD_ORDER_CANCEL_REJECTED)
+            out.order_cancel_rejected.order_id = cancel.order_id
+            out.order_cancel_rejected.reference = cancel.reference
+            out.order_cancel_rejected.reason = seto.ORDER_CANCEL_REJECTED_NOT_FOUND
+            self._send_account(conn, out, out.order_cancel_rejected)
+        else:
+            out = self._out_payload(seto.PAYLOAD_ORDER_CANCELLED)
+            out.order_cancelled.order_id = cancel.order_id
+            out.order_cancelled.reference = cancel.reference
+            out.order_cancelled.reason = seto.ORDER_CANCELLED_MEMBER_REQUESTED
+            self.stats.orders_cancelled += 1
+            self._send_account(conn, out, out.order_cancelled)
+
+    def _next_quote_at(self):
+        return self._started_at + (self._quote_ticks + self.quote_burst) / self.quote_rate
+
+    def _send_quotes(self, now):
+        "Send the quote payloads which are due since the last round"
+        bursts = int((now - self._started_at) * self.quote_rate / self.quote_burst)
+        due = bursts * self.quote_burst - self._quote_ticks
+        if due <= 0:
+            return
+        receivers = [conn for conn in self._connections if conn.logged_in and conn.markets]
+        if not receivers:
+            # Nobody to send them to, skip straight to the current tick
+            self._quote_ticks += due
+            return
+        for tick in range(self._quote_ticks, self._quote_ticks + due):
+            for conn in receivers:
+                if len(conn.send_buffer) > self.max_send_buffer:
+                    self.stats.quotes_dropped += 1
+                    continue
+                self._send_quote(conn, tick)
+                self.stats.quotes_sent += 1
+        self._quote_ticks += due
+
+    def _send_quote(self, conn, tick):
+        "Send the quotes for `tick`, serialised from a template so only the sequence number is encoded"
+        market_id = conn.markets[tick % len(conn.markets)]
+        contract_id = tick // len(conn.markets) % self.contracts_per_market + 1
+        key = (market_id, contract_id, tick % _QUOTE_CYCLE)
+        template = self._quote_templates.get(key)
+        if template is None:
+            template = self._quote_templates[key] = PayloadTemplate(self._quote(*key))
+        frame_encode(conn.send_buffer, template.serialize(conn.outseq))
+        conn.outseq += 1
+        self.stats.payloads_sent += 1
+
+    def _quote(self, market_id, contract_id, step):
+        "Synthetic quotes for one contract, walking prices around the middle of the book"
+        out = self._out_payload(seto.PAYLOAD_CONTRACT_QUOTES)
+        quotes = out.contract_quotes
+        quotes.market_id = market_id
+        quotes.contract_id = contract_id
+        price = 5000 + step * 10
+        for level in range(self.quote_depth):
+            bid = quotes.bids.add()
+            bid.price = price - 50 * (level + 1)
+            bid.quantity = 100000 + (step + level) * 7
+            offer = quotes.offers.add()
+            offer.price = price + 50 * (level + 1)
+            offer.quantity = 100000 + (step + level) * 11
+        # Seq is patched in by the template
+        out.eto_payload.seq = 0
+        return out
+
+    def _send_account(self, conn, out, message):
+        "Send an order payload, numbered and kept for replays"
+        journal = self._journals.setdefault(conn.account, [])
+        message.account_sequence_64 = len(journal) + 1
+        self._send(conn, out)
+        kept = seto.Payload()
+        kept.CopyFrom(out)
+        journal.append(kept)
+
+    def _send_eto(self, conn, eto_type):
+        out = self._out_payload(seto.PAYLOAD_ETO)
+        out.eto_payload.type = eto_type
+        self._send(conn, out)
+
+    def _out_payload(self, seto_type):
+        out = self._payload
+        out.Clear()
+        out.type = seto_type
+        return out
+
+    def _send(self, conn, out):
+        out.eto_payload.seq = conn.outseq
+        conn.outseq += 1
+        frame_encode(conn.send_buffer, out.SerializeToString())
+        self.stats.payloads_sent += 1
+
+
+def main(argv=None):
+    "Run a server from the command line"
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local stand-in for the Smarkets streaming API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3801)
+    parser.add_argument('--quote-rate', type=float, default=1000.0,
+                        help='quote payloads per second per subscribed client')
+    parser.add_argument('--contracts-per-market', type=int, default=2)
+    parser.add_argument('--quote-depth', type=int, default=1, help='price levels on each side of a quote')
+    parser.add_argument('--quote-burst', type=int, default=1, help='quote payloads sent back to back')
+    parser.add_argument('--heartbeat-interval', type=float, default=None)
+    parser.add_argument('--password', default=None)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = StreamingServer(
+        host=args.host, port=args.port, quote_rate=args.quote_rate,
+        contracts_per_market=args.contracts_per_market, heartbeat_interval=args.heartbeat_interval,
+        password=args.password, quote_depth=args.quote_depth, quote_burst=args.quote_burst)
+    server.logger.info('listening on %s:%s', *server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        server.logger.info('%r', server.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,83 @@
 #
 # This module is released under the MIT License:
 # http://www.opensource.org/licenses/mit-license.php
+import errno
 import logging
+import os
 import socket
 import ssl
-from collections import namedtuple
+import struct
+import sys
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from itertools import islice
 
 from google.protobuf.text_format import MessageToString
 
 from smarkets import private
 from smarkets.errors import reraise
 from smarkets.lazy import LazyCall
+from smarkets.signal import Signal
 from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import DIRECTION_IN, DIRECTION_OUT
 from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
-from smarkets.streaming_api.framing import frame_decode_all, frame_encode
+from smarkets.streaming_api.framing import frame_encode, frame_header, FrameDecoder, peek_payload_header
+from smarkets.streaming_api.templates import HEARTBEAT_TEMPLATE, REPLAY_TEMPLATE
+from smarkets.streaming_api.utils import set_payload_message
+
+_monotonic = getattr(time, 'monotonic', time.time)
+_monotonic_ns = getattr(time, 'monotonic_ns', None) or (lambda: int(_monotonic() * 1e9))
+_time_ns = getattr(time, 'time_ns', None) or (lambda: int(time.time() * 1e9))
+
+# Only flush() sends buffered payloads
+FLUSH_POLICY_EXPLICIT = 0
+# Every payload is sent as soon as it's buffered
+FLUSH_POLICY_IMMEDIATE = 1
+# Buffered payloads are sent once there's at least flush_threshold bytes of them
+FLUSH_POLICY_THRESHOLD = 2
+# Buffered payloads are sent once the oldest of them has waited for flush_window
+# seconds or there's at least flush_threshold bytes of them
+FLUSH_POLICY_WINDOW = 3
+
+# Market data payloads which can be shed while the inbound buffers are over a high-water
+# mark, see SessionSettings.shed_payload_types. Quotes of markets which had some shed are
+# stale until they're subscribed to again.
+SHED_MARKET_DATA = frozenset([seto.PAYLOAD_MARKET_QUOTES, seto.PAYLOAD_CONTRACT_QUOTES])
+
+# Maximum number of buffers passed to a single sendmsg() call
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+
+# Errors raised by non-blocking sockets when an operation would have to block
+_WOULD_BLOCK_ERRNOS = frozenset((errno.EAGAIN, errno.EWOULDBLOCK))
+_SSL_WOULD_BLOCK_ERRORS = tuple(
+    getattr(ssl, name) for name in ('SSLWantReadError', 'SSLWantWriteError') if hasattr(ssl, name))
+
+# Socket option asking Linux for the time received data arrived at, which is then passed as
+# a control message of the same type. The socket module doesn't define it, 35 is the value
+# on all common architectures.
+_SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35 if sys.platform.startswith('linux') else None)
+# struct timespec in the control message
+_TIMESPEC = struct.Struct('@ll')
+_TIMESTAMP_CMSG_SPACE = socket.CMSG_SPACE(_TIMESPEC.size) if hasattr(socket, 'CMSG_SPACE') else 0
+
+
+def _would_block(exc):
+    "Check if a socket error only means that a non-blocking call can't proceed yet"
+    return isinstance(exc, _SSL_WOULD_BLOCK_ERRORS) or getattr(exc, 'errno', None) in _WOULD_BLOCK_ERRNOS
+
+
+def _without_credentials(data):
+    "Serialised copy of a login payload with the username, password and session token blanked out"
+    login = seto.Payload()
+    login.ParseFromString(data)
+    login.login.ClearField('username')
+    login.login.ClearField('password')
+    login.login.ClearField('cookie')
+    return login.SerializeToString()
 
 
 class SessionSettings(object):
@@ -24,7 +88,12 @@ class SessionSettings(object):
 
     def __init__(self, username=None, password=None, token=None,
                  host='stream.smarkets.com', port=3801, ssl=True,
-                 socket_timeout=30, ssl_kwargs=None, tcp_nodelay=True):
+                 socket_timeout=30, ssl_kwargs=None, tcp_nodelay=True,
+                 read_buffer_capacity=262144, borrowed_frames=False,
+                 flush_policy=FLUSH_POLICY_EXPLICIT, flush_threshold=16384, flush_window=0.0002,
+                 vectored_flush=False, kernel_timestamps=False,
+                 inbound_high_water_bytes=None, inbound_high_water_frames=None, shed_payload_types=(),
+                 reorder_capacity=1024, reorder_timeout=5.0):
         self.username = username
         self.password = password
         self.token = token
@@ -39,10 +108,156 @@ class SessionSettings(object):
         # testing to determine whether a single large recv() system
         # call is worse than many smaller ones.
         self.read_chunksize = 65536  # 64k
+        # Initial size of the preallocated receive buffer, it grows
+        # only if a frame doesn't fit into it
+        self.read_buffer_capacity = read_buffer_capacity
+        # Reuse payload objects and parse straight from the receive
+        # buffer, see Session.next_frames for what it means for consumers
+        self.borrowed_frames = borrowed_frames
+        # When buffered payloads are sent without waiting for Session.flush,
+        # one of the FLUSH_POLICY_* constants
+        self.flush_policy = flush_policy
+        self.flush_threshold = flush_threshold
+        self.flush_window = flush_window
+        # Queue frames separately and send them with sendmsg() instead of
+        # copying them into one buffer, only possible without SSL
+        self.vectored_flush = vectored_flush
+        # Take the time data was received at from the kernel (SO_TIMESTAMPNS) instead of
+        # when reading it returned, so frames are timed from their arrival. Only possible
+        # on Linux without SSL, see Frame.received_at
+        self.kernel_timestamps = kernel_timestamps
+        # Stop reading from the socket once this many bytes or complete frames received
+        # aren't handled yet, None for no limit. See Session.check_inbound
+        self.inbound_high_water_bytes = inbound_high_water_bytes
+        self.inbound_high_water_frames = inbound_high_water_frames
+        # seto payload types skipped without being parsed or dispatched while the session
+        # is overloaded, for example SHED_MARKET_DATA
+        self.shed_payload_types = frozenset(shed_payload_types)
+        # Maximum number of payloads received ahead of a gap in the incoming sequence which
+        # are kept until it's filled, see Session.next_frames
+        self.reorder_capacity = reorder_capacity
+        # Seconds a gap is waited for at most, None to wait until reorder_capacity payloads
+        # are kept
+        self.reorder_timeout = reorder_timeout
+
+
+class Frame(namedtuple('Frame', 'bytes protobuf received_at')):
+
+    """
+    A received payload.
+
+    `received_at` is the :func:`time.monotonic_ns` time the last bytes of the payload were
+    received at, by the kernel with :attr:`SessionSettings.kernel_timestamps`. It's only
+    tracked with kernel timestamps or while timing latency, otherwise it's None.
+    """
+
+
+Frame.__new__.__defaults__ = (None,)
+
+
+class FlushStats(object):
+
+    "Counts how well payloads are coalesced into socket writes"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.payloads = 0
+        self.flushes = 0
+        self.bytes = 0
+
+    @property
+    def payloads_per_flush(self):
+        """
+        Average number of payloads sent with one socket write.
+
+        :rtype: float
+        """
+        return self.payloads / float(self.flushes) if self.flushes else 0.0
+
+    def __repr__(self):
+        return '%s(payloads=%d, flushes=%d, bytes=%d)' % (
+            type(self).__name__, self.payloads, self.flushes, self.bytes)
+
+
+class InboundStats(object):
+
+    """
+    Counts how full the inbound buffers get, only tracked with high-water marks set in
+    :class:`SessionSettings`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.overloads = 0
+        self.payloads_shed = 0
+        self.max_buffered_bytes = 0
+        self.max_buffered_frames = 0
+
+    def __repr__(self):
+        return '%s(overloads=%d, payloads_shed=%d, max_buffered_bytes=%d, max_buffered_frames=%d)' % (
+            type(self).__name__, self.overloads, self.payloads_shed, self.max_buffered_bytes,
+            self.max_buffered_frames)
+
+
+class SequenceStats(object):
+
+    "Counts irregularities in the incoming sequence"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.gaps = 0
+        self.gaps_skipped = 0
+        self.payloads_lost = 0
+        self.payloads_reordered = 0
+        self.duplicates = 0
+        self.max_reorder_depth = 0
+
+    def __repr__(self):
+        return ('%s(gaps=%d, gaps_skipped=%d, payloads_lost=%d, payloads_reordered=%d, duplicates=%d, '
+                'max_reorder_depth=%d)') % (
+            type(self).__name__, self.gaps, self.gaps_skipped, self.payloads_lost,
+            self.payloads_reordered, self.duplicates, self.max_reorder_depth)
+
+
+class _PayloadQueue(deque):
+
+    "Queue of received payloads keeping count of their total size in `nbytes`"
+
+    def __init__(self):
+        super(_PayloadQueue, self).__init__()
+        self.nbytes = 0
+
+    def append(self, data):
+        super(_PayloadQueue, self).append(data)
+        self.nbytes += len(data)
+
+    def appendleft(self, data):
+        super(_PayloadQueue, self).appendleft(data)
+        self.nbytes += len(data)
+
+    def extend(self, payloads):
+        for data in payloads:
+            self.append(data)
 
+    def pop(self):
+        data = super(_PayloadQueue, self).pop()
+        self.nbytes -= len(data)
+        return data
 
-class Frame(namedtuple('Frame', 'bytes protobuf')):
-    pass
+    def popleft(self):
+        data = super(_PayloadQueue, self).popleft()
+        self.nbytes -= len(data)
+        return data
+
+    def clear(self):
+        super(_PayloadQueue, self).clear()
+        self.nbytes = 0
 
 
 class Session(object):
@@ -51,6 +266,11 @@ class Session(object):
     logger = private(logging.getLogger('smarkets.session'))
     flush_logger = private(logging.getLogger('smarkets.session.flush'))
 
+    # Number of payload objects reused in borrowed frames mode
+    BORROWED_PAYLOAD_POOL_SIZE = 4
+    # Part of the inbound high-water marks the buffers have to drop to for reading to resume
+    INBOUND_RESUME_RATIO = 0.5
+
     def __init__(self, settings, inseq=1, outseq=1, account_sequence=None):
         """
         :type setting: :class:`SessionSettings`
@@ -67,8 +287,51 @@ class Session(object):
         self.buf_outseq = outseq
         self.out_payload = seto.Payload()
         self.send_buffer = bytearray()
-        self.read_buffer = bytearray()
-        self.buffered_incoming_payloads = []
+        # Bytes before this offset in send_buffer are sent already
+        self._send_offset = 0
+        # Frame parts waiting for a vectored flush
+        self._send_chunks = deque()
+        self._send_chunks_size = 0
+        self._vectored = settings.vectored_flush and not settings.ssl and hasattr(socket.socket, 'sendmsg')
+        self.flush_stats = FlushStats()
+        self._corked = 0
+        self._unflushed_since = None
+        # When bytes were last written to the socket
+        self.last_sent_at = None
+        # A heartbeat reply is buffered and wasn't flushed yet
+        self.heartbeat_pending = False
+        self.decoder = FrameDecoder(settings.read_buffer_capacity)
+        self.buffered_incoming_payloads = _PayloadQueue()
+        # Reading is paused because the inbound buffers went over a high-water mark
+        self.overloaded = False
+        # Fired with `overloaded`, `buffered_bytes` and `buffered_frames` keyword arguments
+        # whenever overloaded changes
+        self.overload = Signal()
+        self.inbound_stats = InboundStats()
+        # Payloads received ahead of the incoming sequence, seq -> (bytes, received_at)
+        self._reorder = {}
+        # When the incoming sequence last got stuck on a gap
+        self._gap_opened_at = None
+        # Sequence numbers of the heartbeats in _reorder, which were answered on arrival
+        self._answered_heartbeats = set()
+        # Fired with `first` and `last` sequence numbers missing and `skipped`, True when the
+        # session stopped waiting for them, whenever there's a gap in the incoming sequence
+        self.gap = Signal()
+        self.sequence_stats = SequenceStats()
+        self._payload_pool = [seto.Payload() for _ in range(self.BORROWED_PAYLOAD_POOL_SIZE)]
+        self._payload_pool_index = 0
+        # A :class:`smarkets.streaming_api.capture.CaptureRecorder` recording all payloads
+        self.recorder = None
+        # A :class:`smarkets.streaming_api.latency.LatencyStats` timing incoming payloads
+        self.latency = None
+        # When the data of the last read was received, only tracked while recording
+        self._received_at = 0.0
+        # Bytes received by the decoder in total and when in nanoseconds, for every read
+        # with bytes which haven't been decoded yet, only tracked while timing latency or
+        # with kernel timestamps
+        self._read_times = deque()
+        # When the last frame from next_frames was received, taken out of the buffer and parsed
+        self._frame_times = None
 
     @property
     def raw_socket(self):
@@ -80,7 +343,18 @@ class Session(object):
 
     @property
     def output_buffer_size(self):
-        return len(self.send_buffer)
+        return len(self.send_buffer) - self._send_offset + self._send_chunks_size
+
+    @property
+    def buffered_bytes(self):
+        "Number of received bytes which weren't handled yet"
+        # Checked for every frame handled while overloaded, so neither is summed up here
+        return self.decoder.pending_bytes + self.buffered_incoming_payloads.nbytes
+
+    @property
+    def buffered_frames(self):
+        "Number of complete frames received which weren't handled yet"
+        return len(self.buffered_incoming_payloads) + self.decoder.frame_count
 
     @property
     def connected(self):
@@ -90,38 +364,51 @@ class Session(object):
     def connect(self):
         "Connects to the API and logs in if not already connected"
         if self.socket.connect():
-            self._clear_send_buffer()
-            # Reset separate outgoing buffer sequence number
-            self.buf_outseq = 1
-            login = self.out_payload
-            login.Clear()
-            login.type = seto.PAYLOAD_LOGIN
-            login.eto_payload.type = eto.PAYLOAD_LOGIN
-            if self.settings.token:
-                login.login.cookie = self.settings.token.encode('utf-8')
-            else:
-                login.login.username = self.settings.username
-                login.login.password = self.settings.password
-            self.logger.info("sending login payload")
-            if self.account_sequence is not None:
-                self.logger.info("Attempting to resume session, account sequence %d",
-                                 self.account_sequence)
-                login.login.account_sequence = 0
-                login.login.account_sequence_64 = self.account_sequence
-
-            self.send()
+            self._send_login()
             self.flush()
 
+    def _send_login(self):
+        "Buffer the login payload for a fresh connection"
+        self._clear_send_buffer()
+        # Reset separate outgoing buffer sequence number
+        self.buf_outseq = 1
+        login = self.out_payload
+        login.Clear()
+        login.type = seto.PAYLOAD_LOGIN
+        login.eto_payload.type = eto.PAYLOAD_LOGIN
+        if self.settings.token:
+            login.login.cookie = self.settings.token.encode('utf-8')
+        else:
+            login.login.username = self.settings.username
+            login.login.password = self.settings.password
+        self.logger.info("sending login payload")
+        if self.account_sequence is not None:
+            self.logger.info("Attempting to resume session, account sequence %d",
+                             self.account_sequence)
+            login.login.account_sequence = 0
+            login.login.account_sequence_64 = self.account_sequence
+
+        self.send()
+
     def _clear_send_buffer(self):
-        if self.send_buffer:
+        if self.output_buffer_size:
             self.logger.warn(
                 'Clearing non-empty buffer, %d bytes will be lost: %r',
-                len(self.send_buffer), self.send_buffer,
+                self.output_buffer_size, self.send_buffer[self._send_offset:] + b''.join(self._send_chunks),
             )
         self.send_buffer = bytearray()
+        self._send_offset = 0
+        self._send_chunks.clear()
+        self._send_chunks_size = 0
+        self._unflushed_since = None
 
     def logout(self):
         "Disconnects from the API"
+        self._send_logout()
+        self.flush()
+
+    def _send_logout(self):
+        "Buffer the logout payload"
         logout = self.out_payload
         logout.Clear()
         logout.type = seto.PAYLOAD_ETO
@@ -129,38 +416,348 @@ class Session(object):
         logout.eto_payload.logout.reason = eto.LOGOUT_NONE
         self.logger.info("sending logout payload")
         self.send()
-        self.flush()
 
     def disconnect(self):
         "Disconnects from the API"
         self.socket.disconnect()
+        self._reset_connection_state()
+
+    def _reset_connection_state(self):
+        "Forget the state of the connection which is gone"
         self.inseq = self.init_inseq
         self.outseq = self.init_outseq
+        # Whatever was received, down to a frame cut off by the disconnection, would be
+        # sequenced against the next connection
+        self.decoder.clear()
+        self.buffered_incoming_payloads.clear()
+        self._read_times.clear()
+        self._reorder.clear()
+        self._answered_heartbeats.clear()
+        if self.overloaded:
+            # There's nothing to hold back anymore
+            self._set_overloaded(False, self.buffered_bytes, self.buffered_frames)
 
     def send(self):
         "Serialise, sequence, add header, and send payload"
         self.logger.debug(
             "buffering payload: %s",
             LazyCall(MessageToString, self.out_payload))
-        sent_seq = self.buf_outseq
-        self.out_payload.eto_payload.seq = sent_seq
-        frame_encode(self.send_buffer, self.out_payload.SerializeToString())
+        self.out_payload.eto_payload.seq = self.buf_outseq
+        if not self.output_buffer_size:
+            self._unflushed_since = _monotonic()
+        self._buffer_frame(self.out_payload.SerializeToString(), self.buf_outseq)
         self.buf_outseq += 1
+        self.flush_stats.payloads += 1
+        self._auto_flush()
+
+    def send_many(self, messages):
+        """
+        Serialise, sequence and buffer a batch of messages in one go.
+
+        The flush policy is applied once, after the whole batch is buffered. The batch is
+        serialised before anything is buffered, so if a message can't be sent none of them is.
+
+        :param messages: seto messages, for example :class:`seto.OrderCreate` or :class:`seto.OrderCancel`
+        :return: Number of buffered messages
+        :rtype: int
+        """
+        payload = self.out_payload
+        first_seq = seq = self.buf_outseq
+        serialised = []
+        for message in messages:
+            payload.Clear()
+            set_payload_message(payload, message)
+            payload.eto_payload.seq = seq
+            serialised.append(payload.SerializeToString())
+            seq += 1
+        count = len(serialised)
+        if not count:
+            return 0
+        if not self.output_buffer_size:
+            self._unflushed_since = _monotonic()
+        buffer_frame = self._buffer_frame
+        for seq, data in enumerate(serialised, first_seq):
+            buffer_frame(data, seq)
+        self.logger.debug("buffered %d payloads", count)
+        self.buf_outseq = first_seq + count
+        self.flush_stats.payloads += count
+        self._auto_flush()
+        return count
+
+    def send_template(self, template, *values):
+        """
+        Sequence and buffer a payload serialised from a template.
+
+        :type template: :class:`smarkets.streaming_api.templates.PayloadTemplate`
+        :param values: Values of the template fields, in order
+        """
+        seq = self.buf_outseq
+        self.logger.debug("buffering templated payload %d: %r", seq, values)
+        if not self.output_buffer_size:
+            self._unflushed_since = _monotonic()
+        self._buffer_frame(template.serialize(seq, *values), seq)
+        self.buf_outseq = seq + 1
+        self.flush_stats.payloads += 1
+        self._auto_flush()
+
+    def _buffer_frame(self, payload, seq):
+        "Frame a serialised payload with sequence number `seq` into the send buffer"
+        if self.recorder is not None:
+            recorded = payload
+            header = peek_payload_header(payload)
+            if header is not None and header[0] == seto.PAYLOAD_LOGIN:
+                # Captures are shared and replayed, credentials stay out of them
+                recorded = _without_credentials(payload)
+            self.recorder.record(DIRECTION_OUT, seq, recorded, _monotonic())
+        if self._vectored:
+            header, padding = frame_header(len(payload))
+            chunks = self._send_chunks
+            chunks.append(header)
+            chunks.append(payload)
+            if padding:
+                chunks.append(padding)
+            self._send_chunks_size += len(header) + len(payload) + len(padding)
+        else:
+            frame_encode(self.send_buffer, payload)
 
     def flush(self):
         "Flush payloads to the socket"
-        self.flush_logger.debug("Flushing %d bytes", len(self.send_buffer))
-        if self.send_buffer:
-            bytes_sent = self.socket.send(self.send_buffer)
-            self.flush_logger.debug("Flushed %d bytes out of %d", bytes_sent, len(self.send_buffer))
-            self.send_buffer[0:] = self.send_buffer[bytes_sent:]
+        self._write()
+
+    def _write(self):
+        "Write as much of the send buffer to the socket as possible"
+        pending = self.output_buffer_size
+        self.flush_logger.debug("Flushing %d bytes", pending)
+        if not pending:
+            return
+        if self._vectored:
+            bytes_sent = self.socket.sendmsg(list(islice(self._send_chunks, _IOV_MAX)))
+            self._consume_chunks(bytes_sent)
+        else:
+            bytes_sent = self._send_buffer_tail()
+            self._consume_buffer(bytes_sent)
+        self.flush_logger.debug("Flushed %d bytes out of %d", bytes_sent, pending)
+        self.flush_stats.flushes += 1
+        self.flush_stats.bytes += bytes_sent
+        if bytes_sent:
+            self.last_sent_at = _monotonic()
+        if not self.output_buffer_size:
+            self._unflushed_since = None
+            self.heartbeat_pending = False
+
+    def _send_buffer_tail(self):
+        "Send what's left of the send buffer without copying it"
+        offset = self._send_offset
+        if not offset:
+            return self.socket.send(self.send_buffer)
+        view = memoryview(self.send_buffer)[offset:]
+        try:
+            return self.socket.send(view)
+        finally:
+            # The buffer can't be resized while it's exported
+            if hasattr(view, 'release'):
+                view.release()
+
+    def _consume_buffer(self, byte_count):
+        "Move past `byte_count` sent bytes of the send buffer, compacting it now and then"
+        buffer = self.send_buffer
+        offset = self._send_offset + byte_count
+        if offset == len(buffer):
+            del buffer[:]
+            offset = 0
+        elif offset > len(buffer) // 2:
+            # Moving what's left is cheap compared to what was sent since the last compaction
+            del buffer[:offset]
+            offset = 0
+        self._send_offset = offset
+
+    def _consume_chunks(self, byte_count):
+        "Drop `byte_count` sent bytes off the front of the vectored send queue"
+        chunks = self._send_chunks
+        self._send_chunks_size -= byte_count
+        while byte_count:
+            chunk_size = len(chunks[0])
+            if chunk_size <= byte_count:
+                chunks.popleft()
+                byte_count -= chunk_size
+            else:
+                chunks[0] = memoryview(chunks[0])[byte_count:]
+                byte_count = 0
+
+    def cork(self):
+        "Hold buffered payloads back, whatever the flush policy, until :meth:`uncork`"
+        self._corked += 1
+
+    def uncork(self):
+        "Undo one :meth:`cork` call, the last one flushes everything buffered in the meantime"
+        self._corked -= 1
+        if not self._corked and self.output_buffer_size:
+            self._write()
+
+    @contextmanager
+    def corked(self):
+        """
+        Coalesce a burst of payloads into as few socket writes as possible::
+
+            with session.corked():
+                for order in orders:
+                    client.send(order)
+        """
+        self.cork()
+        try:
+            yield
+        finally:
+            self.uncork()
+
+    @property
+    def flush_deadline(self):
+        """
+        Time (as returned by :func:`time.monotonic`) by which buffered payloads are due to be
+        flushed according to :attr:`SessionSettings.flush_window`, None if nothing is due.
+
+        :rtype: float or None
+        """
+        if (self._unflushed_since is None or self._corked or
+                self.settings.flush_policy != FLUSH_POLICY_WINDOW):
+            return None
+        return self._unflushed_since + self.settings.flush_window
+
+    def _auto_flush(self):
+        "Flush the send buffer if the flush policy says so"
+        policy = self.settings.flush_policy
+        if policy == FLUSH_POLICY_EXPLICIT or self._corked:
+            return
+        if (policy == FLUSH_POLICY_IMMEDIATE or
+                self.output_buffer_size >= self.settings.flush_threshold or
+                (policy == FLUSH_POLICY_WINDOW and
+                 _monotonic() - self._unflushed_since >= self.settings.flush_window)):
+            self._write()
+
+    def _flush_before_read(self):
+        "Reads may block for long, don't hold automatically flushed payloads back meanwhile"
+        if (self.settings.flush_policy != FLUSH_POLICY_EXPLICIT and not self._corked and
+                self.output_buffer_size):
+            self._write()
 
     def read(self):
-        self.read_buffer += self.socket.recv()
+        """
+        Receive data from the socket straight into the decoder buffer.
+
+        While :attr:`overloaded` it returns straight away without receiving anything, handle
+        the buffered frames for reading to resume.
+        """
+        self._flush_before_read()
+        self.receive()
 
-        messages, remaining_buffer = frame_decode_all(self.read_buffer)
-        self.buffered_incoming_payloads.extend(messages)
-        self.read_buffer = remaining_buffer
+    def receive(self):
+        "Receive data like :meth:`read`, without flushing automatically flushed payloads first"
+        if self.overloaded and self.check_inbound():
+            return
+        chunksize = self.settings.read_chunksize
+        received = self.socket.recv_into(self.decoder.reserve(chunksize), chunksize)
+        self.decoder.commit(received)
+        self._timestamp_read()
+        self.check_inbound()
+
+    def check_inbound(self):
+        """
+        Compare the inbound buffers with the high-water marks.
+
+        Going over :attr:`SessionSettings.inbound_high_water_bytes` or
+        :attr:`SessionSettings.inbound_high_water_frames` makes the session
+        :attr:`overloaded`: reading pauses and payloads of
+        :attr:`SessionSettings.shed_payload_types` are shed until the buffers drop to
+        :attr:`INBOUND_RESUME_RATIO` of both marks. Reading doesn't pause while there's no
+        complete frame to handle. :attr:`overload` is fired on every change.
+
+        It's called after every read and, while overloaded, for every frame handled. Call
+        it after putting data into the buffers in any other way.
+
+        :return: :attr:`overloaded`
+        :rtype: bool
+        """
+        settings = self.settings
+        max_bytes = settings.inbound_high_water_bytes
+        max_frames = settings.inbound_high_water_frames
+        if max_bytes is None and max_frames is None:
+            return self.overloaded
+        buffered_bytes = self.buffered_bytes
+        buffered_frames = self.buffered_frames
+        stats = self.inbound_stats
+        if buffered_bytes > stats.max_buffered_bytes:
+            stats.max_buffered_bytes = buffered_bytes
+        if buffered_frames > stats.max_buffered_frames:
+            stats.max_buffered_frames = buffered_frames
+
+        if self.overloaded:
+            ratio = self.INBOUND_RESUME_RATIO
+            if not buffered_frames or (
+                    (max_bytes is None or buffered_bytes <= max_bytes * ratio) and
+                    (max_frames is None or buffered_frames <= max_frames * ratio)):
+                self._set_overloaded(False, buffered_bytes, buffered_frames)
+        elif buffered_frames and (
+                (max_bytes is not None and buffered_bytes >= max_bytes) or
+                (max_frames is not None and buffered_frames >= max_frames)):
+            stats.overloads += 1
+            self._set_overloaded(True, buffered_bytes, buffered_frames)
+        return self.overloaded
+
+    def _set_overloaded(self, overloaded, buffered_bytes, buffered_frames):
+        self.overloaded = overloaded
+        if overloaded:
+            self.logger.warning('inbound buffers overloaded with %d bytes in %d frames, pausing reads',
+                                buffered_bytes, buffered_frames)
+            self._pause_reading()
+        else:
+            self.logger.info('inbound buffers down to %d bytes in %d frames, resuming reads',
+                             buffered_bytes, buffered_frames)
+            self._resume_reading()
+        self.overload.fire(
+            overloaded=overloaded, buffered_bytes=buffered_bytes, buffered_frames=buffered_frames)
+
+    def _pause_reading(self):
+        "Hook for transports receiving on their own, receive() checks overloaded itself"
+
+    def _resume_reading(self):
+        "Hook for transports receiving on their own"
+
+    def _timestamp_read(self):
+        "Note when the data just read was received, only tracked when something needs it"
+        kernel_timestamps = self.settings.kernel_timestamps
+        if self.recorder is None and self.latency is None and not kernel_timestamps:
+            return
+        # How long ago the kernel received the data, by the wall clock
+        age = 0
+        if kernel_timestamps:
+            kernel_received_at = getattr(self.socket, 'kernel_received_at', None)
+            if kernel_received_at is not None:
+                age = max(0, _time_ns() - kernel_received_at)
+        if self.recorder is not None:
+            self._received_at = _monotonic() - age / 1e9
+        if self.latency is not None or kernel_timestamps:
+            self._read_times.append((self.decoder.received, _monotonic_ns() - age))
+
+    def _frame_received_at(self, default):
+        "When the last bytes of the frame just taken out of the decoder were received"
+        read_times = self._read_times
+        decoded = self.decoder.received - self.decoder.pending_bytes
+        # Reads before the one which completed the frame aren't needed anymore
+        while read_times and read_times[0][0] < decoded:
+            read_times.popleft()
+        return read_times[0][1] if read_times else default
+
+    def frame_dispatched(self, name):
+        """
+        Time the last frame from :meth:`next_frames` once its handlers returned.
+
+        Does nothing unless :attr:`latency` is set.
+
+        :param name: Payload type the frame was dispatched as
+        """
+        times = self._frame_times
+        if times is not None and self.latency is not None:
+            self._frame_times = None
+            self.latency.record(name, times[0], times[1], times[2], _monotonic_ns())
 
     def next_frame(self):
         """Get the next payload and increment inseq.
@@ -173,28 +770,176 @@ class Session(object):
         :rtype: :class:`smarkets.streaming_api.session.Frame` or None
 
         """
-        if not self.buffered_incoming_payloads:
-            return None
+        return next(self.next_frames(1), None)
+
+    def next_frames(self, max_count=sys.maxsize, wanted=None, skipped=None):
+        """Iterate over up to `max_count` buffered payloads, incrementing inseq.
+
+        Iteration stops early when the buffers run out of complete payloads, same as repeated
+        :meth:`next_frame` calls returning None.
+
+        Payloads arriving ahead of the incoming sequence are copied aside and yielded once the
+        gap before them is filled. When one opens :attr:`gap` is fired and the missing payloads
+        are asked to be replayed, and heartbeats arriving meanwhile are answered straight away.
+        When more than :attr:`SessionSettings.reorder_capacity` payloads are waiting or the
+        sequence was stuck for :attr:`SessionSettings.reorder_timeout` seconds, the missing
+        ones are given up on: they're counted as lost, :attr:`gap` is fired again and
+        iteration goes on with the waiting payloads. Payloads which were already received are
+        dropped. :attr:`sequence_stats` keeps count.
 
-        data, self.buffered_incoming_payloads = (
-            self.buffered_incoming_payloads[0], self.buffered_incoming_payloads[1:])
+        While :attr:`overloaded`, payloads of :attr:`SessionSettings.shed_payload_types`
+        are sequenced and dropped without being parsed or yielded, see :meth:`check_inbound`.
 
-        payload = seto.Payload()
-        payload.ParseFromString(bytes(data))
-        self._handle_in_payload(payload)
-        frame = Frame(bytes=data, protobuf=payload)
-        if payload.eto_payload.seq == self.inseq:
+        .. warning::
+            Every frame has to be consumed before the next one is requested.
+
+        With :attr:`SessionSettings.borrowed_frames` enabled frames are borrowed: the protobuf
+        is one of :attr:`BORROWED_PAYLOAD_POOL_SIZE` payload objects reused in turn, parsed
+        straight from the receive buffer, and `bytes` is a :class:`memoryview` into that
+        buffer which is only valid until the next :meth:`read`. Copy anything which needs
+        to be kept for longer.
+
+        If `wanted` is given, only the payload type and sequence number of every payload is
+        read at first and payloads for which `wanted(seto_type, eto_type)` returns False are
+        sequenced and skipped without being parsed or yielded. Heartbeats are still answered.
+        `skipped(seto_type, eto_type, seq, data)` is called for every skipped payload if given,
+        `data` is only valid during the call.
+
+        While :attr:`latency` is set, call :meth:`frame_dispatched` once a frame is handled
+        to time it.
+
+        :type max_count: int
+        :type wanted: callable or None
+        :type skipped: callable or None
+        :rtype: iterator of :class:`smarkets.streaming_api.session.Frame`
+        """
+        queued = self.buffered_incoming_payloads
+        next_payload = self.decoder.next_payload
+        borrowed = self.settings.borrowed_frames
+        pool = self._payload_pool
+        recorder = self.recorder
+        latency = self.latency
+        read_times = self._read_times
+        # Frames are only timed for latency stats and with kernel timestamps
+        timed = latency is not None or self.settings.kernel_timestamps
+        shed_types = self.settings.shed_payload_types
+        reorder = self._reorder
+        self._check_gap_timeout()
+        received_at = None
+        count = 0
+        while count < max_count:
+            if reorder and self.inseq in reorder:
+                data, received_at = reorder.pop(self.inseq)
+                self.sequence_stats.payloads_reordered += 1
+                # Waiting for anything still missing starts now
+                self._gap_opened_at = _monotonic()
+                if timed:
+                    framed_at = _monotonic_ns()
+            elif queued:
+                data = queued.popleft()
+                if timed:
+                    received_at = framed_at = _monotonic_ns()
+            else:
+                data = next_payload()
+                if data is None:
+                    return
+                if timed:
+                    framed_at = _monotonic_ns()
+                    if len(read_times) == 1:
+                        # All undecoded bytes came with one read
+                        received_at = read_times[0][1]
+                    else:
+                        received_at = self._frame_received_at(framed_at)
+
+            shedding = self.overloaded and self.check_inbound() and shed_types
+            if wanted is not None or shedding:
+                header = peek_payload_header(data)
+                if header is not None:
+                    seto_type, eto_type, seq = header
+                    shed = shedding and seto_type in shed_types
+                    if (seq == self.inseq and eto_type != eto.PAYLOAD_LOGIN_RESPONSE and
+                            (shed or wanted is not None and not wanted(seto_type, eto_type))):
+                        if recorder is not None:
+                            recorder.record(DIRECTION_IN, seq, data, self._received_at)
+                        self.inseq += 1
+                        if shed:
+                            self.inbound_stats.payloads_shed += 1
+                            continue
+                        if skipped is not None:
+                            skipped(seto_type, eto_type, seq, data)
+                        if eto_type == eto.PAYLOAD_HEARTBEAT:
+                            self._answer_heartbeat(seq)
+                        continue
+
+            if borrowed:
+                payload = pool[self._payload_pool_index]
+                self._payload_pool_index = (self._payload_pool_index + 1) % len(pool)
+            else:
+                data = memoryview(data).tobytes()
+                payload = seto.Payload()
+            payload.ParseFromString(data)
+            if latency is not None:
+                self._frame_times = (received_at, framed_at, _monotonic_ns())
+            seq = payload.eto_payload.seq
+            if seq != self.inseq:
+                self._out_of_sequence(payload, data, received_at)
+                continue
+            if recorder is not None:
+                recorder.record(DIRECTION_IN, seq, data, self._received_at)
+            self._handle_in_payload(payload)
             # Go ahead
-            self.logger.debug("received sequence %d", self.inseq)
+            self.logger.debug("received sequence %d", seq)
             self.inseq += 1
-            return frame
-        elif payload.eto_payload.seq > self.inseq:
-            self.logger.warn(
-                'Received incoming sequence %d instead of expected %d',
-                payload.eto_payload.seq, self.inseq)
-            return None
-        else:
-            return None
+            count += 1
+            yield Frame(bytes=data, protobuf=payload, received_at=received_at)
+
+    def _out_of_sequence(self, payload, data, received_at):
+        "Keep a payload which arrived ahead of the incoming sequence, drop one already received"
+        stats = self.sequence_stats
+        reorder = self._reorder
+        seq = payload.eto_payload.seq
+        if seq < self.inseq or seq in reorder:
+            stats.duplicates += 1
+            self.logger.warning('Dropping incoming sequence %d received already, expected %d',
+                                seq, self.inseq)
+            return
+        if not reorder:
+            stats.gaps += 1
+            self.logger.warning('Received incoming sequence %d instead of expected %d',
+                                seq, self.inseq)
+            self._gap_opened_at = _monotonic()
+            self.gap.fire(first=self.inseq, last=seq - 1, skipped=False)
+            self.logger.info('Requesting a replay from incoming sequence %d', self.inseq)
+            self.send_template(REPLAY_TEMPLATE, self.inseq)
+        if payload.eto_payload.type == eto.PAYLOAD_HEARTBEAT:
+            # Waiting for the gap to be filled could take longer than the server waits
+            self._answered_heartbeats.add(seq)
+            self._send_heartbeat()
+        # Borrowed frames point into the receive buffer
+        reorder[seq] = (memoryview(data).tobytes(), received_at)
+        if len(reorder) > stats.max_reorder_depth:
+            stats.max_reorder_depth = len(reorder)
+        if len(reorder) > self.settings.reorder_capacity:
+            self._skip_gap()
+
+    def _check_gap_timeout(self):
+        "Give up on the gap the incoming sequence is stuck on if it was for too long"
+        timeout = self.settings.reorder_timeout
+        if self._reorder and timeout is not None and _monotonic() - self._gap_opened_at >= timeout:
+            self._skip_gap()
+
+    def _skip_gap(self):
+        "Go on with the payloads waiting after the gap, counting the missing ones as lost"
+        stats = self.sequence_stats
+        reorder = self._reorder
+        first = self.inseq
+        self.inseq = min(reorder)
+        self._gap_opened_at = _monotonic()
+        stats.gaps_skipped += 1
+        stats.payloads_lost += self.inseq - first
+        self.logger.error('Gave up waiting for incoming sequence %d to %d, %d payloads are waiting',
+                          first, self.inseq - 1, len(reorder))
+        self.gap.fire(first=first, last=self.inseq - 1, skipped=True)
 
     def _handle_in_payload(self, msg):
         "Pre-consume the login response message"
@@ -206,14 +951,23 @@ class Session(object):
             self.logger.info("received login_response with session %r and outseq %d",
                              self.session, self.buf_outseq)
         elif msg.eto_payload.type == eto.PAYLOAD_HEARTBEAT:
-            self.logger.debug("received heartbeat message, responding...")
-            heartbeat = self.out_payload
-            heartbeat.Clear()
-            heartbeat.type = seto.PAYLOAD_ETO
-            heartbeat.eto_payload.type = eto.PAYLOAD_HEARTBEAT
-            self.send()
+            self._answer_heartbeat(msg.eto_payload.seq)
         return msg
 
+    def _answer_heartbeat(self, seq):
+        "Answer a heartbeat handled in sequence, unless it was answered when it arrived early"
+        answered = self._answered_heartbeats
+        if answered and seq in answered:
+            answered.discard(seq)
+        else:
+            self._send_heartbeat()
+
+    def _send_heartbeat(self):
+        self.logger.debug("received heartbeat message, responding...")
+        # Doesn't touch out_payload, which may hold a payload being built by the caller
+        self.heartbeat_pending = True
+        self.send_template(HEARTBEAT_TEMPLATE)
+
 
 class SessionSocket(object):
 
@@ -226,6 +980,11 @@ class SessionSocket(object):
             raise ValueError("settings is not a SessionSettings")
         self.settings = settings
         self._sock = None
+        # Whether the kernel timestamps received data on the current connection
+        self.kernel_timestamps = False
+        # Wall clock time in nanoseconds the kernel received the data returned by the last
+        # recv_into at, None without kernel timestamps
+        self.kernel_received_at = None
 
     @property
     def connected(self):
@@ -257,29 +1016,46 @@ class SessionSocket(object):
             reraise(ConnectionError(self._error_message(exc)))
 
         self._sock = sock
+        if self.settings.kernel_timestamps:
+            self.kernel_timestamps = self._enable_kernel_timestamps(sock)
+        return True
+
+    def _enable_kernel_timestamps(self, sock):
+        "Ask the kernel to timestamp received data, falling back to timestamps taken after reads"
+        if _SO_TIMESTAMPNS is None or self.settings.ssl or not hasattr(sock, 'recvmsg_into'):
+            self.logger.warning('kernel receive timestamps are only available on Linux without SSL')
+            return False
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMPNS, 1)
+        except socket.error as exc:
+            self.logger.warning('failed to enable kernel receive timestamps: %s', exc)
+            return False
         return True
 
     def disconnect(self):
         "Close the TCP socket."
-        if self._sock is None:
+        # Taken first, a reader thread may disconnect at the same time
+        sock, self._sock = self._sock, None
+        if sock is None:
             self.logger.debug("disconnect() called with no socket, ignoring")
             return
         try:
             self.logger.info("shutting down reads")
-            self._sock.shutdown(socket.SHUT_RD)
+            sock.shutdown(socket.SHUT_RD)
             self.logger.info("shutting down reads/writes")
-            self._sock.shutdown(socket.SHUT_RDWR)
+            sock.shutdown(socket.SHUT_RDWR)
             self.logger.info("closing socket")
-            self._sock.close()
+            sock.close()
         except socket.error as e:
             # Ignore exceptions while disconnecting
             self.logger.debug('Exception when disconnecting: %r', e)
-        self._sock = None
+        self.kernel_timestamps = False
+        self.kernel_received_at = None
 
     def send(self, byte_array):
         """
         :type byte_array: bytearray
-        :return: Number of sent bytes
+        :return: Number of sent bytes, 0 if the socket is non-blocking and can't be written to
         :rtype: int
         """
         if self._sock is None:
@@ -291,6 +1067,30 @@ class SessionSocket(object):
                 raise SocketDisconnected('Socket disconnected when writing to it, 0 bytes written')
             return sent
         except socket.error as e:
+            if _would_block(e):
+                return 0
+            reraise(ConnectionError("Error while writing to socket", e))
+
+    def sendmsg(self, buffers):
+        """
+        Send many buffers with one system call.
+
+        :type buffers: list of bytes-like objects
+        :return: Number of sent bytes, 0 if the socket is non-blocking and can't be written to
+        :rtype: int
+        """
+        if self._sock is None:
+            raise SocketDisconnected('Trying to write to socket when disconnected')
+        try:
+            if self.wire_logger.isEnabledFor(logging.DEBUG):
+                self.wire_logger.debug("sending %d buffers: %r", len(buffers), b''.join(buffers))
+            sent = self._sock.sendmsg(buffers)
+            if sent == 0:
+                raise SocketDisconnected('Socket disconnected when writing to it, 0 bytes written')
+            return sent
+        except socket.error as e:
+            if _would_block(e):
+                return 0
             reraise(ConnectionError("Error while writing to socket", e))
 
     def recv(self):
@@ -313,6 +1113,45 @@ class SessionSocket(object):
         except socket.error as e:
             reraise(ConnectionError('Error while reading from socket', e))
 
+    def recv_into(self, buffer, nbytes):
+        """Read stuff from underlying socket into `buffer`.
+
+        :type buffer: writable buffer, for example :class:`memoryview` or bytearray
+        :return: Number of received bytes, 0 if the socket is non-blocking and has nothing to read
+        :rtype: int
+        """
+        if self._sock is None:
+            raise SocketDisconnected(
+                'Trying to read from a socket when disconnected')
+        try:
+            if self.kernel_timestamps:
+                received = self._recv_into_timestamped(buffer, nbytes)
+            else:
+                received = self._sock.recv_into(buffer, nbytes)
+            if not received:
+                message = "Socket disconnected while receiving, got 0 bytes"
+                self.logger.info(message)
+                raise SocketDisconnected(message)
+            if self.wire_logger.isEnabledFor(logging.DEBUG):
+                self.wire_logger.debug(
+                    'Received %d bytes: %r', received, memoryview(buffer)[:received].tobytes())
+            return received
+        except socket.error as e:
+            if _would_block(e):
+                return 0
+            reraise(ConnectionError('Error while reading from socket', e))
+
+    def _recv_into_timestamped(self, buffer, nbytes):
+        "Receive into `buffer`, keeping the kernel timestamp of the data"
+        received, ancillary, flags, address = self._sock.recvmsg_into(
+            [memoryview(buffer)[:nbytes]], _TIMESTAMP_CMSG_SPACE)
+        self.kernel_received_at = None
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == _SO_TIMESTAMPNS and len(data) >= _TIMESPEC.size:
+                seconds, nanoseconds = _TIMESPEC.unpack_from(data)
+                self.kernel_received_at = seconds * 1000000000 + nanoseconds
+        return received
+
     def _error_message(self, exception):
         "Stringify a socket exception"
         # args for socket.error can either be (errno, "message")
@@ -0,0 +1,187 @@
+"Pre-serialised payloads which only get a few integer fields patched in for every send"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+from google.protobuf.descriptor import FieldDescriptor
+from six import int2byte
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import uleb128_encode
+from smarkets.streaming_api.utils import payload_field, set_payload_message
+
+__all__ = ('PayloadTemplate', 'HEARTBEAT_TEMPLATE', 'PING_TEMPLATE', 'REPLAY_TEMPLATE')
+
+_WIRE_TYPE_VARINT = 0
+_WIRE_TYPE_LENGTH_DELIMITED = 2
+
+# Field types which can be patched, all encoded as unsigned varints
+_VARINT_FIELD_TYPES = frozenset((
+    FieldDescriptor.TYPE_UINT32,
+    FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_ENUM,
+    FieldDescriptor.TYPE_BOOL,
+))
+
+_SEQ_PATH = ('eto_payload', 'seq')
+
+_SMALL_VARINTS = tuple(int2byte(value) for value in range(0x80))
+
+
+class PayloadTemplate(object):
+
+    """
+    A seto payload serialised once, except for the sequence number and some integer fields.
+
+    Serialising a payload from a template skips building and serialising protobuf objects,
+    only the patched fields and the lengths of the messages containing them are encoded::
+
+        template = PayloadTemplate(
+            seto.OrderCreate(side=seto.SIDE_BUY, quantity=0, price=0, market_id=1, contract_id=0),
+            ('price', 'quantity', 'contract_id'))
+        session.send_template(template, 2500, 100000, 42)
+    """
+
+    def __init__(self, message, fields=()):
+        """
+        :param message: Prototype seto message, for example :class:`seto.OrderCreate`, or a
+            complete :class:`seto.Payload`. The values of the patched fields don't matter.
+        :param fields: Names of the integer fields of `message` which are patched for every send,
+            in the order their values are passed to :meth:`serialize`. When `message` is a
+            payload they're dotted paths, like ``order_create.price``.
+        :type fields: sequence of str
+        :raises ValueError: if a field isn't an unsigned integer, enum or bool field
+        """
+        payload = seto.Payload()
+        if isinstance(message, seto.Payload):
+            payload.CopyFrom(message)
+            paths = [tuple(field.split('.')) for field in fields]
+        else:
+            set_payload_message(payload, message)
+            prefix = payload_field(type(message))[1].name
+            paths = [(prefix,) + tuple(field.split('.')) for field in fields]
+        self.fields = tuple(fields)
+        self._root = _TemplateNode(payload, [_SEQ_PATH] + paths, list(range(len(paths) + 1)))
+
+    def serialize(self, seq, *values):
+        """
+        Serialise the payload with the given sequence number and field values.
+
+        :rtype: bytes
+        """
+        return self._root.serialize((seq,) + values)
+
+
+class _TemplateNode(object):
+
+    """
+    How to encode a message with patched fields.
+
+    Fields are kept in field number order, like protobuf serialisers write them, so that
+    :func:`smarkets.streaming_api.framing.peek_payload_header` can read templated payloads.
+    Every slot is the constant bytes up to and including the key of a patched field and
+    either the index of the field value or the node of the nested message.
+    """
+
+    __slots__ = ('slots', 'suffix')
+
+    def __init__(self, message, paths, indexes):
+        message_copy = message.__class__()
+        message_copy.CopyFrom(message)
+        fields = message_copy.DESCRIPTOR.fields_by_name
+        patched = {}
+        nested = {}
+        for path, index in zip(paths, indexes):
+            field = fields.get(path[0])
+            if field is None:
+                raise ValueError('%s has no field %r' % (message_copy.DESCRIPTOR.full_name, path[0]))
+            if len(path) == 1:
+                if field.type not in _VARINT_FIELD_TYPES:
+                    raise ValueError('%s is not an integer field' % field.full_name)
+                patched[field.number] = (_tag(field.number, _WIRE_TYPE_VARINT), index, None)
+            else:
+                if field.type != FieldDescriptor.TYPE_MESSAGE:
+                    raise ValueError('%s is not a message field' % field.full_name)
+                sub_paths, sub_indexes = nested.setdefault(field, ([], []))
+                sub_paths.append(path[1:])
+                sub_indexes.append(index)
+        for field, (sub_paths, sub_indexes) in nested.items():
+            child = _TemplateNode(getattr(message_copy, field.name), sub_paths, sub_indexes)
+            patched[field.number] = (_tag(field.number, _WIRE_TYPE_LENGTH_DELIMITED), None, child)
+        constant = dict(
+            (field.number, _field_bytes(message_copy, field))
+            for field, value in message_copy.ListFields() if field.number not in patched
+        )
+        self.slots = []
+        prefix = b''
+        for number in sorted(set(constant).union(patched)):
+            if number in constant:
+                prefix += constant[number]
+            else:
+                tag, index, child = patched[number]
+                self.slots.append((prefix + tag, index, child))
+                prefix = b''
+        self.suffix = prefix
+
+    def serialize(self, values):
+        parts = []
+        for prefix, index, child in self.slots:
+            parts.append(prefix)
+            if child is None:
+                parts.append(_varint(values[index]))
+            else:
+                sub = child.serialize(values)
+                parts.append(_varint(len(sub)))
+                parts.append(sub)
+        parts.append(self.suffix)
+        return b''.join(parts)
+
+
+def _field_bytes(message, field):
+    "Serialise a single field of a message"
+    single = message.__class__()
+    single.CopyFrom(message)
+    for other, value in single.ListFields():
+        if other is not field:
+            single.ClearField(other.name)
+    return single.SerializePartialToString()
+
+
+def _varint(value):
+    if value < 0x80:
+        if value < 0:
+            raise ValueError('templated fields take non-negative values, got %r' % (value,))
+        return _SMALL_VARINTS[value]
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _tag(number, wire_type):
+    return bytes(uleb128_encode(number << 3 | wire_type))
+
+
+def _eto_template(eto_type):
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_ETO
+    payload.eto_payload.type = eto_type
+    return PayloadTemplate(payload)
+
+
+def _replay_template():
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_ETO
+    payload.eto_payload.type = eto.PAYLOAD_REPLAY
+    payload.eto_payload.replay.seq = 0
+    return PayloadTemplate(payload, ('eto_payload.replay.seq',))
+
+
+PING_TEMPLATE = _eto_template(eto.PAYLOAD_PING)
+HEARTBEAT_TEMPLATE = _eto_template(eto.PAYLOAD_HEARTBEAT)
+# Asks for the incoming payloads from the sequence number it's sent with to be sent again
+REPLAY_TEMPLATE = _replay_template()
@@ -0,0 +1,376 @@
+"Reading a streaming API connection in its own thread and handling frames in worker threads"
+# Copyright (C) 2011 Smarkets Limited <support@smarkets.com>
+#
+# This module is released under the MIT License:
+# http://www.opensource.org/licenses/mit-license.php
+from __future__ import absolute_import
+
+import logging
+import threading
+from collections import deque
+
+from smarkets import private
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.keepalive import KeepaliveScheduler
+from smarkets.streaming_api.templates import PING_TEMPLATE
+
+__all__ = ('FrameQueue', 'ThreadedStreamingAPIClient')
+
+
+class FrameQueue(object):
+
+    """
+    Bounded queue handing frames from a reader thread to a worker thread.
+
+    Frames go in and come out in batches, so the lock is taken once for every batch read
+    from the socket and once for every batch a worker picks up, not for every frame. Queue
+    depth is tracked for monitoring: :attr:`depth` is the current number of queued frames,
+    :attr:`max_depth` the highest it has been and :attr:`put_waits` the number of times the
+    reader had to wait for room.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: Maximum number of queued frames
+        :type capacity: int
+        """
+        if capacity <= 0:
+            raise ValueError('capacity needs to be positive, got %r' % (capacity,))
+        self.capacity = capacity
+        self._frames = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+        self.max_depth = 0
+        self.put_waits = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+    @property
+    def depth(self):
+        "Number of queued frames"
+        return len(self._frames)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put_many(self, frames):
+        """
+        Queue a batch of frames, waiting while the queue is full.
+
+        Frames which don't fit are queued as room is made. Frames put after :meth:`close`
+        are dropped.
+
+        :type frames: list
+        :return: Number of queued frames
+        :rtype: int
+        """
+        queued = self._frames
+        position = 0
+        with self._lock:
+            while position < len(frames) and not self._closed:
+                room = self.capacity - len(queued)
+                if room <= 0:
+                    self.put_waits += 1
+                    self._not_full.wait()
+                    continue
+                batch = frames[position:position + room]
+                queued.extend(batch)
+                position += len(batch)
+                self.frames_in += len(batch)
+                if len(queued) > self.max_depth:
+                    self.max_depth = len(queued)
+                self._not_empty.notify()
+        return position
+
+    def get_many(self, timeout=None):
+        """
+        Take all queued frames, waiting until there are some.
+
+        :param timeout: Seconds to wait at most, None to wait until there are frames
+        :return: The frames, an empty list if `timeout` expired or None once the queue is
+            closed and empty
+        :rtype: list or None
+        """
+        queued = self._frames
+        with self._lock:
+            if not queued:
+                if self._closed:
+                    return None
+                self._not_empty.wait(timeout)
+                if not queued:
+                    return None if self._closed else []
+            frames = list(queued)
+            queued.clear()
+            self.frames_out += len(frames)
+            self._not_full.notify()
+        return frames
+
+    def close(self):
+        "Stop accepting frames, workers get the queued ones and then None"
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def __repr__(self):
+        return '%s(depth=%d, max_depth=%d, put_waits=%d, frames_in=%d, frames_out=%d)' % (
+            type(self).__name__, self.depth, self.max_depth, self.put_waits, self.frames_in,
+            self.frames_out)
+
+
+class ThreadedStreamingAPIClient(StreamingAPIClient):
+
+    """
+    :class:`smarkets.streaming_api.client.StreamingAPIClient` which reads in a thread of its
+    own and calls handlers in worker threads.
+
+    Log in as usual, then :meth:`start` the threads. The reader thread owns the socket: it
+    reads, decodes and sequences frames, answers heartbeats and hands the frames to be
+    dispatched to the workers through bounded :class:`FrameQueue` queues, so slow handlers
+    don't hold up reading. When a queue is full the reader waits for room, and stops
+    reading meanwhile.
+
+    With more than one worker, frames are spread over the workers by `key`, a function of
+    the payload: frames with the same key are handled by the same worker in the order they
+    arrived, for example by market with ``lambda message: message.contract_quotes.market_id``.
+    Without a key frames are spread round-robin and handled in any order.
+
+    Sending is safe from any thread, handlers included. Don't call :meth:`read` while the
+    threads are running. Handler exceptions are logged and counted in :attr:`handler_errors`.
+    If the connection fails, the reader stops, the workers handle the frames which were
+    queued already and stop too, and the exception is kept in :attr:`reader_error`. So does
+    an exception raised by `key`. The reader also stops once it has handed off a logout.
+    Whenever it stops, the reader disconnects the session itself, :meth:`stop` and
+    :meth:`logout` only shut the socket down while it runs.
+
+    With a `keepalive_interval`, a :class:`smarkets.streaming_api.keepalive.KeepaliveScheduler`
+    thread sends keepalives whenever nothing was written for that long, also while the
+    reader waits for room in a full queue.
+
+    Frames can't be borrowed from the session in threaded mode and latency stats aren't
+    taken, see :attr:`smarkets.streaming_api.session.Session.latency`.
+    """
+
+    logger = private(logging.getLogger('smarkets.streaming_api.threaded'))
+
+    def __init__(self, session, workers=1, queue_capacity=65536, key=None, keepalive_interval=None):
+        """
+        :type session: :class:`smarkets.streaming_api.session.Session`
+        :param workers: Number of worker threads
+        :param queue_capacity: Maximum number of frames queued for every worker
+        :param key: Function of a payload returning which frames have to be handled in order
+        :type key: callable or None
+        :param keepalive_interval: Seconds without writing after which a keepalive is sent,
+            None for no keepalives
+        """
+        if session.settings.borrowed_frames:
+            raise ValueError('frames handed to worker threads can not be borrowed')
+        if workers <= 0:
+            raise ValueError('workers needs to be positive, got %r' % (workers,))
+        super(ThreadedStreamingAPIClient, self).__init__(session)
+        self.queues = [FrameQueue(queue_capacity) for _ in range(workers)]
+        self.key = key
+        self.reader_error = None
+        self.handler_errors = 0
+        self.frames_read = 0
+        self._send_lock = threading.Lock()
+        self.keepalive = None
+        if keepalive_interval is not None:
+            self.keepalive = KeepaliveScheduler(session, keepalive_interval, lock=self._send_lock)
+        self._running = False
+        self._logging_out = False
+        self._reader = None
+        self._workers = []
+        self._next_worker = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queue_depth(self):
+        "Number of frames waiting for workers"
+        return sum(queue.depth for queue in self.queues)
+
+    def start(self):
+        "Start the reader and worker threads, the client has to be logged in"
+        if self._running:
+            raise RuntimeError('already started')
+        if not self.session.connected:
+            raise ValueError('client has to be connected before starting it')
+        self._running = True
+        self._logging_out = False
+        self.reader_error = None
+        self.queues = [FrameQueue(queue.capacity) for queue in self.queues]
+        self._workers = [
+            threading.Thread(target=self._work, args=(queue,), name='smarkets-worker-%d' % (number,))
+            for number, queue in enumerate(self.queues)
+        ]
+        self._reader = threading.Thread(target=self._read_frames, name='smarkets-reader')
+        for thread in self._workers + [self._reader]:
+            thread.daemon = True
+            thread.start()
+        if self.keepalive is not None:
+            self.keepalive.start()
+
+    def stop(self, timeout=None):
+        """
+        Disconnect and wait for the threads to handle the queued frames and finish.
+
+        :param timeout: Seconds to wait for every thread, None to wait until they finish
+        """
+        self._running = False
+        self._disconnect()
+        self.join(timeout)
+
+    def join(self, timeout=None):
+        "Wait for the threads to finish, which they do after :meth:`stop` or a disconnection"
+        current = threading.current_thread()
+        for thread in [self._reader] + self._workers:
+            if thread is not None and thread is not current:
+                thread.join(timeout)
+        if self.keepalive is not None:
+            self.keepalive.stop(timeout)
+
+    def logout(self, receive=True, timeout=5):
+        """
+        Log out and stop the threads.
+
+        :param receive: Wait up to `timeout` seconds for the logout confirmation to be
+            handled before disconnecting
+        """
+        if not self._running:
+            return super(ThreadedStreamingAPIClient, self).logout(receive)
+        self.last_login = None
+        if receive:
+            # The reader stops once it has handed off the confirmation or the server hung up
+            self._logging_out = True
+        else:
+            self._running = False
+        with self._send_lock:
+            self.session.logout()
+        if receive:
+            self._reader.join(timeout)
+        self._running = False
+        self._disconnect()
+        self.join(timeout)
+
+    def _disconnect(self):
+        "Disconnect the session, or leave it to the reader thread while that is running"
+        reader = self._reader
+        if reader is not None and reader.is_alive() and reader is not threading.current_thread():
+            # It may be receiving into the buffers or decoding them, shutting the socket down
+            # stops it and it disconnects the session on its way out
+            self.session.socket.disconnect()
+        else:
+            with self._send_lock:
+                self.session.disconnect()
+
+    def read(self, *args, **kwargs):
+        if self._running:
+            raise RuntimeError('frames are read by the reader thread')
+        return super(ThreadedStreamingAPIClient, self).read(*args, **kwargs)
+
+    def flush(self):
+        with self._send_lock:
+            self.session.flush()
+
+    def send(self, message):
+        with self._send_lock:
+            super(ThreadedStreamingAPIClient, self).send(message)
+
+    def send_many(self, messages):
+        with self._send_lock:
+            count = self.session.send_many(messages)
+            self.session.flush()
+        return count
+
+    def send_template(self, template, *values):
+        with self._send_lock:
+            self.session.send_template(template, *values)
+
+    def ping(self):
+        with self._send_lock:
+            self.session.send_template(PING_TEMPLATE)
+
+    def _logged_out(self):
+        # Only the reader thread touches the receive buffers while the threads are running
+        if threading.current_thread() not in self._workers:
+            super(ThreadedStreamingAPIClient, self)._logged_out()
+
+    def _read_frames(self):
+        "Reader thread"
+        session = self.session
+        wanted = self._wants_payload
+        lock = self._send_lock
+        try:
+            while self._running:
+                session.receive()
+                # Heartbeats are answered while frames are sequenced, which sends
+                with lock:
+                    frames = list(session.next_frames(wanted=wanted))
+                    if session.output_buffer_size:
+                        session.flush()
+                if frames:
+                    self.frames_read += len(frames)
+                    self._hand_off(frames)
+                    if any(frame.protobuf.type == seto.PAYLOAD_ETO and
+                           frame.protobuf.eto_payload.type == eto.PAYLOAD_LOGOUT for frame in frames):
+                        # Workers dispatching the logout leave disconnecting to this thread
+                        break
+        except (ConnectionError, SocketDisconnected) as exc:
+            if self._running and not self._logging_out:
+                self.logger.warning('reader stopped: %s', exc)
+                self.reader_error = exc
+        except Exception as exc:
+            # Raised by the key function, frames can't be handed off in order anymore
+            self.logger.exception('reader failed')
+            self.reader_error = exc
+        finally:
+            # Nothing else touches the receive buffers while this thread runs
+            with lock:
+                session.disconnect()
+            self._running = False
+            if self.keepalive is not None:
+                self.keepalive.stop()
+            for queue in self.queues:
+                queue.close()
+
+    def _hand_off(self, frames):
+        queues = self.queues
+        if len(queues) == 1:
+            queues[0].put_many(frames)
+            return
+        batches = [[] for _ in queues]
+        key = self.key
+        if key is None:
+            worker = self._next_worker
+            for frame in frames:
+                batches[worker].append(frame)
+                worker = (worker + 1) % len(queues)
+            self._next_worker = worker
+        else:
+            for frame in frames:
+                batches[hash(key(frame.protobuf)) % len(queues)].append(frame)
+        for queue, batch in zip(queues, batches):
+            if batch:
+                queue.put_many(batch)
+
+    def _work(self, queue):
+        "Worker thread"
+        dispatch = self._dispatch
+        while True:
+            frames = queue.get_many()
+            if frames is None:
+                return
+            for frame in frames:
+                try:
+                    dispatch(frame)
+                except Exception:
+                    self.handler_errors += 1
+                    self.logger.exception('handler failed for frame %d', frame.protobuf.eto_payload.seq)
@@ -1,13 +1,43 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from smarkets.streaming_api import seto
-from smarkets.string import camel_case_to_underscores
 
-__all__ = ('set_payload_message',)
+__all__ = ('payload_field', 'set_payload_message')
+
+# Message class -> (payload type, descriptor of the payload field holding such messages)
+_PAYLOAD_FIELDS = {}
 
 
 def set_payload_message(payload, message):
-    underscore_form = camel_case_to_underscores(type(message).__name__)
-    payload_type = getattr(seto, 'PAYLOAD_' + underscore_form.upper())
+    message_class = type(message)
+    try:
+        payload_type, field = _PAYLOAD_FIELDS[message_class]
+    except KeyError:
+        payload_type, field = payload_field(message_class)
     payload.type = payload_type
-    getattr(payload, underscore_form).CopyFrom(message)
+    getattr(payload, field.name).CopyFrom(message)
+
+
+def payload_field(message_class):
+    """
+    Payload type and field of a seto message class.
+
+    :return: payload type and the :class:`google.protobuf.descriptor.FieldDescriptor` of the
+        :class:`seto.Payload` field holding such messages
+    :raises ValueError: if no payload field holds such messages
+    """
+    try:
+        return _PAYLOAD_FIELDS[message_class]
+    except KeyError:
+        found = _PAYLOAD_FIELDS[message_class] = _find_payload_field(message_class)
+        return found
+
+
+def _find_payload_field(message_class):
+    "Work out the payload type and field of a message class, done once per class"
+    descriptor = message_class.DESCRIPTOR
+    for field in seto.Payload.DESCRIPTOR.fields:
+        payload_type = getattr(seto, 'PAYLOAD_' + field.name.upper(), None)
+        if field.message_type is descriptor and payload_type is not None:
+            return payload_type, field
+    raise ValueError('%s is not a seto payload message' % (descriptor.full_name,))
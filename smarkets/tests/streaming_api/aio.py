@@ -0,0 +1,120 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import unittest
+
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.aio import AsyncSession, AsyncStreamingAPIClient
+from smarkets.streaming_api.exceptions import SocketDisconnected
+from smarkets.streaming_api.framing import frame_encode, FrameDecoder
+from smarkets.streaming_api.session import SessionSettings
+
+
+class FakeServer(object):
+
+    "Answers the login and responds to pings with a heartbeat and a pong"
+
+    def __init__(self, close_after_login=False):
+        self.received = []
+        self.close_after_login = close_after_login
+
+    async def handle(self, reader, writer):
+        decoder = FrameDecoder()
+        outseq = 1
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            decoder.feed(data)
+            for data in decoder:
+                payload = seto.Payload()
+                payload.ParseFromString(data.tobytes())
+                self.received.append(payload)
+                if payload.type == seto.PAYLOAD_LOGIN:
+                    responses = (eto.PAYLOAD_LOGIN_RESPONSE,)
+                elif payload.eto_payload.type == eto.PAYLOAD_PING:
+                    responses = (eto.PAYLOAD_HEARTBEAT, eto.PAYLOAD_PONG)
+                else:
+                    continue
+                frames = bytearray()
+                for eto_type in responses:
+                    out = seto.Payload()
+                    out.type = seto.PAYLOAD_ETO
+                    out.eto_payload.type = eto_type
+                    out.eto_payload.seq = outseq
+                    if eto_type == eto.PAYLOAD_LOGIN_RESPONSE:
+                        out.eto_payload.login_response.session = 'session'
+                        out.eto_payload.login_response.reset = 1
+                    outseq += 1
+                    frame_encode(frames, out.SerializeToString())
+                writer.write(bytes(frames))
+                if self.close_after_login:
+                    writer.close()
+                    return
+        writer.close()
+
+
+class AsyncClientTestCase(unittest.TestCase):
+
+    "Tests for the asyncio client against a local server"
+
+    def run_with_server(self, test, server=None):
+        if server is None:
+            server = FakeServer()
+
+        async def run():
+            listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            settings = SessionSettings('username', 'password', host='127.0.0.1', port=port, ssl=False)
+            client = AsyncStreamingAPIClient(AsyncSession(settings))
+            try:
+                await asyncio.wait_for(test(client, server), 5)
+            finally:
+                client.session.disconnect()
+                listener.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_login_and_iterate(self):
+        "Test logging in, answering heartbeats and iterating over frames"
+        async def test(client, server):
+            pongs = []
+            client.add_handler('eto.pong', lambda message: pongs.append(message))
+            await client.login()
+            await client.ping()
+            await client.flush()
+            names = []
+            async for frame in client:
+                names.append(frame.protobuf.eto_payload.type)
+                if frame.protobuf.eto_payload.type == eto.PAYLOAD_PONG:
+                    break
+            # Nothing handles the heartbeat, it's answered and skipped
+            eq_(names, [eto.PAYLOAD_PONG])
+            eq_(len(pongs), 1)
+            eq_(client.session.inseq, 4)
+            while len(server.received) < 3:
+                await asyncio.sleep(0.01)
+            eq_([payload.eto_payload.type for payload in server.received],
+                [eto.PAYLOAD_LOGIN, eto.PAYLOAD_PING, eto.PAYLOAD_HEARTBEAT])
+
+        self.run_with_server(test)
+
+    def test_frames_followed_by_close(self):
+        "Test frames received before the connection is closed are dispatched before it's reported"
+        async def test(client, server):
+            await client.session.connect()
+            while client.session.connected:
+                await asyncio.sleep(0.01)
+            eq_(await client.read(), 1)
+            eq_(client.last_login.eto_payload.login_response.session, 'session')
+            eq_(client.session.inseq, 2)
+            with self.assertRaises(SocketDisconnected):
+                await client.read()
+
+        self.run_with_server(test, FakeServer(close_after_login=True))
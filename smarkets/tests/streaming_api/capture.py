@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from mock import Mock, patch
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.capture import (
+    CaptureRecorder, DIRECTION_IN, DIRECTION_OUT, read_capture, read_capture_index,
+)
+from smarkets.streaming_api.exceptions import ParseError
+from smarkets.streaming_api.framing import frame_encode
+from smarkets.streaming_api.session import Session, SessionSettings
+from smarkets.tests.streaming_api.payloads import eto_payload
+
+
+class TempDir(object):
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self.path
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.path)
+
+
+def test_session_records_received_and_sent_payloads():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'session.cap')
+        session = Session(SessionSettings('username', 'password'))
+        session.socket = Mock()
+        frames = bytearray()
+        for seq in (1, 2):
+            frame_encode(frames, eto_payload(seq))
+
+        def recv_into(buffer, nbytes):
+            buffer[:len(frames)] = frames
+            return len(frames)
+
+        session.socket.recv_into.side_effect = recv_into
+        with CaptureRecorder(path) as recorder:
+            session.recorder = recorder
+            with patch('smarkets.streaming_api.session._monotonic', return_value=12.5):
+                session.read()
+                eq_(len(list(session.next_frames())), 2)
+                session.out_payload.Clear()
+                session.out_payload.type = seto.PAYLOAD_ETO
+                session.out_payload.eto_payload.type = eto.PAYLOAD_PING
+                session.send()
+
+        records = list(read_capture(path))
+        eq_([(record.direction, record.seq) for record in records],
+            [(DIRECTION_IN, 1), (DIRECTION_IN, 2), (DIRECTION_OUT, 1)])
+        eq_(set(record.timestamp for record in records), set([12.5]))
+        eq_(bytes(records[1].payload), eto_payload(2))
+
+        index = read_capture_index(path + '.idx')
+        eq_(sorted(index), [(0, DIRECTION_IN, 1), (0, DIRECTION_IN, 2), (0, DIRECTION_OUT, 1)])
+        with open(path, 'rb') as f:
+            f.seek(index[(0, DIRECTION_IN, 2)])
+            eq_(f.read(1), b'\x01')
+
+
+def test_recorded_logins_have_no_credentials():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'login.cap')
+        session = Session(SessionSettings('username', 'secret password', vectored_flush=False))
+        session.socket = Mock()
+        with CaptureRecorder(path) as recorder:
+            session.recorder = recorder
+            session._send_login()
+
+        records = list(read_capture(path))
+        eq_([(record.direction, record.seq) for record in records], [(DIRECTION_OUT, 1)])
+        assert b'secret password' not in bytes(records[0].payload)
+        login = seto.Payload()
+        login.ParseFromString(bytes(records[0].payload))
+        eq_(login.type, seto.PAYLOAD_LOGIN)
+        eq_((login.login.username, login.login.password), ('', ''))
+        # What's sent is left alone
+        assert b'secret password' in bytes(session.send_buffer)
+
+
+def test_recorder_appends_to_existing_captures():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'append.cap')
+        for seq in (1, 2):
+            with CaptureRecorder(path) as recorder:
+                recorder.record(DIRECTION_IN, seq, eto_payload(seq), 1.0)
+        eq_([record.seq for record in read_capture(path)], [1, 2])
+        eq_(sorted(read_capture_index(path + '.idx').values()), [8, 8 + 21 + len(eto_payload(1))])
+
+
+def test_index_keeps_the_records_of_every_session():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'reconnects.cap')
+        with CaptureRecorder(path) as recorder:
+            for direction, seq in (
+                (DIRECTION_OUT, 1), (DIRECTION_IN, 1), (DIRECTION_IN, 2),
+                # Reconnected, both sequences start again
+                (DIRECTION_OUT, 1), (DIRECTION_IN, 1),
+            ):
+                recorder.record(direction, seq, eto_payload(seq), 1.0)
+        offsets = [8 + i * (21 + len(eto_payload(1))) for i in range(5)]
+        eq_(read_capture_index(path + '.idx'), {
+            (0, DIRECTION_OUT, 1): offsets[0],
+            (0, DIRECTION_IN, 1): offsets[1],
+            (0, DIRECTION_IN, 2): offsets[2],
+            (1, DIRECTION_OUT, 1): offsets[3],
+            (1, DIRECTION_IN, 1): offsets[4],
+        })
+
+
+def test_truncated_captures_are_rejected():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'truncated.cap')
+        with CaptureRecorder(path) as recorder:
+            recorder.record(DIRECTION_IN, 1, eto_payload(1), 1.0)
+        with open(path, 'rb+') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        assert_raises(ParseError, list, read_capture(path))
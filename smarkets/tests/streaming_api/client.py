@@ -1,12 +1,13 @@
 from __future__ import absolute_import
 
+import sys
 import unittest
 from collections import namedtuple
 from itertools import chain, product
 
 import six
 
-from mock import patch
+from mock import Mock, patch
 from nose.tools import eq_
 from six.moves import xrange
 
@@ -44,14 +45,14 @@ def read_session_buff_gen(raw_response):
     class indexer(object):
         index = 0
 
-    def ret_buff():
-        if indexer.index < len(buffers):
+    def ret_buffs(max_count=sys.maxsize, wanted=None):
+        while max_count and indexer.index < len(buffers):
             val = buffers[indexer.index]
             indexer.index += 1
-            return val
-        return None
+            max_count -= 1
+            yield val
 
-    return ret_buff
+    return ret_buffs
 
 
 class Handler(object):
@@ -81,14 +82,14 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_ok(self):
         "Test the `Smarkets.login` method"
-        self.client.session.next_frame = read_session_buff_gen(SUCCESSFUL_LOGIN_RESPONSE_RAW)
+        self.client.session.next_frames = read_session_buff_gen(SUCCESSFUL_LOGIN_RESPONSE_RAW)
         self.client.login()
         self.assertTrue(self.client.check_login())
 
     def test_login_ok_async(self):
         "Test the `Smarkets.login` method"
         self.client.login(False)
-        self.client.session.next_frame = read_session_buff_gen(
+        self.client.session.next_frames = read_session_buff_gen(
             SUCCESSFUL_LOGIN_RESPONSE_RAW +
             PAYLOAD_THROTTLE_LIMITS_RAW +
             PAYLOAD_THROTTLE_LIMITS_RAW)
@@ -97,7 +98,7 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_unauthorized(self):
         "Test the `Smarkets.login` method for unauthorized"
-        self.client.session.next_frame = read_session_buff_gen(UNAUTHORIZED_LOGIN_RESPONSE_RAW)
+        self.client.session.next_frames = read_session_buff_gen(UNAUTHORIZED_LOGIN_RESPONSE_RAW)
         try:
             self.client.login()
         except LoginError as ex:
@@ -110,7 +111,7 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_ok_then_timeout(self):
         "Test the `Smarkets.login` method for a sequence of messages"
-        self.client.session.next_frame = read_session_buff_gen(
+        self.client.session.next_frames = read_session_buff_gen(
             SUCCESSFUL_LOGIN_RESPONSE_RAW +
             PAYLOAD_THROTTLE_LIMITS_RAW +
             LOGOUT_HEARTBEAT_TIMEOUT_RAW)
@@ -126,7 +127,7 @@ class SmarketsTestCase(unittest.TestCase):
 
     def test_login_noresponse(self):
         "Test the `Smarkets.login` when no login response has been received"
-        self.client.session.next_frame = read_session_buff_gen('')
+        self.client.session.next_frames = read_session_buff_gen('')
 
         try:
             self.client.login()
@@ -143,6 +144,15 @@ class SmarketsTestCase(unittest.TestCase):
             [('logout', (), {}),
              ('disconnect', (), {})])
 
+    def test_send_many_flushes_once(self):
+        messages = [seto.OrderCancel(order_id=order_id) for order_id in range(3)]
+        self.mock_session.send_many.return_value = 3
+        eq_(self.client.send_many(messages), 3)
+        self.assertEquals(
+            self.mock_session.method_calls,
+            [('send_many', (messages,), {}),
+             ('flush', (), {})])
+
     def test_each_instance_has_separate_callbacks(self):
         client_a, client_b = (StreamingAPIClient('_') for i in range(2))
         handler = Handler()
@@ -172,6 +182,58 @@ class SmarketsTestCase(unittest.TestCase):
         self.assertRaises(
             InvalidCallbackError, self.client.del_handler, 'foo', handler)
 
+    def test_dispatch_calls_handlers_by_payload_type(self):
+        "Test dispatching frames to named and global handlers"
+        pong_handler, accepted_handler, global_handler = Handler(), Handler(), Mock()
+        self.client.add_handler('eto.pong', pong_handler)
+        self.client.add_handler('seto.order_accepted', accepted_handler)
+        self.client.add_global_handler(global_handler)
+
+        pong = seto.Payload()
+        pong.type = seto.PAYLOAD_ETO
+        pong.eto_payload.type = eto.PAYLOAD_PONG
+        frame = Frame(bytes=None, protobuf=pong)
+        self.client._dispatch(frame)
+        eq_((pong_handler.call_count, accepted_handler.call_count), (1, 0))
+        global_handler.assert_called_once_with(name='eto.pong', message=frame)
+
+        self.client.del_handler('eto.pong', pong_handler)
+        self.client.del_global_handler(global_handler)
+        self.client._dispatch(frame)
+        eq_(pong_handler.call_count, 1)
+        eq_(global_handler.call_count, 1)
+
+    def test_handlers_added_to_the_signals_are_dispatched(self):
+        "Test handlers added to the callback signals directly are called and wanted"
+        pong_handler, global_handler = Handler(), Mock()
+        self.client.callbacks['eto.pong'] += pong_handler
+        self.client.global_callback += global_handler
+        self.assertTrue(self.client._wants_payload(seto.PAYLOAD_ETO, eto.PAYLOAD_PONG))
+
+        pong = seto.Payload()
+        pong.type = seto.PAYLOAD_ETO
+        pong.eto_payload.type = eto.PAYLOAD_PONG
+        frame = Frame(bytes=None, protobuf=pong)
+        self.client._dispatch(frame)
+        eq_(pong_handler.call_count, 1)
+        global_handler.assert_called_once_with(name='eto.pong', message=frame)
+
+        self.client.global_callback -= global_handler
+        self.assertTrue(self.client._wants_payload(seto.PAYLOAD_ETO, eto.PAYLOAD_PONG))
+        self.client.callbacks['eto.pong'] -= pong_handler
+        self.assertFalse(self.client._wants_payload(seto.PAYLOAD_ETO, eto.PAYLOAD_PONG))
+
+    def test_only_payloads_with_handlers_are_wanted(self):
+        "Test which payload types need to be parsed"
+        wants = self.client._wants_payload
+        self.assertFalse(wants(seto.PAYLOAD_ORDER_ACCEPTED, eto.PAYLOAD_NONE))
+        self.assertTrue(wants(seto.PAYLOAD_ETO, eto.PAYLOAD_LOGIN_RESPONSE))
+        self.client.add_handler('seto.order_accepted', Handler())
+        self.assertTrue(wants(seto.PAYLOAD_ORDER_ACCEPTED, eto.PAYLOAD_NONE))
+        self.assertFalse(wants(seto.PAYLOAD_ETO, eto.PAYLOAD_PONG))
+        self.client.add_global_handler(Handler())
+        self.assertTrue(wants(seto.PAYLOAD_ETO, eto.PAYLOAD_PONG))
+
     @staticmethod
     def _login_response():
         "Create a dummy login response payload"
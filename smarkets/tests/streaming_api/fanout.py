@@ -0,0 +1,175 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import multiprocessing
+import time
+import unittest
+
+from mock import patch
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises, eq_
+from six.moves.queue import Empty
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.fanout import (
+    _ordered_stores, _WorkerFilter, FanOutStreamingAPIClient, shared_memory, SharedFrameRing,
+)
+from smarkets.streaming_api.server import StreamingServer
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+def setup_module():
+    if shared_memory is None or not _ordered_stores():
+        raise SkipTest('shared memory rings are not available')
+
+
+def test_frames_of_any_size_go_around_the_ring():
+    ring = SharedFrameRing.create(slot_count=8, slot_size=32, consumer_count=1)
+    try:
+        reader = ring.reader(0)
+        payloads = [bytes(bytearray([number % 256])) * size for number, size in enumerate(
+            (0, 1, 16, 17, 40, 100, 3, 16, 33))]
+        for number, data in enumerate(payloads):
+            ring.publish(seto.PAYLOAD_ETO, number, data)
+            eq_(reader.read(), [(seto.PAYLOAD_ETO, number, data)])
+        eq_(reader.read(), [])
+        eq_(ring.published, len(payloads))
+        eq_(ring.consumer_stats(), [(0, len(payloads), 0, 0, 0)])
+        assert_raises(ValueError, ring.publish, seto.PAYLOAD_ETO, 0, b'x' * 200)
+    finally:
+        ring.close()
+
+
+def test_lapped_readers_count_lost_frames():
+    ring = SharedFrameRing.create(slot_count=4, slot_size=32, consumer_count=2)
+    try:
+        ahead, behind = ring.reader(0), ring.reader(1)
+        for number in range(3):
+            ring.publish(seto.PAYLOAD_ETO, number, b'%d' % number)
+        eq_(len(ahead.read()), 3)
+        for number in range(3, 10):
+            ring.publish(seto.PAYLOAD_ETO, number, b'%d' % number)
+        stats = ring.consumer_stats()
+        eq_([(stat.frames, stat.lag) for stat in stats], [(3, 7), (0, 10)])
+        eq_(behind.lag, 10)
+        # Both were lapped, everything which was overwritten is lost
+        eq_(ahead.read(), [])
+        eq_(behind.read(), [])
+        eq_([(stat.frames, stat.lag, stat.lost) for stat in ring.consumer_stats()], [(3, 0, 7), (0, 0, 10)])
+        ring.publish(seto.PAYLOAD_ETO, 10, b'10')
+        eq_(behind.read(), [(seto.PAYLOAD_ETO, 10, b'10')])
+    finally:
+        ring.close()
+
+
+def test_unwanted_frames_are_skipped():
+    ring = SharedFrameRing.create(slot_count=16, slot_size=32, consumer_count=1)
+    try:
+        reader = ring.reader(0, wanted=lambda seto_type, eto_type: seto_type == seto.PAYLOAD_CONTRACT_QUOTES)
+        ring.publish(seto.PAYLOAD_ETO, eto.PAYLOAD_HEARTBEAT, b'heartbeat')
+        ring.publish(seto.PAYLOAD_CONTRACT_QUOTES, 0, b'quotes' * 10)
+        eq_(reader.read(), [(seto.PAYLOAD_CONTRACT_QUOTES, 0, b'quotes' * 10)])
+        eq_((reader.frames, reader.lag), (2, 0))
+        assert_raises(ValueError, ring.reader, 1)
+    finally:
+        ring.close()
+
+
+def test_rings_need_ordered_stores():
+    with patch('platform.machine', return_value='aarch64'):
+        assert_raises(RuntimeError, SharedFrameRing.create, slot_count=8, slot_size=32, consumer_count=1)
+
+
+def test_payloads_too_large_for_the_ring_are_dropped():
+    client = FanOutStreamingAPIClient(Session(SessionSettings('username', 'password')))
+    client.ring = SharedFrameRing.create(slot_count=2, slot_size=32, consumer_count=1)
+    try:
+        client._publish(seto.PAYLOAD_ETO, eto.PAYLOAD_HEARTBEAT, 5, b'x' * 100)
+        client._publish(seto.PAYLOAD_ETO, eto.PAYLOAD_HEARTBEAT, 6, b'x' * 10)
+        eq_(client.payloads_dropped, 1)
+        eq_(client.ring.published, 1)
+    finally:
+        client.ring.close()
+
+
+def test_worker_filters():
+    worker_filter = _WorkerFilter(['seto.contract_quotes', 'eto.pong'], markets=[1])
+    assert worker_filter.wants_type(seto.PAYLOAD_CONTRACT_QUOTES, 0)
+    assert worker_filter.wants_type(seto.PAYLOAD_ETO, eto.PAYLOAD_PONG)
+    assert not worker_filter.wants_type(seto.PAYLOAD_ETO, eto.PAYLOAD_HEARTBEAT)
+    payload = seto.Payload(type=seto.PAYLOAD_CONTRACT_QUOTES)
+    payload.contract_quotes.market_id = 1
+    assert worker_filter.wants_market(payload)
+    payload.contract_quotes.market_id = 2
+    assert not worker_filter.wants_market(payload)
+    assert worker_filter.wants_market(seto.Payload(type=seto.PAYLOAD_ETO))
+    assert_raises(ValueError, _WorkerFilter, ['seto.nothing'])
+
+
+class _Collect(object):
+
+    "Handler sending what it was called with back to the test"
+
+    def __init__(self, index, queue):
+        self.index = index
+        self.queue = queue
+
+    def __call__(self, message):
+        self.queue.put((self.index, message.type, message.contract_quotes.market_id, message.eto_payload.seq))
+
+
+class FanOutStreamingAPIClientTestCase(unittest.TestCase):
+
+    "Tests for the fan-out client against the local server"
+
+    def setUp(self):
+        self.server = StreamingServer(quote_rate=2000)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_workers_get_the_payloads_they_filter_for(self):
+        host, port = self.server.address
+        settings = SessionSettings('username', 'password', host=host, port=port, ssl=False, socket_timeout=5)
+        client = FanOutStreamingAPIClient(Session(settings), slot_count=1024)
+        queue = multiprocessing.Queue()
+        client.add_worker(_Collect(0, queue), payload_types=['seto.contract_quotes'], markets=[1])
+        client.add_worker(_Collect(1, queue))
+        accepted = []
+        client.add_handler('seto.order_accepted', lambda message: accepted.append(message))
+        client.login()
+        client.start()
+        try:
+            assert_raises(RuntimeError, client.add_worker, _Collect(2, queue))
+            client.send_many([seto.MarketSubscribe(market_id=market_id) for market_id in (1, 2)])
+            client.send(seto.OrderCreate(
+                side=seto.SIDE_BUY, quantity=10000, price=2500, market_id=1, contract_id=1, reference=1))
+            client.flush()
+            deadline = time.time() + 5
+            while not accepted or client.session.inseq < 50:
+                assert time.time() < deadline, 'timed out'
+                client.read()
+            client.logout()
+            eq_([stat.lost for stat in client.consumer_stats()], [0, 0])
+        finally:
+            client.stop(timeout=5)
+
+        calls = []
+        # The workers finished, everything they sent is on its way
+        while True:
+            try:
+                calls.append(queue.get(timeout=0.5))
+            except Empty:
+                break
+        first = [call for call in calls if call[0] == 0]
+        everything = [call for call in calls if call[0] == 1]
+        # The second worker got every payload after the login response, up to the logout
+        seqs = [call[3] for call in everything]
+        eq_(seqs, list(range(2, len(seqs) + 2)))
+        assert len(seqs) >= 49
+        assert first
+        eq_(set(call[1:3] for call in first), set([(seto.PAYLOAD_CONTRACT_QUOTES, 1)]))
+        eq_([call[3] for call in first], sorted(call[3] for call in first))
+        assert (seto.PAYLOAD_ORDER_ACCEPTED, 0) in set(call[1:3] for call in everything)
+        eq_(len(accepted), 1)
+        eq_(client.consumer_stats(), [])
@@ -5,8 +5,10 @@ from itertools import chain
 from nose.tools import eq_, raises
 from six.moves import xrange
 
+from smarkets.streaming_api import eto, seto
 from smarkets.streaming_api.framing import (
-    frame_decode_all, frame_encode, IncompleteULEB128, uleb128_decode, uleb128_encode,
+    frame_decode_all, frame_encode, frame_header, FrameDecoder, IncompleteULEB128, peek_payload_header,
+    uleb128_decode, uleb128_encode,
 )
 
 
@@ -81,31 +83,148 @@ def check_frame_encode(byte_array, output):
     eq_(frame, output)
 
 
+FRAME_DECODE_CASES = (
+    # frame matches the boundary
+    (b'', ([], b'')),
+    (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd', ([b'a', b'ab', b'abc', b'abcd'], b'')),
+
+    # ends with complete header but only part of a message
+    (b'\x03ab', ([], b'\x03ab')),
+    (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd\x03ab', ([b'a', b'ab', b'abc', b'abcd'], b'\x03ab')),
+    (b'\x05abcd', ([], b'\x05abcd')),
+
+    # ends with incomplete header
+    (b'\x80', ([], b'\x80')),
+    (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd\x03ab', ([b'a', b'ab', b'abc', b'abcd'], b'\x03ab')),
+
+    # 4(or more)-byte incomplete header is a special case because it reaches the minimum frame size
+    # so let's make sure decoding doesn't fail at header decoding stage
+    (b'\x80\x80\x80\x80', ([], b'\x80\x80\x80\x80')),
+    (b'\x80\x80\x80\x80\x80', ([], b'\x80\x80\x80\x80\x80')),
+
+    # regression: if the second frame is shorter, we still want to decode both...
+    (b'\x05abcde\x03abc', ([b'abcde', b'abc'], b'')),
+)
+
+
 def test_frame_decode_all():
-    for input_, output in (
-        # frame matches the boundary
-        (b'', ([], b'')),
-        (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd', ([b'a', b'ab', b'abc', b'abcd'], b'')),
-
-        # ends with complete header but only part of a message
-        (b'\x03ab', ([], b'\x03ab')),
-        (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd\x03ab', ([b'a', b'ab', b'abc', b'abcd'], b'\x03ab')),
-        (b'\x05abcd', ([], b'\x05abcd')),
-
-        # ends with incomplete header
-        (b'\x80', ([], b'\x80')),
-        (b'\x01a\x00\x00\x02ab\x00\x03abc\x04abcd\x03ab', ([b'a', b'ab', b'abc', b'abcd'], b'\x03ab')),
-
-        # 4(or more)-byte incomplete header is a special case because it reaches the minimum frame size
-        # so let's make sure decoding doesn't fail at header decoding stage
-        (b'\x80\x80\x80\x80', ([], b'\x80\x80\x80\x80')),
-        (b'\x80\x80\x80\x80\x80', ([], b'\x80\x80\x80\x80\x80')),
-
-        # regression: if the second frame is shorter, we still want to decode both...
-        (b'\x05abcde\x03abc', ([b'abcde', b'abc'], b'')),
-    ):
+    for input_, output in FRAME_DECODE_CASES:
         yield check_frame_decode_all, bytearray(input_), output
 
 
 def check_frame_decode_all(byte_array, output):
     eq_(frame_decode_all(byte_array), output)
+
+
+def test_frame_decoder():
+    for input_, output in FRAME_DECODE_CASES:
+        for chunk_size in (1, 3, len(input_) or 1):
+            yield check_frame_decoder, input_, chunk_size, output
+
+
+def check_frame_decoder(input_, chunk_size, output):
+    expected_payloads, expected_remaining = output
+    decoder = FrameDecoder()
+    payloads = []
+    for i in xrange(0, len(input_), chunk_size):
+        decoder.feed(input_[i:i + chunk_size])
+        payloads.extend(payload.tobytes() for payload in decoder)
+    eq_(payloads, expected_payloads)
+    eq_(decoder.pending_bytes, len(expected_remaining))
+
+
+def test_frame_decoder_moves_pending_bytes_to_the_front():
+    decoder = FrameDecoder(capacity=8)
+    decoder.feed(b'\x03abc\x03de')
+    eq_(decoder.next_payload().tobytes(), b'abc')
+    decoder.feed(b'f\x02gh\x00')
+    eq_(decoder.capacity, 8)
+    eq_([payload.tobytes() for payload in decoder], [b'def', b'gh'])
+
+
+def test_frame_decoder_grows_for_large_frames():
+    decoder = FrameDecoder(capacity=4)
+    payload = b'x' * 100
+    frame = bytearray()
+    frame_encode(frame, payload)
+    for i in xrange(0, len(frame), 7):
+        view = decoder.reserve(7)
+        chunk = frame[i:i + 7]
+        view[:len(chunk)] = chunk
+        decoder.commit(len(chunk))
+    eq_(decoder.next_payload().tobytes(), payload)
+    eq_(decoder.pending_bytes, 0)
+    assert decoder.capacity >= len(frame)
+
+
+def test_frame_decoder_counts_complete_frames():
+    decoder = FrameDecoder(capacity=8)
+    decoder.feed(b'\x03abc\x03de')
+    eq_(decoder.frame_count, 1)
+    decoder.feed(b'f\x02gh\x00\x05')
+    eq_(decoder.frame_count, 3)
+    eq_(decoder.next_payload().tobytes(), b'abc')
+    eq_(decoder.frame_count, 2)
+    # Pending bytes are moved to the front
+    decoder.feed(b'vwxyz')
+    eq_(decoder.frame_count, 3)
+    eq_([payload.tobytes() for payload in decoder], [b'def', b'gh', b'vwxyz'])
+    eq_(decoder.frame_count, 0)
+    decoder.feed(b'\x01a\x00\x00')
+    eq_(decoder.frame_count, 1)
+
+
+def test_frame_decoder_clear_drops_everything():
+    decoder = FrameDecoder(capacity=8)
+    decoder.feed(b'\x03abc\x05de')
+    eq_(decoder.frame_count, 1)
+    decoder.clear()
+    eq_((decoder.pending_bytes, decoder.frame_count), (0, 0))
+    decoder.feed(b'\x02fg\x00')
+    eq_([payload.tobytes() for payload in decoder], [b'fg'])
+
+
+def _payloads_to_peek():
+    heartbeat = seto.Payload()
+    heartbeat.type = seto.PAYLOAD_ETO
+    heartbeat.eto_payload.type = eto.PAYLOAD_HEARTBEAT
+    heartbeat.eto_payload.seq = 300
+
+    accepted = seto.Payload()
+    accepted.type = seto.PAYLOAD_ORDER_ACCEPTED
+    accepted.eto_payload.seq = 2 ** 40
+    accepted.order_accepted.seq = 1
+    accepted.order_accepted.order_id = 12345
+    accepted.order_accepted.reference = 1
+
+    return heartbeat, accepted
+
+
+def test_peek_payload_header():
+    for payload in _payloads_to_peek():
+        yield check_peek_payload_header, payload
+
+
+def check_peek_payload_header(payload):
+    eq_(peek_payload_header(bytearray(payload.SerializeToString())),
+        (payload.type, payload.eto_payload.type, payload.eto_payload.seq))
+
+
+def test_peek_payload_header_gives_up_on_truncated_payloads():
+    for payload in _payloads_to_peek():
+        serialized = bytearray(payload.SerializeToString())
+        eto_payload_end = 4 + len(payload.eto_payload.SerializeToString())
+        for i in xrange(eto_payload_end):
+            yield check_peek_payload_header_gives_up, serialized[:i]
+
+
+def check_peek_payload_header_gives_up(serialized):
+    eq_(peek_payload_header(serialized), None)
+
+
+def test_frame_header_matches_frame_encode():
+    for byte_count in (0, 1, 2, 3, 127, 128, 300):
+        header, padding = frame_header(byte_count)
+        frame = bytearray()
+        frame_encode(frame, b'x' * byte_count)
+        eq_(bytes(frame), header + b'x' * byte_count + padding)
@@ -0,0 +1,143 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import unittest
+
+from mock import Mock, patch
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_decode_all, frame_encode
+from smarkets.streaming_api.keepalive import KeepaliveScheduler
+from smarkets.streaming_api.server import StreamingServer
+from smarkets.streaming_api.session import FLUSH_POLICY_EXPLICIT, Session, SessionSettings
+from smarkets.streaming_api.templates import PING_TEMPLATE
+from smarkets.streaming_api.threaded import ThreadedStreamingAPIClient
+
+
+def _session():
+    session = Session(SessionSettings(
+        'username', 'password', flush_policy=FLUSH_POLICY_EXPLICIT, vectored_flush=False))
+    session.socket = Mock()
+    session.socket.connected = True
+    session.sent = bytearray()
+
+    def send(data):
+        session.sent.extend(data)
+        return len(data)
+
+    session.socket.send.side_effect = send
+    return session
+
+
+def _sent_types(session):
+    payloads, _ = frame_decode_all(session.sent)
+    types = []
+    for data in payloads:
+        payload = seto.Payload()
+        payload.ParseFromString(bytes(data))
+        types.append(payload.eto_payload.type)
+    return types
+
+
+def test_keepalives_are_sent_when_nothing_was_written_for_the_interval():
+    session = _session()
+    keepalive = KeepaliveScheduler(session, interval=10, template=PING_TEMPLATE)
+    with patch('smarkets.streaming_api.session._monotonic', return_value=100.0):
+        eq_(keepalive.run_pending(now=100.0), True)
+    eq_(session.last_sent_at, 100.0)
+    eq_(keepalive.next_due(now=101.0), 110.0)
+    eq_(keepalive.run_pending(now=109.0), False)
+    with patch('smarkets.streaming_api.session._monotonic', return_value=110.0):
+        eq_(keepalive.run_pending(now=110.0), True)
+    eq_(keepalive.keepalives_sent, 2)
+    eq_(_sent_types(session), [eto.PAYLOAD_PING, eto.PAYLOAD_PING])
+    session.socket.connected = False
+    eq_(keepalive.run_pending(now=200.0), False)
+    assert_raises(ValueError, KeepaliveScheduler, session, interval=0)
+
+
+def test_buffered_payloads_are_flushed_as_the_keepalive():
+    session = _session()
+    keepalive = KeepaliveScheduler(session, interval=10, template=PING_TEMPLATE)
+    with patch('smarkets.streaming_api.session._monotonic', return_value=100.0):
+        eq_(keepalive.run_pending(now=100.0), True)
+    session.send_template(PING_TEMPLATE)
+    session.send_template(PING_TEMPLATE)
+    # The explicit flush policy leaves them in the send buffer
+    eq_(_sent_types(session), [eto.PAYLOAD_PING])
+    eq_(keepalive.next_due(now=101.0), 110.0)
+    eq_(keepalive.run_pending(now=109.0), False)
+    with patch('smarkets.streaming_api.session._monotonic', return_value=110.0):
+        eq_(keepalive.run_pending(now=110.0), True)
+    eq_(session.output_buffer_size, 0)
+    eq_(keepalive.keepalives_sent, 2)
+    eq_(_sent_types(session), [eto.PAYLOAD_PING] * 3)
+    eq_(session.last_sent_at, 110.0)
+
+
+def test_heartbeat_replies_are_flushed_without_waiting_for_the_application():
+    session = _session()
+    keepalive = KeepaliveScheduler(session, interval=10)
+    heartbeat = seto.Payload()
+    heartbeat.type = seto.PAYLOAD_ETO
+    heartbeat.eto_payload.type = eto.PAYLOAD_HEARTBEAT
+    heartbeat.eto_payload.seq = 1
+    frames = bytearray()
+    frame_encode(frames, heartbeat.SerializeToString())
+    session.decoder.feed(frames)
+    eq_(len(list(session.next_frames())), 1)
+    # The explicit flush policy holds the reply back
+    assert session.heartbeat_pending
+    eq_(session.socket.send.call_count, 0)
+    eq_(keepalive.run_pending(), True)
+    eq_((keepalive.heartbeat_flushes, keepalive.keepalives_sent), (1, 0))
+    assert not session.heartbeat_pending
+    eq_(_sent_types(session), [eto.PAYLOAD_HEARTBEAT])
+
+
+class KeepaliveThreadTestCase(unittest.TestCase):
+
+    "Tests for keepalives sent from a background thread to the local server"
+
+    def setUp(self):
+        self.server = StreamingServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_keepalives_flow_while_handlers_are_busy(self):
+        host, port = self.server.address
+        settings = SessionSettings('username', 'password', host=host, port=port, ssl=False, socket_timeout=5)
+        client = ThreadedStreamingAPIClient(Session(settings), keepalive_interval=0.02)
+        client.login()
+        busy = threading.Event()
+        release = threading.Event()
+
+        def on_pong(message):
+            busy.set()
+            release.wait(5)
+
+        client.add_handler('eto.pong', on_pong)
+        client.start()
+        try:
+            assert client.keepalive.running
+            client.ping()
+            client.flush()
+            # The server has handled the ping once its pong is being handled, everything it
+            # receives from now on is a keepalive
+            assert busy.wait(5), 'timed out'
+            received = self.server.stats.payloads_received
+            deadline = time.time() + 5
+            while self.server.stats.payloads_received < received + 5:
+                assert time.time() < deadline, 'timed out'
+                time.sleep(0.005)
+            # Keepalives are counted after they're sent, under the lock
+            with client.keepalive.lock:
+                assert client.keepalive.keepalives_sent >= 5
+        finally:
+            release.set()
+            client.stop(timeout=5)
+        assert not client.keepalive.running
@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+
+from mock import Mock, patch
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api.client import (
+    READ_MODE_BUFFER_FROM_SOCKET, READ_MODE_DISPATCH_FROM_BUFFER, StreamingAPIClient,
+)
+from smarkets.streaming_api.framing import frame_encode
+from smarkets.streaming_api.latency import (
+    _bucket_index, LatencyHistogram, LatencyStats, STAGE_DISPATCH, STAGE_PARSE, STAGE_QUEUED, STAGE_TOTAL,
+)
+from smarkets.streaming_api.session import Session, SessionSettings
+from smarkets.tests.streaming_api.payloads import eto_payload
+
+
+def close_to(value, expected):
+    "Check that a value read from a histogram is within bucket precision"
+    return expected <= value <= expected * 1.125
+
+
+def test_histogram_percentiles_are_within_bucket_precision():
+    histogram = LatencyHistogram()
+    for microseconds in range(1, 1001):
+        histogram.add(microseconds / 1e6)
+    eq_(histogram.count, 1000)
+    assert close_to(histogram.max, 1000e-6), histogram.max
+    assert abs(histogram.mean - 500.5e-6) < 500.5e-6 * 0.0625, histogram.mean
+    for percent, expected in ((50, 500e-6), (90, 900e-6), (99, 990e-6), (100, 1000e-6)):
+        value = histogram.percentile(percent)
+        assert close_to(value, expected), (percent, value)
+    eq_(sum(count for low, high, count in histogram.buckets()), 1000)
+
+
+def test_histogram_buckets_contain_their_values():
+    for nanoseconds in itertools.chain(range(50), (127, 128, 1000, 123456789, 2 ** 40 + 1, 2 ** 63 - 1)):
+        histogram = LatencyHistogram()
+        histogram.counts[_bucket_index(nanoseconds)] += 1
+        [(low, high, count)] = histogram.buckets()
+        assert low * 1e9 <= nanoseconds * (1 + 1e-12) and nanoseconds <= high * 1e9 * (1 + 1e-12), (
+            nanoseconds, low, high)
+
+
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+    eq_((histogram.count, histogram.mean, histogram.max, histogram.percentile(99), list(histogram.buckets())),
+        (0, 0.0, 0.0, 0.0, []))
+
+
+def test_stats_per_payload_type_and_combined():
+    stats = LatencyStats()
+    stats.record('eto.pong', 1000, 1500, 1750, 2000)
+    stats.record('seto.contract_quotes', 1000, 1250, 1500, 4000)
+    eq_(stats.names, ['eto.pong', 'seto.contract_quotes'])
+    assert close_to(stats.histogram('eto.pong', STAGE_QUEUED).max, 500e-9)
+    assert close_to(stats.histogram('eto.pong', STAGE_PARSE).max, 250e-9)
+    assert close_to(stats.histogram('seto.contract_quotes', STAGE_DISPATCH).max, 2500e-9)
+    combined = stats.histogram()
+    eq_(combined.count, 2)
+    assert close_to(combined.max, 3000e-9)
+    eq_(stats.histogram('seto.order_accepted').count, 0)
+    assert_raises(ValueError, stats.histogram, 'eto.pong', 'kernel')
+
+    snapshot = stats.snapshot(percentiles=(50,))
+    eq_(sorted(snapshot['eto.pong'][STAGE_TOTAL]), ['count', 'max', 'mean', 'p50'])
+    eq_(snapshot['eto.pong'][STAGE_TOTAL]['count'], 1)
+    assert close_to(snapshot['eto.pong'][STAGE_TOTAL]['p50'], 1000e-9)
+    stats.reset()
+    eq_(stats.names, [])
+
+
+def test_client_times_frames_from_the_read_which_completed_them():
+    session = Session(SessionSettings('username', 'password'))
+    session.socket = Mock()
+    session.latency = LatencyStats()
+    frames = bytearray()
+    frame_encode(frames, eto_payload(1))
+    frame_encode(frames, eto_payload(2))
+    # The first read gets the first frame and half of the second one
+    chunks = [frames[:len(frames) * 3 // 4], frames[len(frames) * 3 // 4:]]
+
+    def recv_into(buffer, nbytes):
+        chunk = chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    session.socket.recv_into.side_effect = recv_into
+    client = StreamingAPIClient(session)
+    pongs = []
+    client.add_handler('eto.pong', lambda message: pongs.append(message.eto_payload.seq))
+    clock = itertools.count(1000, 1000)
+    with patch('smarkets.streaming_api.session._monotonic_ns', side_effect=lambda: next(clock)):
+        client.read(READ_MODE_BUFFER_FROM_SOCKET)
+        client.read(READ_MODE_BUFFER_FROM_SOCKET)
+        eq_(client.read(READ_MODE_DISPATCH_FROM_BUFFER), 2)
+    eq_(pongs, [1, 2])
+    # Reads at 1 and 2 microseconds, then every frame is taken out of the buffer, parsed and
+    # dispatched at 3, 4, 5 and 6, 7, 8 microseconds
+    queued = session.latency.histogram('eto.pong', STAGE_QUEUED)
+    [(low1, high1, count1), (low2, high2, count2)] = queued.buckets()
+    assert low1 <= 2000e-9 <= high1 and low2 <= 4000e-9 <= high2
+    eq_([count for low, high, count in session.latency.histogram('eto.pong', STAGE_PARSE).buckets()], [2])
+    eq_([count for low, high, count in session.latency.histogram('eto.pong', STAGE_DISPATCH).buckets()], [2])
+    assert close_to(session.latency.histogram('eto.pong', STAGE_TOTAL).max, 6000e-9)
+    eq_(len(session._read_times), 1)
@@ -0,0 +1,41 @@
+"Payloads and frames shared by the streaming API tests"
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_encode
+
+
+def eto_payload(seq, eto_type=eto.PAYLOAD_PONG):
+    "Serialised seto payload carrying an eto payload of `eto_type`"
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_ETO
+    payload.eto_payload.type = eto_type
+    payload.eto_payload.seq = seq
+    return payload.SerializeToString()
+
+
+def quote_payload(seq, market_id=1):
+    "Serialised market quotes payload"
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_MARKET_QUOTES
+    payload.market_quotes.market_id = market_id
+    payload.eto_payload.seq = seq
+    return payload.SerializeToString()
+
+
+def framed(payloads):
+    "Frames of the serialised `payloads`, in order"
+    frames = bytearray()
+    for data in payloads:
+        frame_encode(frames, data)
+    return frames
+
+
+def pong_frames(count, first_seq=1):
+    "Frames of `count` pongs with sequence numbers from `first_seq` on"
+    return framed(eto_payload(seq) for seq in range(first_seq, first_seq + count))
+
+
+def quote_frames(count, first_seq=1):
+    "Frames of `count` market quotes with sequence numbers from `first_seq` on"
+    return framed(quote_payload(seq) for seq in range(first_seq, first_seq + count))
@@ -0,0 +1,103 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import time
+import unittest
+
+from mock import Mock
+from nose.tools import eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.framing import frame_decode_all
+from smarkets.streaming_api.reactor import Reactor
+from smarkets.streaming_api.session import Session, SessionSettings
+from smarkets.tests.streaming_api.payloads import pong_frames
+
+
+class ReactorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = Reactor(read_limit=3)
+        self.peers = []
+        self.clients = []
+        self.pongs = []
+
+    def tearDown(self):
+        for client in self.reactor.clients:
+            self.reactor.unregister(client)
+        for sock in self.peers:
+            sock.close()
+        for client in self.clients:
+            client.session.disconnect()
+
+    def _client(self, keepalive_interval=None, **settings):
+        local, peer = socket.socketpair()
+        session = Session(SessionSettings('username', 'password', ssl=False, **settings))
+        session.socket._sock = local
+        client = StreamingAPIClient(session)
+        index = len(self.clients)
+        client.add_handler('eto.pong', lambda message: self.pongs.append((index, message.eto_payload.seq)))
+        self.reactor.register(client, keepalive_interval)
+        self.peers.append(peer)
+        self.clients.append(client)
+        return client, peer
+
+    def test_dispatches_from_every_ready_client_within_read_limit(self):
+        for _ in range(2):
+            client, peer = self._client()
+            peer.sendall(pong_frames(5))
+
+        eq_(self.reactor.run_once(timeout=1), 6)
+        eq_(sorted(self.pongs), [(0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3)])
+
+        # Leftovers are dispatched even though the sockets have nothing new to read
+        eq_(self.reactor.run_once(timeout=1), 4)
+        eq_(len(self.pongs), 10)
+        eq_(self.reactor.run_once(timeout=0), 0)
+
+    def test_flushes_pending_messages_when_writable(self):
+        client, peer = self._client()
+        client.ping()
+        self.reactor.run_once(timeout=1)
+        eq_(client.output_buffer_size, 0)
+        peer.settimeout(1)
+        data = peer.recv(1024)
+        payload = seto.Payload()
+        payload.ParseFromString(data[1:])
+        eq_(payload.eto_payload.type, eto.PAYLOAD_PING)
+
+    def test_drops_disconnected_clients(self):
+        callback = Mock()
+        self.reactor.disconnected += callback
+        client, peer = self._client()
+        peer.close()
+        self.reactor.run_once(timeout=1)
+        eq_(self.reactor.clients, [])
+        eq_(callback.call_args[1]['client'], client)
+
+    def test_sends_keepalives_on_time(self):
+        client, peer = self._client(keepalive_interval=0.05)
+        started = time.time()
+        eq_(self.reactor.run_once(timeout=5), 0)
+        assert time.time() - started < 1
+        peer.settimeout(1)
+        [payload], _ = frame_decode_all(bytearray(peer.recv(1024)))
+        heartbeat = seto.Payload()
+        heartbeat.ParseFromString(bytes(payload))
+        eq_((heartbeat.eto_payload.type, heartbeat.eto_payload.seq), (eto.PAYLOAD_HEARTBEAT, 1))
+
+    def test_overloaded_clients_are_not_read_from(self):
+        client, peer = self._client(inbound_high_water_frames=4)
+        peer.sendall(pong_frames(7))
+        eq_(self.reactor.run_once(timeout=1), 3)
+        eq_(client.session.overloaded, True)
+        received = client.session.decoder.received
+        peer.sendall(pong_frames(3, first_seq=8))
+        # Only buffered frames are handled until the client catches up
+        eq_(self.reactor.run_once(timeout=1), 3)
+        eq_(client.session.decoder.received, received)
+        eq_(client.session.overloaded, False)
+        for _ in range(3):
+            self.reactor.run_once(timeout=1)
+        eq_([seq for _, seq in self.pongs], list(range(1, 11)))
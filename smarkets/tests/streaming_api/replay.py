@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api import eto
+from smarkets.streaming_api.capture import CaptureRecorder, DIRECTION_IN, DIRECTION_OUT
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import SocketDisconnected
+from smarkets.streaming_api.framing import frame_decode_all
+from smarkets.streaming_api.replay import replay, ReplaySocket
+from smarkets.streaming_api.session import Session, SessionSettings
+from smarkets.tests.streaming_api.capture import TempDir
+from smarkets.tests.streaming_api.payloads import eto_payload
+
+
+def _write_capture(path, timestamps, first_seq=10):
+    with CaptureRecorder(path) as recorder:
+        for seq, timestamp in enumerate(timestamps, first_seq):
+            recorder.record(DIRECTION_IN, seq, eto_payload(seq), timestamp)
+            recorder.record(DIRECTION_OUT, seq, eto_payload(seq, eto.PAYLOAD_PING), timestamp)
+
+
+def test_replay_dispatches_captured_payloads():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'replay.cap')
+        _write_capture(path, [float(i) for i in range(50)])
+        client = StreamingAPIClient(Session(SessionSettings('username', 'password')))
+        seqs = []
+        client.add_handler('eto.pong', lambda message: seqs.append(message.eto_payload.seq))
+        eq_(replay(client, path), 50)
+        eq_(seqs, list(range(10, 60)))
+        eq_(client.session.inseq, 60)
+
+
+def test_replay_goes_on_across_reconnects():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'reconnect.cap')
+        with CaptureRecorder(path) as recorder:
+            for _ in range(2):
+                for seq in (1, 2, 3):
+                    recorder.record(DIRECTION_OUT, seq, eto_payload(seq, eto.PAYLOAD_PING), float(seq))
+                    recorder.record(DIRECTION_IN, seq, eto_payload(seq), float(seq))
+        client = StreamingAPIClient(Session(SessionSettings('username', 'password')))
+        seqs = []
+        client.add_handler('eto.pong', lambda message: seqs.append(message.eto_payload.seq))
+        eq_(replay(client, path), 6)
+        eq_(seqs, [1, 2, 3, 1, 2, 3])
+        eq_(client.session.inseq, 4)
+        eq_(client.session.sequence_stats.duplicates, 0)
+
+
+def test_replies_do_not_pile_up_during_replay():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'heartbeats.cap')
+        with CaptureRecorder(path) as recorder:
+            for seq in range(1, 2001):
+                recorder.record(DIRECTION_IN, seq, eto_payload(seq, eto.PAYLOAD_HEARTBEAT), float(seq))
+        session = Session(SessionSettings('username', 'password'))
+        session.settings.read_chunksize = 256
+        client = StreamingAPIClient(session)
+        buffered = []
+        client.add_handler('eto.heartbeat', lambda message: buffered.append(session.output_buffer_size))
+        eq_(replay(client, path), 2000)
+        assert max(buffered) < 1024, max(buffered)
+        eq_(session.output_buffer_size, 0)
+
+
+def test_empty_captures_have_no_records():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'empty.cap')
+        open(path, 'wb').close()
+        client = StreamingAPIClient(Session(SessionSettings('username', 'password')))
+        eq_(replay(client, path), 0)
+        eq_(client.session.inseq, 1)
+
+
+def test_frames_are_split_across_reads():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'split.cap')
+        _write_capture(path, [0.0, 0.0, 0.0])
+        socket = ReplaySocket(path)
+        data = bytearray()
+        while True:
+            buffer = bytearray(5)
+            try:
+                received = socket.recv_into(buffer, 5)
+            except SocketDisconnected:
+                break
+            data += buffer[:received]
+        socket.close()
+        payloads, rest = frame_decode_all(data)
+        eq_([bytes(payload) for payload in payloads], [eto_payload(seq) for seq in (10, 11, 12)])
+        eq_(len(rest), 0)
+
+
+def test_scaled_time_replay_waits_for_due_payloads():
+    with TempDir() as directory:
+        path = os.path.join(directory, 'timed.cap')
+        _write_capture(path, [100.0, 100.0, 101.0, 104.0])
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        socket = ReplaySocket(path, speed=2.0, clock=lambda: now[0], sleep=sleep)
+        buffer = bytearray(1024)
+        received = []
+        for _ in range(3):
+            size = socket.recv_into(buffer, len(buffer))
+            received.append([bytes(payload) for payload in frame_decode_all(buffer[:size])[0]])
+        eq_(received, [
+            [eto_payload(10), eto_payload(11)],
+            [eto_payload(12)],
+            [eto_payload(13)],
+        ])
+        eq_(sleeps, [0.5, 1.5])
+        assert_raises(SocketDisconnected, socket.recv_into, buffer, len(buffer))
+        socket.close()
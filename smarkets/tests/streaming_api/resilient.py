@@ -0,0 +1,134 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+import unittest
+
+from mock import patch
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api import seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import ConnectionError, SocketDisconnected
+from smarkets.streaming_api.resilient import ResilientStreamingAPIClient
+from smarkets.streaming_api.server import StreamingServer
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+def test_backoff_grows_with_jitter():
+    client = ResilientStreamingAPIClient(
+        Session(SessionSettings('username', 'password')), initial_backoff=0.1, max_backoff=1.0)
+    with patch('smarkets.streaming_api.resilient._random', return_value=1.0):
+        eq_([client.backoff(attempt) for attempt in range(6)], [0.0, 0.1, 0.2, 0.4, 0.8, 1.0])
+    with patch('smarkets.streaming_api.resilient._random', return_value=0.0):
+        eq_(client.backoff(3), 0.2)
+
+
+class ResilientStreamingAPIClientTestCase(unittest.TestCase):
+
+    "Tests for the reconnecting client against the local server"
+
+    def setUp(self):
+        self.server = StreamingServer(quote_rate=1000)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def settings(self):
+        host, port = self.server.address
+        return SessionSettings('username', 'password', host=host, port=port, ssl=False, socket_timeout=5)
+
+    def read_until(self, client, condition):
+        deadline = time.time() + 5
+        while not condition():
+            assert time.time() < deadline, 'timed out'
+            client.read()
+
+    def test_reconnects_and_replays_missed_account_payloads(self):
+        client = ResilientStreamingAPIClient(Session(self.settings()), initial_backoff=0.01)
+        accepted = []
+        quotes = []
+        reconnects = []
+        client.add_handler('seto.order_accepted', lambda message: accepted.append(message))
+        client.add_handler('seto.contract_quotes', lambda message: quotes.append(message))
+        client.reconnected += lambda duration, attempts: reconnects.append((duration, attempts))
+        client.login()
+        client.send(seto.MarketSubscribe(market_id=7))
+        client.send(seto.OrderCreate(
+            side=seto.SIDE_BUY, quantity=10000, price=2500, market_id=7, contract_id=1, reference=1))
+        client.flush()
+        self.read_until(client, lambda: accepted and quotes)
+        eq_(client.session.account_sequence, 1)
+
+        self.server.drop_connections()
+        deadline = time.time() + 5
+        while self.server.connections:
+            assert time.time() < deadline, 'timed out'
+            time.sleep(0.005)
+        # Another connection of the same account places an order meanwhile
+        other = StreamingAPIClient(Session(self.settings()))
+        other.login()
+        other.send(seto.OrderCreate(
+            side=seto.SIDE_SELL, quantity=10000, price=2600, market_id=7, contract_id=1, reference=2))
+        other.flush()
+        other_accepted = []
+        other.add_handler('seto.order_accepted', lambda message: other_accepted.append(message))
+        self.read_until(other, lambda: other_accepted)
+        other.logout()
+
+        del quotes[:]
+        self.read_until(client, lambda: len(accepted) == 2 and quotes)
+        eq_([message.order_accepted.reference for message in accepted], [1, 2])
+        eq_([message.eto_payload.is_replay for message in accepted], [False, True])
+        eq_(client.session.account_sequence, 2)
+        eq_(set(quote.contract_quotes.market_id for quote in quotes), set([7]))
+        stats = client.reconnect_stats
+        eq_((stats.reconnects, stats.failed_attempts, stats.messages_replayed), (1, 0, 1))
+        eq_(stats.durations.count, 1)
+        eq_(len(reconnects), 1)
+        eq_(reconnects[0][1], 1)
+        assert 0 < reconnects[0][0] == stats.last_duration
+        client.logout()
+
+    def test_reconnects_after_losing_the_connection_mid_frame(self):
+        client = ResilientStreamingAPIClient(Session(self.settings()), initial_backoff=0.01)
+        quotes = []
+        client.add_handler('seto.contract_quotes', lambda message: quotes.append(message))
+        client.login()
+        client.send(seto.MarketSubscribe(market_id=7))
+        client.flush()
+        self.read_until(client, lambda: quotes)
+
+        self.server.drop_connections()
+        session = client.session
+        # Receive everything sent before the connection was dropped, followed by the start
+        # of a frame which was cut off
+        try:
+            while True:
+                session.receive()
+        except (ConnectionError, SocketDisconnected):
+            pass
+        session.decoder.feed(b'\x40abc')
+
+        del quotes[:]
+        self.read_until(client, lambda: quotes)
+        eq_(client.reconnect_stats.reconnects, 1)
+        client.logout()
+
+    def test_gives_up_after_max_attempts(self):
+        client = ResilientStreamingAPIClient(Session(self.settings()), max_attempts=3)
+        client.login()
+        self.server.stop()
+        delays = []
+        with patch('smarkets.streaming_api.resilient._sleep', side_effect=delays.append):
+            assert_raises((ConnectionError, SocketDisconnected), client.read)
+        eq_(len(delays), 3)
+        eq_(client.reconnect_stats.failed_attempts, 3)
+        eq_(client.reconnect_stats.reconnects, 0)
+
+    def test_does_not_reconnect_after_logging_out(self):
+        client = ResilientStreamingAPIClient(Session(self.settings()))
+        client.login()
+        client.logout()
+        assert_raises(SocketDisconnected, client.read)
+        eq_(client.reconnect_stats.reconnects, 0)
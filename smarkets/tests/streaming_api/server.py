@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+import unittest
+
+from mock import patch
+from nose.tools import eq_
+
+from smarkets.streaming_api import seto
+from smarkets.streaming_api.client import StreamingAPIClient
+from smarkets.streaming_api.exceptions import LoginError
+from smarkets.streaming_api.server import StreamingServer
+from smarkets.streaming_api.session import Session, SessionSettings
+
+
+class StreamingServerTestCase(unittest.TestCase):
+
+    "Tests for the local server with a real client over loopback"
+
+    def setUp(self):
+        self.server = StreamingServer(quote_rate=2000, password='password')
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, password='password'):
+        host, port = self.server.address
+        settings = SessionSettings('username', password, host=host, port=port, ssl=False, socket_timeout=5)
+        return StreamingAPIClient(Session(settings))
+
+    def read_until(self, client, condition):
+        deadline = time.time() + 5
+        while not condition():
+            assert time.time() < deadline, 'timed out'
+            client.read()
+
+    def test_login_ping_and_logout(self):
+        client = self.client()
+        client.login()
+        pongs = []
+        client.add_handler('eto.pong', lambda message: pongs.append(message))
+        client.ping()
+        client.flush()
+        self.read_until(client, lambda: pongs)
+        eq_(client.session.inseq, 3)
+        client.logout()
+        assert not client.session.connected
+
+    def test_wrong_password_is_rejected(self):
+        client = self.client(password='wrong')
+        self.assertRaises(LoginError, client.login)
+
+    def test_quotes_and_orders(self):
+        client = self.client()
+        client.login()
+        quotes = []
+        accepted = []
+        cancelled = []
+        client.add_handler('seto.contract_quotes', lambda message: quotes.append(message))
+        client.add_handler('seto.order_accepted', lambda message: accepted.append(message))
+        client.add_handler('seto.order_cancelled', lambda message: cancelled.append(message))
+        client.send(seto.MarketSubscribe(market_id=7))
+        client.send(seto.OrderCreate(
+            side=seto.SIDE_BUY, quantity=10000, price=2500, market_id=7, contract_id=1, reference=42))
+        client.flush()
+        self.read_until(client, lambda: accepted and len(quotes) >= 20)
+        eq_(set(quote.contract_quotes.market_id for quote in quotes), set([7]))
+        eq_((accepted[0].order_accepted.reference, accepted[0].order_accepted.seq), (42, 3))
+        client.send(seto.OrderCancel(order_id=accepted[0].order_accepted.order_id))
+        client.flush()
+        self.read_until(client, lambda: cancelled)
+        eq_(self.server.stats.orders_cancelled, 1)
+        client.logout()
+
+    def test_quote_depth_and_bursts(self):
+        self.server.stop()
+        self.server = StreamingServer(quote_rate=2000, quote_depth=3, quote_burst=50, password='password')
+        self.server.start()
+        client = self.client()
+        client.login()
+        quotes = []
+        client.add_handler('seto.contract_quotes', lambda message: quotes.append(message))
+        client.send(seto.MarketSubscribe(market_id=7))
+        client.flush()
+        self.read_until(client, lambda: len(quotes) >= 100)
+        for quote in quotes:
+            eq_((len(quote.contract_quotes.bids), len(quote.contract_quotes.offers)), (3, 3))
+        eq_([quote.eto_payload.seq for quote in quotes], list(range(2, 2 + len(quotes))))
+        client.logout()
+
+
+def test_quotes_without_subscribers_are_skipped():
+    server = StreamingServer(quote_rate=2000)
+    try:
+        server.run_once(0)
+        # Billions of quotes are due, working through them one tick at a time would take minutes
+        server._started_at -= 1000000
+        with patch.object(server, '_send_quote') as send_quote:
+            server.run_once(0)
+        eq_(send_quote.call_count, 0)
+        assert server._quote_ticks >= 2000000000
+    finally:
+        server.close()
@@ -1,18 +1,451 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import socket
+import sys
+import time
+from unittest import SkipTest
+
+from mock import Mock, patch
 from nose.tools import eq_
-from smarkets.streaming_api.session import SessionSettings, Session
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import frame_decode_all, frame_encode
+from smarkets.streaming_api.session import (
+    FLUSH_POLICY_EXPLICIT, FLUSH_POLICY_IMMEDIATE, FLUSH_POLICY_THRESHOLD, FLUSH_POLICY_WINDOW,
+    _monotonic, SHED_MARKET_DATA, SessionSettings, Session, SessionSocket,
+)
+from smarkets.tests.streaming_api.payloads import eto_payload, framed, pong_frames, quote_frames
 
 
 def test_next_frame_regression():
     settings = SessionSettings('username', 'password')
     session = Session(settings)
     session_string = '8zysBBGAD6nb95JDIO'
-    session.buffered_incoming_payloads = \
-        [bytearray(
+    session.buffered_incoming_payloads.append(
+        bytearray(
             b'\x08\x01\x12\x1e\x08\x01\x10\x08\x18\x002\x16\n\x12' +
             session_string.encode('utf-8') +
             b'\x10\x02'
-        )]
+        ))
     payload = session.next_frame().protobuf
     eq_(payload.eto_payload.login_response.session, session_string)
+
+
+def _chunked_recv_into(data, chunksize):
+    chunks = [data[i:i + chunksize] for i in range(0, len(data), chunksize)]
+
+    def recv_into(buffer, nbytes):
+        chunk = chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    return recv_into
+
+
+def test_read_receives_into_decoder_buffer():
+    settings = SessionSettings('username', 'password', read_buffer_capacity=16)
+    session = Session(settings)
+    session.socket = Mock()
+    session.socket.recv_into.side_effect = _chunked_recv_into(pong_frames(20), 5)
+
+    seqs = []
+    while len(seqs) < 20:
+        session.read()
+        frame = session.next_frame()
+        while frame is not None:
+            seqs.append(frame.protobuf.eto_payload.seq)
+            frame = session.next_frame()
+    eq_(seqs, list(range(1, 21)))
+
+
+def test_next_frames_drains_up_to_max_count():
+    session = Session(SessionSettings('username', 'password'))
+    session.decoder.feed(pong_frames(5))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames(3)], [1, 2, 3])
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [4, 5])
+    eq_(session.next_frame(), None)
+
+
+def test_next_frames_stops_on_out_of_sequence_payload():
+    session = Session(SessionSettings('username', 'password'))
+    session.decoder.feed(pong_frames(2) + pong_frames(2, first_seq=5))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [1, 2])
+    eq_(session.inseq, 3)
+
+
+def test_borrowed_frames_reuse_payload_objects():
+    settings = SessionSettings('username', 'password', borrowed_frames=True)
+    session = Session(settings)
+    session.decoder.feed(pong_frames(2 * Session.BORROWED_PAYLOAD_POOL_SIZE))
+    frames = [(frame.protobuf, frame.protobuf.eto_payload.seq) for frame in session.next_frames()]
+    eq_([seq for _, seq in frames], list(range(1, 2 * Session.BORROWED_PAYLOAD_POOL_SIZE + 1)))
+    eq_(len(set(id(payload) for payload, _ in frames)), Session.BORROWED_PAYLOAD_POOL_SIZE)
+
+
+def test_next_frames_skips_unwanted_payloads_without_parsing():
+    session = Session(SessionSettings('username', 'password'))
+    frames = pong_frames(3)
+    heartbeat = seto.Payload()
+    heartbeat.type = seto.PAYLOAD_ETO
+    heartbeat.eto_payload.type = eto.PAYLOAD_HEARTBEAT
+    heartbeat.eto_payload.seq = 4
+    frame_encode(frames, heartbeat.SerializeToString())
+    session.decoder.feed(frames)
+
+    wanted = Mock(return_value=False)
+    eq_(list(session.next_frames(wanted=wanted)), [])
+    eq_(wanted.call_count, 4)
+    eq_(wanted.call_args[0], (seto.PAYLOAD_ETO, eto.PAYLOAD_HEARTBEAT))
+    eq_(session.inseq, 5)
+    # the heartbeat was answered
+    assert session.send_buffer
+
+
+def _sending_session(**kwargs):
+    session = Session(SessionSettings('username', 'password', **kwargs))
+    session.socket = Mock()
+    session.socket.send.side_effect = len
+    return session
+
+
+def _send_pings(session, count):
+    for _ in range(count):
+        session.out_payload.Clear()
+        session.out_payload.type = seto.PAYLOAD_ETO
+        session.out_payload.eto_payload.type = eto.PAYLOAD_PING
+        session.send()
+
+
+def test_explicit_flush_policy_waits_for_flush():
+    session = _sending_session(flush_policy=FLUSH_POLICY_EXPLICIT)
+    _send_pings(session, 3)
+    eq_(session.socket.send.call_count, 0)
+    session.flush()
+    eq_(session.socket.send.call_count, 1)
+    eq_((session.flush_stats.payloads, session.flush_stats.flushes), (3, 1))
+    eq_(session.flush_stats.payloads_per_flush, 3.0)
+
+
+def test_immediate_flush_policy():
+    session = _sending_session(flush_policy=FLUSH_POLICY_IMMEDIATE)
+    _send_pings(session, 3)
+    eq_(session.socket.send.call_count, 3)
+    eq_(session.output_buffer_size, 0)
+
+
+def test_threshold_flush_policy():
+    session = _sending_session(flush_policy=FLUSH_POLICY_THRESHOLD, flush_threshold=20)
+    # every ping frame takes 9 bytes
+    _send_pings(session, 2)
+    eq_(session.socket.send.call_count, 0)
+    _send_pings(session, 1)
+    eq_(session.socket.send.call_count, 1)
+    eq_(session.flush_stats.bytes, 27)
+
+
+def test_window_flush_policy():
+    session = _sending_session(flush_policy=FLUSH_POLICY_WINDOW, flush_window=0.5)
+    with patch('smarkets.streaming_api.session._monotonic', return_value=10.0):
+        _send_pings(session, 2)
+        eq_(session.flush_deadline, 10.5)
+    eq_(session.socket.send.call_count, 0)
+    with patch('smarkets.streaming_api.session._monotonic', return_value=10.6):
+        _send_pings(session, 1)
+    eq_(session.socket.send.call_count, 1)
+    eq_(session.flush_deadline, None)
+
+
+def test_pending_payloads_are_flushed_before_reading():
+    session = _sending_session(flush_policy=FLUSH_POLICY_WINDOW, flush_window=60)
+    session.socket.recv_into.side_effect = _chunked_recv_into(pong_frames(1), 64)
+    _send_pings(session, 1)
+    session.read()
+    eq_(session.socket.send.call_count, 1)
+
+
+def test_cork_coalesces_payloads():
+    session = _sending_session(flush_policy=FLUSH_POLICY_IMMEDIATE)
+    with session.corked():
+        _send_pings(session, 5)
+        eq_(session.socket.send.call_count, 0)
+    eq_(session.socket.send.call_count, 1)
+    eq_(session.flush_stats.payloads_per_flush, 5.0)
+
+
+def _partial_writer(max_bytes, written):
+    def write(data):
+        data = b''.join(bytes(chunk) for chunk in data) if isinstance(data, list) else bytes(data)
+        written.extend(data[:max_bytes])
+        return min(max_bytes, len(data))
+
+    return write
+
+
+def test_partial_sends_keep_the_frames_in_order():
+    session = _sending_session()
+    written = bytearray()
+    session.socket.send.side_effect = _partial_writer(5, written)
+    _send_pings(session, 10)
+    expected = bytes(session.send_buffer)
+    while session.output_buffer_size:
+        session.flush()
+        assert session._send_offset <= len(session.send_buffer)
+    eq_(bytes(written), expected)
+    eq_(len(session.send_buffer), 0)
+
+
+def test_vectored_flush_sends_queued_frames_with_sendmsg():
+    session = _sending_session(ssl=False, vectored_flush=True)
+    written = bytearray()
+    session.socket.sendmsg.side_effect = _partial_writer(7, written)
+    _send_pings(session, 4)
+    expected = bytearray()
+    for frame in session._send_chunks:
+        expected += frame
+    eq_(session.output_buffer_size, len(expected))
+    while session.output_buffer_size:
+        session.flush()
+    eq_(bytes(written), bytes(expected))
+    eq_(session.socket.send.call_count, 0)
+
+
+def test_send_many_sequences_and_buffers_a_batch():
+    session = _sending_session(flush_policy=FLUSH_POLICY_IMMEDIATE)
+    written = bytearray()
+    session.socket.send.side_effect = _partial_writer(1024, written)
+    cancels = []
+    for order_id in range(1, 4):
+        cancel = seto.OrderCancel()
+        cancel.order_id = order_id
+        cancels.append(cancel)
+    eq_(session.send_many(iter(cancels)), 3)
+    eq_(session.socket.send.call_count, 1)
+    eq_(session.buf_outseq, 4)
+    payloads = []
+    for data in frame_decode_all(written)[0]:
+        payload = seto.Payload()
+        payload.ParseFromString(bytes(data))
+        payloads.append(payload)
+    eq_([payload.type for payload in payloads], [seto.PAYLOAD_ORDER_CANCEL] * 3)
+    eq_([payload.eto_payload.seq for payload in payloads], [1, 2, 3])
+    eq_([payload.order_cancel.order_id for payload in payloads], [1, 2, 3])
+    eq_(session.send_many([]), 0)
+    eq_(session.socket.send.call_count, 1)
+
+
+def test_send_many_buffers_nothing_when_a_message_fails():
+    session = _sending_session()
+    written = bytearray()
+    session.socket.send.side_effect = _partial_writer(1024, written)
+    cancel = seto.OrderCancel()
+    cancel.order_id = 1
+    # Not a seto payload message
+    unsupported = eto.Replay()
+    try:
+        session.send_many([cancel, cancel, unsupported])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('sending an unsupported message should fail')
+    eq_((session.output_buffer_size, session.buf_outseq), (0, 1))
+    _send_pings(session, 1)
+    session.flush()
+    [data], _ = frame_decode_all(written)
+    payload = seto.Payload()
+    payload.ParseFromString(bytes(data))
+    eq_(payload.eto_payload.seq, 1)
+
+
+def test_kernel_timestamps_date_frames_from_their_arrival():
+    if not sys.platform.startswith('linux'):
+        raise SkipTest('kernel receive timestamps are only available on Linux')
+    if not hasattr(socket.socket, 'recvmsg_into'):
+        raise SkipTest('kernel receive timestamps need socket.recvmsg_into')
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    host, port = listener.getsockname()
+    session = Session(SessionSettings(
+        'username', 'password', host=host, port=port, ssl=False, kernel_timestamps=True))
+    session.socket.connect()
+    server, _ = listener.accept()
+    try:
+        eq_(session.socket.kernel_timestamps, True)
+        # The kernel turns timestamping on in the background, the first packets may have none
+        for first_seq in range(1, 40, 2):
+            server.sendall(bytes(pong_frames(2, first_seq)))
+            time.sleep(0.05)
+            session.read()
+            read_at = _monotonic()
+            frames = list(session.next_frames())
+            eq_(len(frames), 2)
+            if session.socket.kernel_received_at is not None:
+                break
+        assert session.socket.kernel_received_at is not None
+        # The frames are dated from when the kernel got them, before sleeping
+        for frame in frames:
+            assert read_at - frame.received_at / 1e9 >= 0.04, read_at - frame.received_at / 1e9
+    finally:
+        server.close()
+        listener.close()
+        session.socket.disconnect()
+    eq_(session.socket.kernel_timestamps, False)
+
+
+def test_kernel_timestamps_fall_back_with_ssl():
+    sock = Mock()
+    session_socket = SessionSocket(SessionSettings('username', 'password', ssl=True, kernel_timestamps=True))
+    eq_(session_socket._enable_kernel_timestamps(sock), False)
+    eq_(sock.setsockopt.call_count, 0)
+
+
+def test_frames_are_not_timed_by_default():
+    session = Session(SessionSettings('username', 'password'))
+    session.socket = Mock()
+    session.socket.recv_into.side_effect = _chunked_recv_into(pong_frames(2), 1024)
+    session.read()
+    eq_([frame.received_at for frame in session.next_frames()], [None, None])
+    eq_(len(session._read_times), 0)
+
+
+def test_reads_pause_over_the_frame_high_water_mark():
+    session = Session(SessionSettings('username', 'password', inbound_high_water_frames=4))
+    session.socket = Mock()
+    session.socket.recv_into.side_effect = _chunked_recv_into(pong_frames(10), 4096)
+    changes = []
+    session.overload += lambda **kwargs: changes.append(
+        (kwargs['overloaded'], kwargs['buffered_frames']))
+
+    session.read()
+    eq_((session.overloaded, session.buffered_frames), (True, 10))
+    # Paused, nothing is received until enough frames are handled
+    session.read()
+    eq_(session.socket.recv_into.call_count, 1)
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames(7)], list(range(1, 8)))
+    eq_(session.overloaded, True)
+    eq_(len(list(session.next_frames(1))), 1)
+    eq_(session.overloaded, False)
+    eq_(changes, [(True, 10), (False, 2)])
+    eq_(session.buffered_bytes, len(pong_frames(2)))
+    eq_((session.inbound_stats.overloads, session.inbound_stats.max_buffered_frames), (1, 10))
+
+
+def test_byte_high_water_mark_needs_a_complete_frame():
+    frames = pong_frames(3)
+    session = Session(SessionSettings('username', 'password', inbound_high_water_bytes=2))
+    # Half a frame can't be handled, holding the rest back would stall the session
+    session.decoder.feed(frames[:5])
+    session.check_inbound()
+    eq_(session.overloaded, False)
+    session.decoder.feed(frames[5:])
+    session.check_inbound()
+    eq_(session.overloaded, True)
+    eq_(len(list(session.next_frames())), 3)
+    eq_(session.overloaded, False)
+
+
+def test_queued_payloads_are_counted_as_they_come_and_go():
+    session = Session(SessionSettings('username', 'password'))
+    payloads = [eto_payload(seq) for seq in (1, 2, 3)]
+    session.buffered_incoming_payloads.extend(payloads)
+    session.decoder.feed(pong_frames(1, first_seq=4))
+    eq_(session.buffered_bytes, sum(len(data) for data in payloads) + len(pong_frames(1, first_seq=4)))
+    eq_(len(list(session.next_frames(2))), 2)
+    eq_(session.buffered_bytes, len(payloads[2]) + len(pong_frames(1, first_seq=4)))
+    session.disconnect()
+    eq_(session.buffered_bytes, 0)
+
+
+def test_overloaded_session_sheds_market_data():
+    session = Session(SessionSettings(
+        'username', 'password', inbound_high_water_frames=4, shed_payload_types=SHED_MARKET_DATA))
+    session.decoder.feed(quote_frames(5) + pong_frames(2, first_seq=6) + quote_frames(3, first_seq=8))
+    session.check_inbound()
+    eq_(session.overloaded, True)
+    frames = list(session.next_frames())
+    # Shedding stops once the buffers drop to half the mark
+    eq_([frame.protobuf.eto_payload.seq for frame in frames], [6, 7, 8, 9, 10])
+    eq_(session.inbound_stats.payloads_shed, 5)
+    eq_(session.inseq, 11)
+    eq_(session.overloaded, False)
+
+
+def test_payloads_ahead_of_a_gap_wait_for_it_to_be_filled():
+    session = Session(SessionSettings('username', 'password'))
+    gaps = []
+    session.gap += lambda **kwargs: gaps.append((kwargs['first'], kwargs['last'], kwargs['skipped']))
+    session.decoder.feed(framed(eto_payload(seq) for seq in [1, 2, 5, 4]))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [1, 2])
+    eq_(gaps, [(3, 4, False)])
+    session.decoder.feed(framed(eto_payload(seq) for seq in [3, 6]))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [3, 4, 5, 6])
+    eq_(len(gaps), 1)
+    eq_((session.sequence_stats.gaps, session.sequence_stats.payloads_reordered), (1, 2))
+    eq_(session.sequence_stats.max_reorder_depth, 2)
+
+
+def test_payloads_received_twice_are_dropped():
+    session = Session(SessionSettings('username', 'password'))
+    session.decoder.feed(framed(eto_payload(seq) for seq in [1, 2, 2, 1, 4, 4, 3]))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [1, 2, 3, 4])
+    eq_(session.sequence_stats.duplicates, 3)
+
+
+def test_gaps_are_skipped_when_the_reorder_buffer_is_full():
+    session = Session(SessionSettings('username', 'password', reorder_capacity=2, borrowed_frames=True))
+    gaps = []
+    session.gap += lambda **kwargs: gaps.append((kwargs['first'], kwargs['last'], kwargs['skipped']))
+    session.decoder.feed(framed(eto_payload(seq) for seq in [1, 4, 5, 6, 7]))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [1, 4, 5, 6, 7])
+    eq_(gaps, [(2, 3, False), (2, 3, True)])
+    stats = session.sequence_stats
+    eq_((stats.gaps_skipped, stats.payloads_lost), (1, 2))
+    # A late payload from the gap is a duplicate now
+    session.decoder.feed(framed(eto_payload(seq) for seq in [3, 8]))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [8])
+    eq_(stats.duplicates, 1)
+
+
+def _sent_payloads(session):
+    payloads = []
+    for data in frame_decode_all(session.send_buffer)[0]:
+        payload = seto.Payload()
+        payload.ParseFromString(bytes(data))
+        payloads.append(payload)
+    return payloads
+
+
+def test_heartbeats_are_answered_during_a_gap():
+    session = Session(SessionSettings('username', 'password'))
+    frames = quote_frames(1)
+    heartbeat = seto.Payload()
+    heartbeat.type = seto.PAYLOAD_ETO
+    heartbeat.eto_payload.type = eto.PAYLOAD_HEARTBEAT
+    for seq in (3, 4):
+        heartbeat.eto_payload.seq = seq
+        frame_encode(frames, heartbeat.SerializeToString())
+    session.decoder.feed(frames)
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [1])
+    sent = _sent_payloads(session)
+    eq_([payload.eto_payload.type for payload in sent],
+        [eto.PAYLOAD_REPLAY, eto.PAYLOAD_HEARTBEAT, eto.PAYLOAD_HEARTBEAT])
+    eq_(sent[0].eto_payload.replay.seq, 2)
+    session.decoder.feed(quote_frames(1, first_seq=2))
+    eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [2, 3, 4])
+    # They aren't answered again when they're handled in sequence
+    eq_(len(_sent_payloads(session)), 3)
+
+
+def test_gaps_are_skipped_after_the_reorder_timeout():
+    session = Session(SessionSettings('username', 'password', reorder_timeout=1.0))
+    gaps = []
+    session.gap += lambda **kwargs: gaps.append((kwargs['first'], kwargs['last'], kwargs['skipped']))
+    with patch('smarkets.streaming_api.session._monotonic', return_value=100.0) as clock:
+        session.decoder.feed(quote_frames(1) + quote_frames(2, first_seq=4))
+        eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [1])
+        clock.return_value = 100.5
+        eq_(list(session.next_frames()), [])
+        clock.return_value = 101.0
+        eq_([frame.protobuf.eto_payload.seq for frame in session.next_frames()], [4, 5])
+    eq_(gaps, [(2, 3, False), (2, 3, True)])
+    eq_(session.sequence_stats.payloads_lost, 2)
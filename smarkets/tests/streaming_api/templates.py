@@ -0,0 +1,72 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.framing import peek_payload_header
+from smarkets.streaming_api.templates import (
+    HEARTBEAT_TEMPLATE, PayloadTemplate, PING_TEMPLATE, REPLAY_TEMPLATE,
+)
+
+
+def _parse(data):
+    payload = seto.Payload()
+    payload.ParseFromString(data)
+    return payload
+
+
+def _order_create(**kwargs):
+    fields = dict(side=seto.SIDE_BUY, quantity=1000, price=2500, market_id=1, contract_id=2, label='quote')
+    fields.update(kwargs)
+    return seto.OrderCreate(**fields)
+
+
+def test_patched_fields_match_a_serialised_message():
+    template = PayloadTemplate(_order_create(), ('price', 'quantity', 'contract_id'))
+    for seq, price, quantity, contract_id in ((1, 0, 0, 0), (300, 9999, 1 << 40, 4000000000)):
+        expected = seto.Payload()
+        expected.type = seto.PAYLOAD_ORDER_CREATE
+        expected.eto_payload.seq = seq
+        expected.order_create.CopyFrom(_order_create(price=price, quantity=quantity, contract_id=contract_id))
+        eq_(_parse(template.serialize(seq, price, quantity, contract_id)), expected)
+
+
+def test_payload_prototypes_take_dotted_paths():
+    payload = seto.Payload()
+    payload.type = seto.PAYLOAD_ORDER_CANCEL
+    payload.order_cancel.order_id = 1
+    template = PayloadTemplate(payload, ('order_cancel.order_id',))
+    parsed = _parse(template.serialize(5, 1 << 63))
+    eq_(parsed.eto_payload.seq, 5)
+    eq_(parsed.order_cancel.order_id, 1 << 63)
+
+
+def test_ping_and_heartbeat_templates():
+    templates = ((PING_TEMPLATE, eto.PAYLOAD_PING), (HEARTBEAT_TEMPLATE, eto.PAYLOAD_HEARTBEAT))
+    for template, eto_type in templates:
+        parsed = _parse(template.serialize(42))
+        eq_(parsed.type, seto.PAYLOAD_ETO)
+        eq_((parsed.eto_payload.type, parsed.eto_payload.seq), (eto_type, 42))
+
+
+def test_replay_template():
+    parsed = _parse(REPLAY_TEMPLATE.serialize(42, 300))
+    eq_((parsed.type, parsed.eto_payload.type), (seto.PAYLOAD_ETO, eto.PAYLOAD_REPLAY))
+    eq_((parsed.eto_payload.seq, parsed.eto_payload.replay.seq), (42, 300))
+
+
+def test_only_integer_fields_can_be_patched():
+    assert_raises(ValueError, PayloadTemplate, _order_create(), ('label',))
+    assert_raises(ValueError, PayloadTemplate, _order_create(), ('no_such_field',))
+
+
+def test_negative_values_are_refused():
+    template = PayloadTemplate(_order_create(), ('price',))
+    assert_raises(ValueError, template.serialize, 1, -1)
+    assert_raises(ValueError, template.serialize, 1, -200)
+
+
+def test_templated_payloads_can_be_peeked():
+    template = PayloadTemplate(_order_create(), ('price',))
+    eq_(peek_payload_header(template.serialize(7, 2500)), (seto.PAYLOAD_ORDER_CREATE, eto.PAYLOAD_NONE, 7))
+    eq_(peek_payload_header(PING_TEMPLATE.serialize(8)), (seto.PAYLOAD_ETO, eto.PAYLOAD_PING, 8))
@@ -0,0 +1,174 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import unittest
+
+from nose.tools import assert_raises, eq_
+
+from smarkets.streaming_api import eto, seto
+from smarkets.streaming_api.server import StreamingServer
+from smarkets.streaming_api.session import Session, SessionSettings
+from smarkets.streaming_api.threaded import FrameQueue, ThreadedStreamingAPIClient
+
+
+def test_frame_queue_hands_over_batches():
+    queue = FrameQueue(4)
+    eq_(queue.put_many([1, 2, 3]), 3)
+    eq_((queue.depth, queue.max_depth), (3, 3))
+    eq_(queue.get_many(), [1, 2, 3])
+    eq_(queue.get_many(timeout=0.01), [])
+    queue.put_many([4])
+    queue.close()
+    eq_(queue.put_many([5]), 0)
+    eq_(queue.get_many(), [4])
+    eq_(queue.get_many(), None)
+    eq_((queue.frames_in, queue.frames_out), (4, 4))
+
+
+def test_frame_queue_put_waits_for_room():
+    queue = FrameQueue(2)
+    taken = []
+
+    def take():
+        while True:
+            frames = queue.get_many()
+            if frames is None:
+                return
+            taken.extend(frames)
+            time.sleep(0.01)
+
+    worker = threading.Thread(target=take)
+    worker.start()
+    eq_(queue.put_many(list(range(10))), 10)
+    queue.close()
+    worker.join(5)
+    eq_(taken, list(range(10)))
+    eq_(queue.max_depth, 2)
+    assert queue.put_waits > 0
+
+
+def test_borrowed_frames_are_refused():
+    session = Session(SessionSettings('username', 'password', borrowed_frames=True))
+    assert_raises(ValueError, ThreadedStreamingAPIClient, session)
+
+
+class ThreadedStreamingAPIClientTestCase(unittest.TestCase):
+
+    "Tests for the threaded client against the local server"
+
+    def setUp(self):
+        self.server = StreamingServer(quote_rate=2000, heartbeat_interval=0.02)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        host, port = self.server.address
+        settings = SessionSettings('username', 'password', host=host, port=port, ssl=False, socket_timeout=5)
+        return ThreadedStreamingAPIClient(Session(settings), **kwargs)
+
+    def wait_until(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            assert time.time() < deadline, 'timed out'
+            time.sleep(0.005)
+
+    def test_slow_handlers_do_not_hold_up_heartbeats(self):
+        client = self.client()
+        client.login()
+        quotes = []
+        threads = set()
+        release = threading.Event()
+
+        def on_quotes(message):
+            threads.add(threading.current_thread().name)
+            release.wait(5)
+            quotes.append(message.contract_quotes.market_id)
+
+        client.add_handler('seto.contract_quotes', on_quotes)
+        client.start()
+        client.send(seto.MarketSubscribe(market_id=7))
+        client.flush()
+        self.wait_until(lambda: client.queue_depth > 10)
+        received = self.server.stats.payloads_received
+        # Heartbeats keep being answered while the handler is blocked
+        self.wait_until(lambda: self.server.stats.payloads_received >= received + 3)
+        release.set()
+        self.wait_until(lambda: len(quotes) > 20)
+        eq_(threads, set(['smarkets-worker-0']))
+        eq_(set(quotes), set([7]))
+        assert client.queues[0].max_depth > 10
+        client.logout()
+        assert not client.running
+        eq_(client.reader_error, None)
+        eq_(client.last_login.eto_payload.type, eto.PAYLOAD_LOGOUT)
+
+    def test_only_the_reader_disconnects_on_logout(self):
+        client = self.client()
+        client.login()
+        disconnect = client.session.disconnect
+        threads = []
+
+        def record_disconnect():
+            threads.append(threading.current_thread().name)
+            disconnect()
+
+        client.session.disconnect = record_disconnect
+        client.start()
+        client.logout()
+        eq_(client.last_login.eto_payload.type, eto.PAYLOAD_LOGOUT)
+        assert threads
+        assert 'smarkets-worker-0' not in threads, threads
+
+    def test_frames_with_the_same_key_go_to_the_same_worker(self):
+        client = self.client(workers=3, key=lambda message: message.contract_quotes.market_id)
+        client.login()
+        workers = {}
+        seqs = {}
+        lock = threading.Lock()
+
+        def on_quotes(message):
+            market_id = message.contract_quotes.market_id
+            with lock:
+                workers.setdefault(market_id, set()).add(threading.current_thread().name)
+                seqs.setdefault(market_id, []).append(message.eto_payload.seq)
+
+        client.add_handler('seto.contract_quotes', on_quotes)
+        client.start()
+        client.send_many([seto.MarketSubscribe(market_id=market_id) for market_id in (1, 2, 3, 4)])
+        self.wait_until(lambda: sum(len(values) for values in seqs.values()) > 200)
+        client.stop()
+        eq_(sorted(workers), [1, 2, 3, 4])
+        for market_id, names in workers.items():
+            eq_(len(names), 1)
+            eq_(seqs[market_id], sorted(seqs[market_id]))
+        eq_(client.handler_errors, 0)
+        eq_(sum(queue.frames_out for queue in client.queues), client.frames_read)
+
+    def test_reader_error_stops_the_workers(self):
+        client = self.client()
+        client.login()
+        client.start()
+        self.server.stop()
+        client.join(5)
+        assert not client.running
+        assert client.reader_error is not None
+        eq_([queue.closed for queue in client.queues], [True])
+
+    def test_key_errors_stop_the_reader(self):
+        def key(message):
+            raise KeyError(message.type)
+
+        client = self.client(workers=2, key=key)
+        client.login()
+        client.add_handler('seto.contract_quotes', lambda message: None)
+        client.start()
+        client.send(seto.MarketSubscribe(market_id=7))
+        client.flush()
+        client.join(5)
+        assert not client.running
+        assert isinstance(client.reader_error, KeyError)
+        assert not client.session.connected
+        eq_([queue.closed for queue in client.queues], [True, True])
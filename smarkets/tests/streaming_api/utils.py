@@ -1,9 +1,15 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from nose.tools import eq_
+from mock import patch
+from nose.tools import eq_, raises
 
-from smarkets.streaming_api.seto import OrderCreate, Payload, PAYLOAD_ORDER_CREATE
-from smarkets.streaming_api.utils import set_payload_message
+from smarkets.streaming_api import utils
+from smarkets.streaming_api.eto import Replay
+from smarkets.streaming_api.seto import (
+    MarketQuotes, OrderCancel, OrderCreate, Payload, PAYLOAD_MARKET_QUOTES, PAYLOAD_ORDER_CANCEL,
+    PAYLOAD_ORDER_CREATE,
+)
+from smarkets.streaming_api.utils import payload_field, set_payload_message
 
 
 def test_set_payload_message():
@@ -14,3 +20,30 @@ def test_set_payload_message():
     set_payload_message(payload, oc)
     eq_(payload.type, PAYLOAD_ORDER_CREATE)
     eq_(payload.order_create, oc)
+
+
+def test_set_payload_message_reuses_payload_fields():
+    payload = Payload()
+    set_payload_message(payload, OrderCancel(order_id=1))
+    set_payload_message(payload, OrderCancel(order_id=2))
+    eq_(payload.type, PAYLOAD_ORDER_CANCEL)
+    eq_(payload.order_cancel.order_id, 2)
+
+
+def test_payload_fields_are_looked_up_once_per_class():
+    utils._PAYLOAD_FIELDS.pop(MarketQuotes, None)
+    with patch.object(utils, '_find_payload_field', wraps=utils._find_payload_field) as find:
+        payload = Payload()
+        for market_id in range(3):
+            set_payload_message(payload, MarketQuotes(market_id=market_id))
+        eq_(payload_field(MarketQuotes)[0], PAYLOAD_MARKET_QUOTES)
+    eq_(find.call_count, 1)
+    eq_(payload.market_quotes.market_id, 2)
+    field = payload_field(MarketQuotes)[1]
+    eq_(field, Payload.DESCRIPTOR.fields_by_name['market_quotes'])
+    eq_(field.message_type, MarketQuotes.DESCRIPTOR)
+
+
+@raises(ValueError)
+def test_payload_field_rejects_messages_which_are_not_payloads():
+    payload_field(Replay)